@@ -0,0 +1,86 @@
+import json
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from app.core.dependencies import get_training_job_service
+from app.schemas.jobs import TrainingJobCreate, TrainingJobResponse
+from services.training_job_service import TrainingJobService
+
+router = APIRouter()
+
+
+@router.post("/", response_model=TrainingJobResponse, status_code=202)
+async def submit_training_job(
+    job: TrainingJobCreate,
+    service: TrainingJobService = Depends(get_training_job_service),
+):
+    try:
+        # 队列已满时抛出 WorkerOverloadedError，由 server 转换为 429
+        submitted_job = service.submit_job(
+            job.job_type,
+            rounds=job.rounds,
+            batch_size=job.batch_size,
+            entry_id=job.entry_id,
+        )
+        return TrainingJobResponse.from_domain(submitted_job)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/", response_model=list[TrainingJobResponse])
+async def list_training_jobs(
+    service: TrainingJobService = Depends(get_training_job_service),
+):
+    return [TrainingJobResponse.from_domain(job) for job in service.list_jobs()]
+
+
+@router.get("/{job_id}", response_model=TrainingJobResponse)
+async def get_training_job(
+    job_id: str,
+    service: TrainingJobService = Depends(get_training_job_service),
+):
+    try:
+        return TrainingJobResponse.from_domain(service.get_job(job_id))
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@router.post("/{job_id}/cancel", response_model=TrainingJobResponse)
+async def cancel_training_job(
+    job_id: str,
+    service: TrainingJobService = Depends(get_training_job_service),
+):
+    try:
+        job = service.get_job(job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if job.is_finished:
+        raise HTTPException(status_code=409, detail=f"Job has already {job.status}")
+    return TrainingJobResponse.from_domain(service.cancel_job(job_id))
+
+
+@router.get("/{job_id}/events")
+def stream_training_job_events(
+    job_id: str,
+    service: TrainingJobService = Depends(get_training_job_service),
+):
+    try:
+        snapshots = service.watch_job(job_id)
+        first_snapshot = next(snapshots)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    def event_stream():
+        yield f"event: progress\ndata: {json.dumps(first_snapshot, ensure_ascii=False)}\n\n"
+        for snapshot in snapshots:
+            if snapshot is None:
+                # 心跳，避免代理因为长时间没有数据而断开连接
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: progress\ndata: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,9 +1,20 @@
 from fastapi import APIRouter, Depends, HTTPException
+from app.core.config import settings
 from app.core.dependencies import (
+    get_llm_manager,
     get_training_loss_service,
     get_training_session_service,
+    get_training_worker,
 )
-from app.schemas.sessions import TrainingSessionCreate, TrainingSessionResponse
+from app.schemas.sessions import (
+    SpeculativeConfigResponse,
+    SpeculativeConfigUpdate,
+    TrainingSessionCreate,
+    TrainingSessionResponse,
+)
+from llm.speculative import SpeculativeConfig
+from llm_manager import LLMManager
+from services.model_worker import ModelWorker
 from services.training_loss_service import TrainingLossService
 from services.training_session_service import TrainingSessionService
 
@@ -14,10 +25,17 @@ router = APIRouter()
 async def create_training_session(
     session: TrainingSessionCreate,
     service: TrainingSessionService = Depends(get_training_session_service),
+    training_worker: ModelWorker = Depends(get_training_worker),
 ):
+    lora_config = session.lora.model_dump(exclude_none=True) if session.lora else None
     try:
-        created_session = service.create_session(
-            name=session.name, base_model=session.base_model
+        created_session = await training_worker.run(
+            service.create_session,
+            name=session.name,
+            base_model=session.base_model,
+            training_mode=session.training_mode,
+            lora_config=lora_config,
+            timeout=settings.TRAINING_REQUEST_TIMEOUT,
         )
         return TrainingSessionResponse.from_domain(created_session)
     except ValueError as e:
@@ -28,9 +46,15 @@ async def create_training_session(
 async def load_training_session(
     session_id: str,
     service: TrainingSessionService = Depends(get_training_session_service),
+    training_worker: ModelWorker = Depends(get_training_worker),
 ):
     try:
-        loaded_session = service.load_session(session_id)
+        # 切换会话可能需要从磁盘加载模型，放到模型 worker 上执行
+        loaded_session = await training_worker.run(
+            service.load_session,
+            session_id,
+            timeout=settings.TRAINING_REQUEST_TIMEOUT,
+        )
         return TrainingSessionResponse.from_domain(loaded_session)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
@@ -41,10 +65,14 @@ async def save_current_session(
     training_session_service: TrainingSessionService = Depends(
         get_training_session_service
     ),
+    training_worker: ModelWorker = Depends(get_training_worker),
 ):
     try:
         # Save the current session and model
-        saved_session = training_session_service.save_current_session()
+        saved_session = await training_worker.run(
+            training_session_service.save_current_session,
+            timeout=settings.TRAINING_REQUEST_TIMEOUT,
+        )
 
         return TrainingSessionResponse.from_domain(saved_session)
     except ValueError as e:
@@ -64,8 +92,13 @@ async def get_current_session(
 @router.post("/end", response_model=None)
 async def end_current_session(
     service: TrainingSessionService = Depends(get_training_session_service),
+    training_worker: ModelWorker = Depends(get_training_worker),
 ):
-    service.end_current_session()
+    # 有未保存的损失时会先保存模型，与训练一样放到模型 worker 上执行
+    await training_worker.run(
+        service.end_current_session,
+        timeout=settings.TRAINING_REQUEST_TIMEOUT,
+    )
     return {"message": "Current session ended successfully"}
 
 
@@ -87,3 +120,48 @@ async def list_sessions(
 ):
     sessions = service.list_sessions()
     return [TrainingSessionResponse.from_domain(session) for session in sessions]
+
+
+@router.get("/models")
+async def get_loaded_models(llm_manager: LLMManager = Depends(get_llm_manager)):
+    return llm_manager.get_registry_stats()
+
+
+@router.get("/speculative", response_model=SpeculativeConfigResponse)
+async def get_speculative_config(
+    service: TrainingSessionService = Depends(get_training_session_service),
+    llm_manager: LLMManager = Depends(get_llm_manager),
+):
+    session = service.get_current_session()
+    if not session:
+        raise HTTPException(status_code=404, detail="No active training session")
+    config = llm_manager.get_speculative_config(session.name)
+    return SpeculativeConfigResponse(
+        **config.__dict__, stats=llm_manager.get_speculative_stats(session.name)
+    )
+
+
+@router.put("/speculative", response_model=SpeculativeConfigResponse)
+async def update_speculative_config(
+    update: SpeculativeConfigUpdate,
+    service: TrainingSessionService = Depends(get_training_session_service),
+    llm_manager: LLMManager = Depends(get_llm_manager),
+    training_worker: ModelWorker = Depends(get_training_worker),
+):
+    session = service.get_current_session()
+    if not session:
+        raise HTTPException(status_code=404, detail="No active training session")
+    try:
+        config = SpeculativeConfig(**update.model_dump())
+        # 加载草稿模型可能比较耗时，放到模型 worker 上执行
+        await training_worker.run(
+            llm_manager.set_speculative_config,
+            session.name,
+            config,
+            timeout=settings.TRAINING_REQUEST_TIMEOUT,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return SpeculativeConfigResponse(
+        **config.__dict__, stats=llm_manager.get_speculative_stats(session.name)
+    )
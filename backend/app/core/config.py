@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic_settings import BaseSettings
 
 
@@ -5,6 +6,83 @@ class Settings(BaseSettings):
     PROJECT_NAME: str = "HeartEcho"
     VERSION: str = "0.1.0"
     MONGODB_URL: str = "mongodb://100.117.209.140:27017/heartecho"
+    # 流式对话时，等待下一个 token 的最长秒数
+    CHAT_STREAM_TIMEOUT: float = 300.0
+    # 多轮对话 KV 前缀缓存
+    PROMPT_CACHE_ENABLED: bool = True
+    PROMPT_CACHE_MAX_ENTRIES: int = 8
+    PROMPT_CACHE_MAX_MB: int = 1024
+    # 相同对话历史与生成参数的回复缓存
+    RESPONSE_CACHE_ENABLED: bool = True
+    RESPONSE_CACHE_MAX_ENTRIES: int = 256
+    # 并发对话请求合并成 batch 解码
+    CHAT_BATCHING_ENABLED: bool = False
+    CHAT_MAX_BATCH_SIZE: int = 8
+    # 没有 GPU 时，对话使用 int8 动态量化模型
+    CHAT_INT8_ON_CPU: bool = True
+    # 对话使用双缓冲快照，训练期间也能对话；发布时机为 "step" 或 "round"
+    INFERENCE_SNAPSHOT_ENABLED: bool = False
+    INFERENCE_SNAPSHOT_PUBLISH: str = "round"
+    # 同时保留多个会话的模型：超出显存预算时把最久未用的模型卸载到 CPU，
+    # 超出内存预算时移除（未保存的训练结果会先保存）
+    MODEL_REGISTRY_DEVICE_MB: int = 20480
+    MODEL_REGISTRY_HOST_MB: int = 32768
+    # 启动时在后台加载的会话（不设置时加载最近训练的会话），以及预热生成的 token 数（0 表示不预热）
+    STARTUP_LOAD_SESSION: bool = True
+    STARTUP_SESSION_ID: Optional[str] = None
+    WARMUP_MAX_NEW_TOKENS: int = 8
+    # lora 会话对话时使用合并了 adapter 的副本，生成更快，但要多占一份完整模型的内存
+    # （CPU 上的 int8 量化模型本身就是合并后的）
+    LORA_MERGE_FOR_INFERENCE: bool = False
+    # 训练的学习率，以及新会话开始训练时的学习率预热步数（0 表示不预热）
+    TRAIN_LEARNING_RATE: float = 1e-5
+    TRAIN_WARMUP_STEPS: int = 0
+    # 训练内存模式：default，或 lean（激活检查点 + bf16 autocast，能训练更长的语料）
+    TRAIN_MEMORY_MODE: str = "default"
+    # 训练和评估时每个样本的 token 上限，更长的语料切成多个窗口，相邻窗口重叠
+    # TRAIN_WINDOW_OVERLAP 个 token 作为上下文
+    TRAIN_MAX_LENGTH: int = 2048
+    TRAIN_WINDOW_OVERLAP: int = 256
+    # 多轮训练任务在当前一轮训练时，后台抽取下一轮的新语料并分词
+    TRAIN_PREFETCH_NEXT_ROUND: bool = True
+    # 保存会话时在后台线程写入检查点，会话目录下保留最近 CHECKPOINT_KEEP 个
+    CHECKPOINT_ASYNC: bool = True
+    CHECKPOINT_KEEP: int = 3
+    # 训练之后每 CHECKPOINT_EVERY_ROUNDS 轮，或距上一个检查点超过 CHECKPOINT_EVERY_SECONDS 秒
+    # 时写入检查点（0 表示不按该条件）；语料的损失在检查点写入之后才写入数据库
+    CHECKPOINT_EVERY_ROUNDS: int = 0
+    CHECKPOINT_EVERY_SECONDS: int = 600
+    # 语料分词结果的缓存（按 sha256 和分词器指纹保存在本地 sqlite 中）
+    TOKEN_CACHE_ENABLED: bool = True
+    TOKEN_CACHE_PATH: str = "./trained/token_cache.sqlite"
+    TOKEN_CACHE_MEMORY_ENTRIES: int = 4096
+    # 导出的 token 语料（mmap 文件）所在目录，每个语料库一个子目录，全部语料为 all
+    TOKEN_CORPUS_DIR: str = "./trained/token_corpus"
+    # 训练时每个 batch 补齐后的 token 上限，长度相近的条目合并成一个 batch（设为 1 即逐条训练）
+    TRAIN_MAX_BATCH_TOKENS: int = 4096
+    # 训练时把多条短语料打包成一个不超过 TRAIN_PACK_MAX_LENGTH 个 token 的块
+    TRAIN_PACKING_ENABLED: bool = False
+    TRAIN_PACK_MAX_LENGTH: int = 4096
+    # 无梯度评估语料损失时，每个 batch 的 token 上限，以及每次从数据库读取的条数
+    SCORE_MAX_BATCH_TOKENS: int = 8192
+    SCORE_PAGE_SIZE: int = 256
+    # 模型任务队列：队列长度与请求截止时间（秒）
+    CHAT_QUEUE_SIZE: int = 32
+    CHAT_REQUEST_TIMEOUT: float = 300.0
+    TRAINING_QUEUE_SIZE: int = 4
+    TRAINING_REQUEST_TIMEOUT: float = 3600.0
+    # 内存中保留的已结束训练任务数
+    TRAINING_JOB_HISTORY: int = 100
+    # 自动训练（默认关闭）：新语料达到 AUTO_SMELT_BATCH_SIZE 条时执行 smelt_new_corpus，
+    # 在空闲时段（如 "01:00-07:00"，多个时段用逗号分隔）没有新语料时执行 smelt_new_old
+    AUTO_SMELT_ENABLED: bool = False
+    AUTO_SMELT_POLL_SECONDS: float = 30.0
+    AUTO_SMELT_BATCH_SIZE: int = 16
+    AUTO_SMELT_IDLE_WINDOWS: str = ""
+    # 最近这么多秒内有对话请求时不开始新的一轮训练
+    AUTO_SMELT_CHAT_QUIET_SECONDS: float = 60.0
+    # 自动训练之后，每隔这么多秒保存一次会话（0 表示不自动保存）
+    AUTO_SMELT_SAVE_INTERVAL_SECONDS: float = 1800.0
 
     class Config:
         env_file = ".env"
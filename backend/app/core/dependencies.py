@@ -14,8 +14,11 @@ from repositories.training_loss.training_loss_repository import TrainingLossRepo
 from repositories.training_session.filesystem_training_session_repository import (
     FileSystemTrainingSessionRepository,
 )
+from services.auto_smelt_service import AutoSmeltService
 from services.corpus_management_service import CorpusManagementService
 from services.model_training_service import ModelTrainingService
+from services.model_worker import ModelWorker
+from services.training_job_service import TrainingJobService
 from services.training_loss_service import TrainingLossService
 from services.training_session_service import TrainingSessionService
 
@@ -29,7 +32,9 @@ def get_corpus_service() -> CorpusManagementService:
 @lru_cache()
 def get_training_session_service():
     training_session_repo = FileSystemTrainingSessionRepository()
-    return TrainingSessionService(training_session_repo, get_llm_manager())
+    return TrainingSessionService(
+        training_session_repo, get_llm_manager(), get_training_loss_service()
+    )
 
 
 @lru_cache()
@@ -42,6 +47,25 @@ def get_model_training_service() -> ModelTrainingService:
     )
 
 
+@lru_cache()
+def get_training_job_service() -> TrainingJobService:
+    return TrainingJobService(
+        model_training_service=get_model_training_service(),
+        training_session_service=get_training_session_service(),
+        training_worker=get_training_worker(),
+    )
+
+
+@lru_cache()
+def get_auto_smelt_service() -> AutoSmeltService:
+    return AutoSmeltService(
+        model_training_service=get_model_training_service(),
+        training_session_service=get_training_session_service(),
+        training_job_service=get_training_job_service(),
+        chat_worker=get_chat_worker(),
+    )
+
+
 @lru_cache()
 def get_training_loss_service():
     training_loss_repo = MongoDBTrainingLossRepository()
@@ -59,3 +83,17 @@ def get_llm_manager():
 @lru_cache()
 def get_corpus_entry_repository():
     return MongoDBCorpusEntryRepository()
+
+
+@lru_cache()
+def get_chat_worker() -> ModelWorker:
+    # 开启 batch 解码时，多个线程同时把请求交给调度器才能凑成 batch
+    num_threads = settings.CHAT_MAX_BATCH_SIZE if settings.CHAT_BATCHING_ENABLED else 1
+    return ModelWorker(
+        "chat", max_queue_size=settings.CHAT_QUEUE_SIZE, num_threads=num_threads
+    )
+
+
+@lru_cache()
+def get_training_worker() -> ModelWorker:
+    return ModelWorker("training", max_queue_size=settings.TRAINING_QUEUE_SIZE)
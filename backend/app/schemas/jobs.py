@@ -0,0 +1,57 @@
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from datetime import datetime
+from domain.training_job import TrainingJob
+
+
+class TrainingJobCreate(BaseModel):
+    job_type: str = Field(
+        ...,
+        description=(
+            "'smelt_new_corpus', 'smelt_new_old', 'smelt_token_corpus' "
+            "or 'train_single_entry'"
+        ),
+    )
+    rounds: int = Field(1, description="Number of training rounds to run back to back")
+    batch_size: int = 16
+    entry_id: Optional[str] = Field(
+        None, description="Corpus entry to train on for 'train_single_entry' jobs"
+    )
+
+
+class TrainingJobResponse(BaseModel):
+    id: str
+    job_type: str
+    session_id: str
+    rounds: int
+    batch_size: int
+    entry_id: Optional[str] = None
+    status: str
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    rounds_completed: int
+    progress: dict
+    results: List[dict]
+    error: Optional[str] = None
+    cancel_requested: bool
+
+    @classmethod
+    def from_domain(cls, job: TrainingJob):
+        return cls(
+            id=job.id,
+            job_type=job.job_type,
+            session_id=job.session_id,
+            rounds=job.rounds,
+            batch_size=job.batch_size,
+            entry_id=job.entry_id,
+            status=job.status,
+            created_at=job.created_at,
+            started_at=job.started_at,
+            finished_at=job.finished_at,
+            rounds_completed=job.rounds_completed,
+            progress=dict(job.progress),
+            results=list(job.results),
+            error=job.error,
+            cancel_requested=job.cancel_requested,
+        )
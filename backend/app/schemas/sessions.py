@@ -1,13 +1,24 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional
 from datetime import datetime
 
 from domain.training_session import TrainingSession
 
 
+class LoraOptions(BaseModel):
+    rank: Optional[int] = Field(None, description="LoRA rank (r)")
+    alpha: Optional[int] = None
+    dropout: Optional[float] = None
+    target_modules: Optional[List[str]] = None
+
+
 class TrainingSessionCreate(BaseModel):
     name: str
     base_model: str
+    training_mode: str = Field(
+        "full", description="'full' fine-tunes all weights, 'lora' trains adapters only"
+    )
+    lora: Optional[LoraOptions] = None
 
 
 class TrainingSessionResponse(BaseModel):
@@ -18,7 +29,10 @@ class TrainingSessionResponse(BaseModel):
     last_trained: datetime
     last_trained: Optional[datetime] = None
     tokens_trained: int = 0
+    rounds_trained: int = 0
     metrics: dict
+    training_mode: str = "full"
+    lora_config: dict = {}
 
     @classmethod
     def from_domain(cls, session: TrainingSession):
@@ -29,5 +43,25 @@ class TrainingSessionResponse(BaseModel):
             start_time=session.start_time,
             last_trained=session.last_trained,
             tokens_trained=session.tokens_trained,
+            rounds_trained=session.rounds_trained,
             metrics=session.metrics,
+            training_mode=session.training_mode,
+            lora_config=session.lora_config,
         )
+
+
+class SpeculativeConfigUpdate(BaseModel):
+    mode: str = Field(
+        ..., description="Speculative decoding mode: 'off', 'draft' or 'prompt_lookup'"
+    )
+    draft_model: Optional[str] = Field(
+        None, description="Path or name of the draft model for 'draft' mode"
+    )
+    num_speculative_tokens: int = 10
+
+
+class SpeculativeConfigResponse(BaseModel):
+    mode: str
+    draft_model: Optional[str] = None
+    num_speculative_tokens: int
+    stats: dict
@@ -0,0 +1,51 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List, Optional
+
+JOB_TYPES = [
+    "smelt_new_corpus",
+    "smelt_new_old",
+    "smelt_token_corpus",
+    "train_single_entry",
+]
+# 可以在上一轮训练时预先抽取语料的任务类型
+PREPARABLE_JOB_TYPES = ["smelt_new_corpus", "smelt_new_old"]
+FINISHED_STATUSES = ["completed", "failed", "cancelled"]
+
+
+@dataclass
+class TrainingJob:
+    """后台训练任务：在一个会话上连续执行 rounds 轮训练。"""
+
+    id: str
+    # 'smelt_new_corpus', 'smelt_new_old', 'smelt_token_corpus' or 'train_single_entry'
+    job_type: str
+    session_id: str
+    rounds: int = 1
+    batch_size: int = 16
+    entry_id: Optional[str] = None  # 仅 train_single_entry 使用
+    status: str = "queued"  # queued, running, completed, failed, cancelled
+    created_at: datetime = field(default_factory=datetime.now)
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    rounds_completed: int = 0
+    # 当前一轮的进度：step、total_steps、loss、tokens、tokens_per_sec
+    progress: dict = field(default_factory=dict)
+    # 每一轮的训练结果
+    results: List[dict] = field(default_factory=list)
+    error: Optional[str] = None
+    cancel_requested: bool = False
+    # 每次状态变化加一，订阅进度时用来判断是否有更新
+    version: int = 0
+
+    def __post_init__(self):
+        if self.job_type not in JOB_TYPES:
+            raise ValueError(f"Invalid job type. Must be one of {JOB_TYPES}")
+        if self.rounds < 1:
+            raise ValueError("rounds must be at least 1")
+        if self.job_type == "train_single_entry" and not self.entry_id:
+            raise ValueError("entry_id is required for train_single_entry jobs")
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
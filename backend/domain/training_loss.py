@@ -11,6 +11,8 @@ class TrainingLoss:
     timestamp: datetime
     loss_value: float
     loss_rank: str
+    # 只经过评估、没有训练过的语料为 False，不影响新语料的统计和抽取
+    trained: bool = True
 
     def __post_init__(self):
         if not isinstance(self.timestamp, datetime):
@@ -13,6 +13,13 @@ class TrainingSession:
     last_trained: datetime
     metrics: dict = field(default_factory=dict)
     tokens_trained: int = 0
+    rounds_trained: int = 0
+    training_mode: str = "full"  # 'full' or 'lora'
+    lora_config: dict = field(default_factory=dict)  # 仅 lora 模式使用
+
+    def __post_init__(self):
+        if self.training_mode not in ["full", "lora"]:
+            raise ValueError("Invalid training mode. Must be 'full' or 'lora'")
 
     def update_metrics(self, new_metrics: dict):
         self.metrics.update(new_metrics)
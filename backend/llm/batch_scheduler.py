@@ -0,0 +1,301 @@
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import ExitStack, nullcontext
+from dataclasses import dataclass, field
+from typing import Callable, ContextManager, List, Optional, Set
+import torch
+import torch.nn.functional as F
+from transformers import (
+    DynamicCache,
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+
+@dataclass
+class GenerationRequest:
+    input_ids: torch.Tensor  # 1D
+    max_new_tokens: int
+    streamer: Optional[object] = None
+    future: Future = field(default_factory=Future)
+    generated: List[int] = field(default_factory=list)
+
+
+class BatchScheduler:
+    """把并发的对话请求合并成一个 batch 一起解码。
+
+    后台线程在每一步解码之间接纳新请求：新请求先单独预填充，再把它的 cache
+    左侧补齐后拼进当前 batch；生成结束（遇到 eos 或达到 max_new_tokens）的请求
+    在步与步之间离开 batch，其余请求继续解码。
+
+    acquire_model 每一步调用一次，返回一个提供模型的上下文管理器，由调用方
+    决定是否需要加锁。它返回的模型换成了另一个对象（如重建的量化模型）时，
+    进行中的请求继续用原来的模型生成完，新请求等它们结束后再用新模型。
+    pin_model(model) 在 batch 开始时调用，返回的上下文管理器保持到 batch 结束，
+    防止模型在步与步之间被改写（如推理快照的发布）。
+    """
+
+    def __init__(
+        self,
+        acquire_model: Callable[[], ContextManager],
+        tokenizer,
+        max_batch_size: int = 8,
+        temperature: float = 0.9,
+        top_p: float = 0.85,
+        top_k: int = 50,
+        pin_model: Optional[Callable[[object], ContextManager]] = None,
+    ):
+        self.acquire_model = acquire_model
+        self.pin_model = pin_model or (lambda model: nullcontext())
+        self.tokenizer = tokenizer
+        self.model = None
+        self.max_batch_size = max_batch_size
+        self.logits_warper = LogitsProcessorList(
+            [
+                TemperatureLogitsWarper(temperature),
+                TopKLogitsWarper(top_k),
+                TopPLogitsWarper(top_p),
+            ]
+        )
+        with acquire_model() as model:
+            self.eos_token_ids = self._get_eos_token_ids(model)
+
+        # batch 状态，_batch_model 是当前 batch 的 cache 所对应的模型
+        self._active: List[GenerationRequest] = []
+        self._batch_model = None
+        self._batch_pin = ExitStack()
+        self._cache: Optional[DynamicCache] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        self._positions: Optional[torch.Tensor] = None
+        self._next_tokens: Optional[torch.Tensor] = None
+
+        self._pending: "queue.Queue[Optional[GenerationRequest]]" = queue.Queue()
+        # 已从队列取出、还没有进入 batch 的请求
+        self._waiting: List[Optional[GenerationRequest]] = []
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(
+        self, input_ids: torch.Tensor, max_new_tokens: int, streamer=None
+    ) -> Future:
+        if self._stopped:
+            raise RuntimeError("Batch scheduler has been stopped")
+        request = GenerationRequest(
+            input_ids=input_ids.detach().cpu(),
+            max_new_tokens=max_new_tokens,
+            streamer=streamer,
+        )
+        self._pending.put(request)
+        return request.future
+
+    def generate(
+        self, input_ids: torch.Tensor, max_new_tokens: int, streamer=None
+    ) -> List[int]:
+        """阻塞直到该请求生成完毕，返回新生成的 token id。"""
+        return self.submit(input_ids, max_new_tokens, streamer).result()
+
+    def stop(self):
+        self._stopped = True
+        self._pending.put(None)
+        self._thread.join()
+
+    def _get_eos_token_ids(self, model) -> Set[int]:
+        eos_token_ids = {self.tokenizer.eos_token_id}
+        generation_eos = getattr(model.generation_config, "eos_token_id", None)
+        if isinstance(generation_eos, int):
+            eos_token_ids.add(generation_eos)
+        elif generation_eos:
+            eos_token_ids.update(generation_eos)
+        eos_token_ids.discard(None)
+        return eos_token_ids
+
+    def _run(self):
+        while True:
+            # 没有进行中的请求时阻塞等待，否则只取已经到达的请求
+            try:
+                if not self._active and not self._waiting:
+                    self._waiting.append(self._pending.get())
+                while len(self._waiting) < self.max_batch_size:
+                    self._waiting.append(self._pending.get_nowait())
+            except queue.Empty:
+                pass
+
+            if any(request is None for request in self._waiting):
+                self._fail_all(RuntimeError("Batch scheduler has been stopped"))
+                return
+
+            try:
+                with self.acquire_model() as model, torch.no_grad():
+                    if self._active and model is not self._batch_model:
+                        # 模型换了，先用原来的模型把进行中的请求生成完
+                        self.model = self._batch_model
+                    else:
+                        if not self._active and self._waiting:
+                            self._batch_pin.enter_context(self.pin_model(model))
+                        self.model = self._batch_model = model
+                        while self._waiting and len(self._active) < self.max_batch_size:
+                            self._admit(self._waiting[0])
+                            self._waiting.pop(0)
+                    self._retire_finished()
+                    if self._active:
+                        self._decode_step()
+            except Exception as e:
+                self._fail_all(e)
+            finally:
+                self.model = None
+
+    def _admit(self, request: GenerationRequest):
+        """单独预填充新请求，并把它合并进当前 batch。"""
+        device = self.model.device
+        input_ids = request.input_ids.unsqueeze(0).to(device)
+        cache = DynamicCache()
+        outputs = self.model(input_ids=input_ids, past_key_values=cache, use_cache=True)
+        next_token = self._sample(outputs.logits[:, -1, :])
+
+        if request.streamer is not None:
+            request.streamer.put(request.input_ids)
+
+        attention_mask = torch.ones_like(input_ids)
+        positions = torch.tensor([input_ids.shape[1]], device=device)
+
+        if not self._active:
+            self._cache = cache
+            self._attention_mask = attention_mask
+            self._positions = positions
+            self._next_tokens = next_token
+        else:
+            batch_length = self._attention_mask.shape[1]
+            new_length = attention_mask.shape[1]
+            target_length = max(batch_length, new_length)
+            batch_layers = _left_pad_cache(
+                self._cache, target_length - batch_length
+            ).to_legacy_cache()
+            new_layers = _left_pad_cache(cache, target_length - new_length).to_legacy_cache()
+            self._cache = DynamicCache.from_legacy_cache(
+                tuple(
+                    (
+                        torch.cat([batch_k, new_k], dim=0),
+                        torch.cat([batch_v, new_v], dim=0),
+                    )
+                    for (batch_k, batch_v), (new_k, new_v) in zip(
+                        batch_layers, new_layers
+                    )
+                )
+            )
+            self._attention_mask = torch.cat(
+                [
+                    F.pad(self._attention_mask, (target_length - batch_length, 0)),
+                    F.pad(attention_mask, (target_length - new_length, 0)),
+                ],
+                dim=0,
+            )
+            self._positions = torch.cat([self._positions, positions])
+            self._next_tokens = torch.cat([self._next_tokens, next_token])
+
+        self._active.append(request)
+        self._emit(len(self._active) - 1)
+
+    def _decode_step(self):
+        """把每一行上一步采样出的 token 喂给模型，采样下一个 token。"""
+        self._attention_mask = F.pad(self._attention_mask, (0, 1), value=1)
+        outputs = self.model(
+            input_ids=self._next_tokens.unsqueeze(1),
+            attention_mask=self._attention_mask,
+            position_ids=self._positions.unsqueeze(1),
+            past_key_values=self._cache,
+            use_cache=True,
+        )
+        self._positions = self._positions + 1
+        self._next_tokens = self._sample(outputs.logits[:, -1, :])
+        for row in range(len(self._active)):
+            self._emit(row)
+        self._retire_finished()
+
+    def _sample(self, logits: torch.Tensor) -> torch.Tensor:
+        scores = self.logits_warper(None, logits.float())
+        probs = torch.softmax(scores, dim=-1)
+        return torch.multinomial(probs, num_samples=1).squeeze(1)
+
+    def _emit(self, row: int):
+        request = self._active[row]
+        token = int(self._next_tokens[row])
+        if token in self.eos_token_ids:
+            return
+        request.generated.append(token)
+        if request.streamer is not None:
+            request.streamer.put(torch.tensor([token]))
+
+    def _is_finished(self, row: int) -> bool:
+        request = self._active[row]
+        return (
+            int(self._next_tokens[row]) in self.eos_token_ids
+            or len(request.generated) >= request.max_new_tokens
+        )
+
+    def _retire_finished(self):
+        finished = [row for row in range(len(self._active)) if self._is_finished(row)]
+        if not finished:
+            return
+        for row in finished:
+            request = self._active[row]
+            if request.streamer is not None:
+                request.streamer.end()
+            request.future.set_result(request.generated)
+
+        keep = [row for row in range(len(self._active)) if row not in finished]
+        self._active = [self._active[row] for row in keep]
+        if not self._active:
+            self._reset_batch()
+            return
+
+        indices = torch.tensor(keep, device=self._attention_mask.device)
+        self._cache.batch_select_indices(indices)
+        self._attention_mask = self._attention_mask[indices]
+        self._positions = self._positions[indices]
+        self._next_tokens = self._next_tokens[indices]
+
+        # 去掉所有行都只是补齐的左侧列
+        padding = int((self._attention_mask.sum(dim=0) == 0).long().cumprod(0).sum())
+        if padding:
+            self._attention_mask = self._attention_mask[:, padding:]
+            self._cache = DynamicCache.from_legacy_cache(
+                tuple(
+                    (k[:, :, padding:, :], v[:, :, padding:, :])
+                    for k, v in self._cache.to_legacy_cache()
+                )
+            )
+
+    def _reset_batch(self):
+        self._active = []
+        self._batch_model = None
+        self._batch_pin.close()
+        self._cache = None
+        self._attention_mask = None
+        self._positions = None
+        self._next_tokens = None
+
+    def _fail_all(self, error: Exception):
+        # 预填充失败的请求可能同时在两个列表中
+        requests = {id(r): r for r in self._active + self._waiting if r is not None}
+        for request in requests.values():
+            if request.streamer is not None:
+                request.streamer.end()
+            if not request.future.done():
+                request.future.set_exception(error)
+        self._waiting = []
+        self._reset_batch()
+
+
+def _left_pad_cache(cache: DynamicCache, pad: int) -> DynamicCache:
+    if pad == 0:
+        return cache
+    return DynamicCache.from_legacy_cache(
+        tuple(
+            (F.pad(k, (0, 0, pad, 0)), F.pad(v, (0, 0, pad, 0)))
+            for k, v in cache.to_legacy_cache()
+        )
+    )
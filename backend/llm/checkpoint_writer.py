@@ -0,0 +1,274 @@
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import torch
+from huggingface_hub import split_torch_state_dict_into_shards
+from safetensors.torch import save_file
+
+LATEST_FILE = "LATEST"
+CHECKPOINTS_DIR = "checkpoints"
+MANIFEST_FILE = "manifest.json"
+
+
+@dataclass
+class CheckpointSnapshot:
+    """写一个检查点需要的全部内容，权重和优化器状态都已经复制到 CPU，
+    写入期间训练可以继续修改模型。"""
+
+    # 权重文件名（不含扩展名），全量模型为 model，lora 为 adapter_model
+    weights_name: str
+    weights: Dict[str, torch.Tensor]
+    # 写入配置和分词器文件
+    save_config: Callable[[str], None]
+    # 用 torch.save 保存的其他文件，如优化器和学习率调度器的状态
+    objects: Dict[str, Any] = field(default_factory=dict)
+    # None 时权重保存为一个文件
+    max_shard_size: Optional[str] = "5GB"
+
+
+def latest_checkpoint(model_dir: str) -> str:
+    """会话目录中最新的完整检查点；没有 LATEST 时是旧的目录结构，直接返回 model_dir。"""
+    latest_path = os.path.join(model_dir, LATEST_FILE)
+    if not os.path.isfile(latest_path):
+        return model_dir
+    with open(latest_path) as f:
+        name = f.read().strip()
+    return os.path.join(model_dir, CHECKPOINTS_DIR, name)
+
+
+def snapshot_state_dict(model) -> Dict[str, torch.Tensor]:
+    """模型权重在 CPU 上的副本。
+
+    共享存储的张量（如绑定的 embedding 和 lm_head）只保留一份，去掉的名字与
+    save_pretrained 一致，加载时由 from_pretrained 重新绑定。
+    """
+    state_dict = model.state_dict()
+    tied_keys = set(getattr(model, "_tied_weights_keys", None) or [])
+    groups: Dict[tuple, List[str]] = {}
+    for name, tensor in state_dict.items():
+        key = (tensor.device, tensor.untyped_storage().data_ptr())
+        groups.setdefault(key, []).append(name)
+    dropped = set()
+    for names in groups.values():
+        if len(names) > 1:
+            kept = [name for name in names if name not in tied_keys] or names[:1]
+            dropped.update(name for name in names if name != kept[0])
+    return {
+        name: cpu_copy(tensor)
+        for name, tensor in state_dict.items()
+        if name not in dropped
+    }
+
+
+def cpu_copy(value):
+    """把张量（可以嵌套在 dict、list 中）复制到 CPU，与原来的张量不共享内存。"""
+    if torch.is_tensor(value):
+        return value.detach().to("cpu", copy=True).contiguous()
+    if isinstance(value, dict):
+        return {key: cpu_copy(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(cpu_copy(item) for item in value)
+    return value
+
+
+class CheckpointWriter:
+    """在后台线程中把 CheckpointSnapshot 写成会话目录下的检查点。
+
+    每个检查点先写到 checkpoints/ 下的临时目录，完整写入后重命名，再原子地更新
+    LATEST 指向它，进程中途退出不会留下写了一半的检查点。内容与上一个检查点
+    相同的权重分片直接硬链接，不再重新写入。只保留最近 keep 个检查点。
+
+    每个会话最多只有一个等待写入的快照：还没开始写时又提交了新的快照，用新的
+    替换旧的，两次提交共用一个 Future，写入跟不上时内存中不会堆积快照。
+    """
+
+    def __init__(self, keep: int = 3):
+        self.keep = max(1, keep)
+        # 只有一个线程，同一会话的检查点按提交顺序写入
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="checkpoint-writer"
+        )
+        self._pending: Dict[str, List[Future]] = {}
+        # 每个会话等待写入的快照 {model_dir: (快照, Future)}
+        self._queued: Dict[str, Tuple[CheckpointSnapshot, Future]] = {}
+        self._lock = Lock()
+
+    def submit(self, model_dir: str, snapshot: CheckpointSnapshot) -> Future:
+        with self._lock:
+            queued = self._queued.get(model_dir)
+            if queued is not None:
+                future = queued[1]
+                self._queued[model_dir] = (snapshot, future)
+                return future
+            future = Future()
+            self._queued[model_dir] = (snapshot, future)
+            self._pending.setdefault(model_dir, []).append(future)
+        future.add_done_callback(lambda f: self._forget(model_dir, f))
+        self._executor.submit(self._write_queued, model_dir)
+        return future
+
+    def wait(self, model_dir: Optional[str] = None):
+        """等待 model_dir（不指定时为全部会话）已提交的检查点写完。"""
+        with self._lock:
+            if model_dir is None:
+                futures = [f for fs in self._pending.values() for f in fs]
+            else:
+                futures = list(self._pending.get(model_dir, []))
+        for future in futures:
+            future.result()
+
+    def write(self, model_dir: str, snapshot: CheckpointSnapshot) -> str:
+        """同步写入一个检查点，返回检查点目录。"""
+        checkpoints_dir = os.path.join(model_dir, CHECKPOINTS_DIR)
+        os.makedirs(checkpoints_dir, exist_ok=True)
+        name = f"checkpoint-{datetime.now():%Y%m%d-%H%M%S-%f}"
+        tmp_dir = os.path.join(checkpoints_dir, f".tmp-{name}")
+        os.makedirs(tmp_dir)
+
+        previous_dir = latest_checkpoint(model_dir)
+        previous_manifest = _read_manifest(previous_dir)
+        shards, index = _shards(snapshot)
+        manifest = {}
+        reused = 0
+        for filename, tensors in shards.items():
+            digest = _digest(tensors)
+            manifest[filename] = digest
+            path = os.path.join(tmp_dir, filename)
+            previous_path = os.path.join(previous_dir, filename)
+            if previous_manifest.get(filename) == digest and os.path.exists(
+                previous_path
+            ):
+                _link_or_copy(previous_path, path)
+                reused += 1
+            else:
+                save_file(tensors, path, metadata={"format": "pt"})
+        if index is not None:
+            index_path = os.path.join(
+                tmp_dir, f"{snapshot.weights_name}.safetensors.index.json"
+            )
+            with open(index_path, "w") as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+        snapshot.save_config(tmp_dir)
+        for filename, value in snapshot.objects.items():
+            torch.save(value, os.path.join(tmp_dir, filename))
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f)
+
+        for filename in os.listdir(tmp_dir):
+            _fsync(os.path.join(tmp_dir, filename))
+        checkpoint_dir = os.path.join(checkpoints_dir, name)
+        os.rename(tmp_dir, checkpoint_dir)
+        _fsync_dir(checkpoints_dir)
+        _write_latest(model_dir, name)
+        print(
+            f"Checkpoint {checkpoint_dir} written, "
+            f"{reused}/{len(manifest)} weight files unchanged"
+        )
+        self._prune(checkpoints_dir, name)
+        return checkpoint_dir
+
+    def _write_queued(self, model_dir: str):
+        with self._lock:
+            snapshot, future = self._queued.pop(model_dir)
+        future.set_result(self._write_logged(model_dir, snapshot))
+
+    def _write_logged(self, model_dir: str, snapshot: CheckpointSnapshot):
+        try:
+            return self.write(model_dir, snapshot)
+        except Exception as e:
+            # LATEST 仍然指向上一个完整的检查点
+            print(f"Writing checkpoint for {model_dir} failed: {e}")
+            return None
+
+    def _forget(self, model_dir: str, future: Future):
+        with self._lock:
+            futures = self._pending.get(model_dir, [])
+            if future in futures:
+                futures.remove(future)
+            if not futures:
+                self._pending.pop(model_dir, None)
+
+    def _prune(self, checkpoints_dir: str, latest_name: str):
+        names = sorted(os.listdir(checkpoints_dir))
+        finished = [name for name in names if not name.startswith(".")]
+        for name in finished[: max(0, len(finished) - self.keep)]:
+            if name != latest_name:
+                shutil.rmtree(os.path.join(checkpoints_dir, name), ignore_errors=True)
+        # 只有一个写入线程，其他临时目录都是之前中途退出留下的
+        for name in names:
+            if name.startswith(".tmp-"):
+                shutil.rmtree(os.path.join(checkpoints_dir, name), ignore_errors=True)
+
+
+def _shards(snapshot: CheckpointSnapshot):
+    """按 save_pretrained 的命名把权重分片，返回 {文件名: 张量} 和分片时的索引。"""
+    if snapshot.max_shard_size is None:
+        return {f"{snapshot.weights_name}.safetensors": snapshot.weights}, None
+    split = split_torch_state_dict_into_shards(
+        snapshot.weights,
+        filename_pattern=snapshot.weights_name + "{suffix}.safetensors",
+        max_shard_size=snapshot.max_shard_size,
+    )
+    shards = {
+        filename: {name: snapshot.weights[name] for name in names}
+        for filename, names in split.filename_to_tensors.items()
+    }
+    if not split.is_sharded:
+        return shards, None
+    return shards, {"metadata": split.metadata, "weight_map": split.tensor_to_filename}
+
+
+def _digest(tensors: Dict[str, torch.Tensor]) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(tensors):
+        tensor = tensors[name]
+        digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        digest.update(tensor.reshape(-1).view(torch.uint8).numpy().data)
+    return digest.hexdigest()
+
+
+def _read_manifest(checkpoint_dir: str) -> Dict[str, str]:
+    path = os.path.join(checkpoint_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _link_or_copy(source: str, target: str):
+    try:
+        os.link(source, target)
+    except OSError:
+        # 文件系统不支持硬链接
+        shutil.copyfile(source, target)
+
+
+def _write_latest(model_dir: str, name: str):
+    tmp_path = os.path.join(model_dir, f".{LATEST_FILE}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(model_dir, LATEST_FILE))
+    _fsync_dir(model_dir)
+
+
+def _fsync(path: str):
+    if os.path.isdir(path):
+        return
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,50 @@
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class GenerationParams:
+    """对话生成参数。"""
+
+    max_new_tokens: int = 2048
+    do_sample: bool = True
+    # Temperature (温度)
+    # 温度参数控制生成过程中的随机性。
+    # 较低的温度（例如 0.7）会让模型更“保守”，即更倾向于选择概率更高的下一个词，从而生成更确定性的输出；
+    # 较高的温度（例如 1.5）会增加随机性，使模型更愿意选择那些概率相对较低的词，从而生成更多样化和出乎意料的输出。
+    temperature: float = 0.9
+    # Top-p (核采样)
+    # 这个参数会在模型生成时考虑概率累积达到 p 值的词集合。
+    # 例如，top_p=0.95 意味着只考虑那些使得概率总和达到 95% 的词，而忽略剩下的低概率词。
+    # 这种方法可以动态地调整被考虑的词数量，确保模型生成的内容在合理范围内又不失随机性。
+    # top_p 像是在生成时只考虑“最有可能的一群词”，而不是所有可能的词，从而保持生成的合理性和多样性之间的平衡。
+    top_p: float = 0.85
+    # Top-k (最高 k 采样)
+    # 在生成过程中，只从概率最高的前 k 个词中进行采样。
+    # 设置 top_k=50，意味着模型只会从最可能的前 50 个词中选择下一个词。这种方法能有效地减少生成中引入的随机性，确保输出的连贯性。
+    # top_k 就像是在生成时限制“视野”，只看最可能的几个词，忽略那些可能性极低的词，从而使生成更加稳妥。
+    top_k: int = 50
+    # 固定随机种子后，采样结果可以复现
+    seed: Optional[int] = None
+
+    @property
+    def is_deterministic(self) -> bool:
+        return not self.do_sample or self.seed is not None
+
+    def uses_default_sampling(self) -> bool:
+        default = GenerationParams(max_new_tokens=self.max_new_tokens)
+        return self == default
+
+    def to_generate_kwargs(self) -> dict:
+        if not self.do_sample:
+            return {"max_new_tokens": self.max_new_tokens, "do_sample": False}
+        return {
+            "max_new_tokens": self.max_new_tokens,
+            "do_sample": True,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "top_k": self.top_k,
+        }
+
+    def to_dict(self) -> dict:
+        return asdict(self)
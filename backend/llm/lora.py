@@ -0,0 +1,76 @@
+import copy
+import os
+from typing import Optional
+import torch
+from peft import LoraConfig, PeftConfig, PeftModel, get_peft_model_state_dict
+from peft.tuners.lora import LoraLayer
+
+ADAPTER_CONFIG_FILE = "adapter_config.json"
+DEFAULT_TARGET_MODULES = [
+    "q_proj",
+    "k_proj",
+    "v_proj",
+    "o_proj",
+    "gate_proj",
+    "up_proj",
+    "down_proj",
+]
+
+
+def build_lora_config(options: dict, base_model: str) -> LoraConfig:
+    """根据会话的 lora_config 创建 peft 的 LoraConfig，未指定的参数使用默认值。"""
+    return LoraConfig(
+        task_type="CAUSAL_LM",
+        # 保存在 adapter_config.json 中，加载会话时据此找到基础模型
+        base_model_name_or_path=base_model,
+        r=options.get("rank", 16),
+        lora_alpha=options.get("alpha", 32),
+        lora_dropout=options.get("dropout", 0.05),
+        target_modules=options.get("target_modules") or DEFAULT_TARGET_MODULES,
+    )
+
+
+def is_adapter_checkpoint(model_dir: str) -> bool:
+    return os.path.exists(os.path.join(model_dir, ADAPTER_CONFIG_FILE))
+
+
+def adapter_base_model(model_dir: str) -> str:
+    """adapter 检查点对应的基础模型路径。"""
+    return PeftConfig.from_pretrained(model_dir).base_model_name_or_path
+
+
+def adapter_state_dict(model: PeftModel, adapter_name: str):
+    """一个 adapter 的权重在 CPU 上的副本，键名与 adapter_model.safetensors 一致。"""
+    state_dict = get_peft_model_state_dict(model, adapter_name=adapter_name)
+    return {
+        key: value.detach().to("cpu", copy=True).contiguous()
+        for key, value in state_dict.items()
+    }
+
+
+def merged_copy(model, adapter_name: Optional[str] = None):
+    """返回合并了 adapter 的普通模型副本，不影响原模型；全量模型直接复制。"""
+    model_copy = copy.deepcopy(model)
+    if isinstance(model_copy, PeftModel):
+        if adapter_name is not None:
+            model_copy.set_adapter(adapter_name)
+        model_copy = model_copy.merge_and_unload(
+            adapter_names=[model_copy.active_adapter]
+        )
+    return model_copy
+
+
+def refresh_merged_copy(merged_model, model: PeftModel, adapter_name: str):
+    """把 adapter 的最新权重合并进 merged_copy 得到的副本。
+
+    基础模型的权重是冻结的，只需要重新计算带 lora 的那些层，不必再复制整个模型。
+    """
+    merged_modules = dict(merged_model.named_modules())
+    with torch.no_grad():
+        for name, module in model.base_model.model.named_modules():
+            if isinstance(module, LoraLayer) and adapter_name in module.lora_A:
+                target = merged_modules[name]
+                weight = module.get_base_layer().weight + module.get_delta_weight(
+                    adapter_name
+                )
+                target.weight.copy_(weight.to(target.weight.dtype))
@@ -0,0 +1,321 @@
+import glob
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+import torch
+
+CHECKPOINT_PATTERNS = ["*.safetensors", "*.bin"]
+
+
+@dataclass
+class RegisteredModel:
+    """注册表中某个会话的模型，以及由它派生出的对话用副本。"""
+
+    session_name: str
+    model_dir: str
+    model: object
+    tokenizer: object
+    # lora 模式下 model 是同一基础模型上所有会话共用的 PeftModel，
+    # adapter_name 是本会话的 adapter
+    adapter_name: Optional[str] = None
+    base_model: Optional[str] = None
+    # 训练之后尚未保存到 model_dir，淘汰前需要先保存
+    dirty: bool = False
+    # 每训练一轮加一，检查点写完时用来判断之后是否又训练过
+    revision: int = 0
+    quantized_model: Optional[object] = None
+    inference_snapshot: Optional[object] = None
+    # lora 模式下对话使用的、合并了 adapter 的副本
+    merged_model: Optional[object] = None
+    # 训练时才创建，在多轮训练之间复用
+    optimizer: Optional[torch.optim.Optimizer] = None
+    lr_scheduler: Optional[object] = None
+    # 按本会话分词器缓存的分词结果
+    token_cache: Optional[object] = None
+    last_used: float = field(default_factory=time.time)
+
+    @property
+    def device(self) -> str:
+        return _module_device(self.model)
+
+    def device_bytes(self, include_model: bool = True) -> int:
+        """占用 self.device 上的内存（快照与模型在同一设备上）。
+
+        共用基础模型的会话只有其中一个计入模型本身（include_model）。
+        """
+        model_bytes = module_num_bytes(self.model)
+        num_bytes = model_bytes if include_model else 0
+        if self.inference_snapshot is not None:
+            num_bytes += 2 * model_bytes
+        if self.merged_model is not None:
+            num_bytes += module_num_bytes(self.merged_model)
+        if self.optimizer is not None:
+            num_bytes += optimizer_num_bytes(self.optimizer)
+        if self.device == "cpu" and self.quantized_model is not None:
+            num_bytes += module_num_bytes(self.quantized_model)
+        return num_bytes
+
+    def host_bytes(self, include_model: bool = True) -> int:
+        """占用的内存（RAM）。"""
+        if self.device == "cpu":
+            return self.device_bytes(include_model)
+        if self.quantized_model is not None:
+            return module_num_bytes(self.quantized_model)
+        return 0
+
+
+class ModelRegistry:
+    """按会话保存多个已加载的模型，在显存和内存预算内按 LRU 淘汰。
+
+    当前使用的模型放在 device 上；显存超出预算时，最久未使用的模型被卸载到
+    CPU，内存也超出预算时再把它从注册表中移除（有未保存的训练结果时先调用
+    save_model 保存）。当前使用的模型不会被卸载或移除。
+
+    注册表本身不加锁保护模型的使用，调用方需要保证切换模型时没有训练或解码
+    正在使用被卸载的模型。
+    """
+
+    def __init__(
+        self,
+        device: str,
+        device_budget_bytes: int,
+        host_budget_bytes: int,
+        save_model: Callable[[RegisteredModel], None],
+    ):
+        self.device = device
+        self.device_budget_bytes = device_budget_bytes
+        self.host_budget_bytes = host_budget_bytes
+        self.save_model = save_model
+        self._entries: "OrderedDict[str, RegisteredModel]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, session_name: str) -> Optional[RegisteredModel]:
+        with self._lock:
+            return self._entries.get(session_name)
+
+    def reserve(self, model_dir: str, protected: Optional[str] = None):
+        """在加载 model_dir 之前，按检查点大小提前腾出空间。"""
+        num_bytes = checkpoint_num_bytes(model_dir)
+        with self._lock:
+            self._enforce_budget(protected, extra_bytes=num_bytes)
+
+    def register(
+        self,
+        session_name: str,
+        model_dir: str,
+        model,
+        tokenizer,
+        adapter_name: Optional[str] = None,
+        base_model: Optional[str] = None,
+    ) -> RegisteredModel:
+        with self._lock:
+            old_entry = self._entries.pop(session_name, None)
+            if old_entry is not None:
+                print(f"Replacing registered model for session {session_name}")
+            entry = RegisteredModel(
+                session_name,
+                model_dir,
+                model,
+                tokenizer,
+                adapter_name=adapter_name,
+                base_model=base_model,
+            )
+            self._entries[session_name] = entry
+            self._enforce_budget(session_name)
+            return entry
+
+    def activate(self, session_name: str) -> RegisteredModel:
+        """把会话的模型放到 device 上并标记为最近使用。"""
+        with self._lock:
+            entry = self._entries[session_name]
+            if entry.device != self.device:
+                print(f"Moving model of session {session_name} to {self.device}")
+                self._enforce_budget(
+                    session_name, extra_bytes=module_num_bytes(entry.model)
+                )
+                entry.model.to(self.device)
+                _move_optimizer_state(entry.optimizer, self.device)
+            self._touch(entry)
+            self._enforce_budget(session_name)
+            return entry
+
+    def find_lora_base(self, base_model: str):
+        """已加载的、可以再加入一个 adapter 的基础模型（PeftModel）。"""
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.adapter_name is not None and entry.base_model == base_model:
+                    return entry.model
+            return None
+
+    def trim(self, protected: Optional[str] = None):
+        """派生的对话副本建好之后重新检查预算。"""
+        with self._lock:
+            self._enforce_budget(protected)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "device": self.device,
+                "device_budget_bytes": self.device_budget_bytes,
+                "host_budget_bytes": self.host_budget_bytes,
+                "device_bytes": self._device_bytes(),
+                "host_bytes": self._host_bytes(),
+                "models": [
+                    {
+                        "session_name": entry.session_name,
+                        "adapter_name": entry.adapter_name,
+                        "base_model": entry.base_model,
+                        "device": entry.device,
+                        "dirty": entry.dirty,
+                        "device_bytes": entry.device_bytes(),
+                        "host_bytes": entry.host_bytes(),
+                        "last_used": entry.last_used,
+                    }
+                    for entry in reversed(self._entries.values())
+                ],
+            }
+
+    def _touch(self, entry: RegisteredModel):
+        entry.last_used = time.time()
+        self._entries.move_to_end(entry.session_name)
+
+    def _device_bytes(self) -> int:
+        if self.device == "cpu":
+            return 0
+        return sum(
+            entry.device_bytes(include_model)
+            for entry, include_model in self._accounted_entries()
+            if entry.device == self.device
+        )
+
+    def _host_bytes(self) -> int:
+        return sum(
+            entry.host_bytes(include_model)
+            for entry, include_model in self._accounted_entries()
+        )
+
+    def _accounted_entries(self):
+        # 共用的基础模型只计算一次
+        seen_models = set()
+        for entry in self._entries.values():
+            yield entry, id(entry.model) not in seen_models
+            seen_models.add(id(entry.model))
+
+    def _sharing(self, model) -> List[RegisteredModel]:
+        return [entry for entry in self._entries.values() if entry.model is model]
+
+    def _lru(self, protected: Optional[str], device: str) -> List[RegisteredModel]:
+        protected_entry = self._entries.get(protected) if protected else None
+        protected_model = protected_entry.model if protected_entry else None
+        return [
+            entry
+            for entry in self._entries.values()
+            if entry.session_name != protected
+            and entry.model is not protected_model
+            and entry.device == device
+        ]
+
+    def _enforce_budget(self, protected: Optional[str], extra_bytes: int = 0):
+        if self.device != "cpu":
+            for entry in self._lru(protected, self.device):
+                if self._device_bytes() + extra_bytes <= self.device_budget_bytes:
+                    break
+                if entry.device == self.device:
+                    self._offload(entry)
+            host_extra_bytes = 0
+        else:
+            host_extra_bytes = extra_bytes
+
+        for entry in self._lru(protected, "cpu"):
+            if self._host_bytes() + host_extra_bytes <= self.host_budget_bytes:
+                break
+            self._evict(entry)
+
+    def _offload(self, entry: RegisteredModel):
+        print(f"Offloading model of session {entry.session_name} to cpu")
+        # 共用基础模型的会话一起卸载；对话用的副本在重新激活时再创建
+        for sharing_entry in self._sharing(entry.model):
+            sharing_entry.inference_snapshot = None
+            sharing_entry.merged_model = None
+            _move_optimizer_state(sharing_entry.optimizer, "cpu")
+        entry.model.to("cpu")
+        _empty_device_cache(self.device)
+
+    def _evict(self, entry: RegisteredModel):
+        if entry.dirty:
+            print(f"Saving model of session {entry.session_name} before eviction")
+            self.save_model(entry)
+            entry.dirty = False
+        print(f"Evicting model of session {entry.session_name}")
+        del self._entries[entry.session_name]
+        self._release(entry)
+
+    def _release(self, entry: RegisteredModel):
+        if entry.adapter_name is not None and self._sharing(entry.model):
+            # 基础模型还有其他会话在用，只删除本会话的 adapter
+            entry.model.delete_adapter(entry.adapter_name)
+        entry.model = None
+        entry.merged_model = None
+        entry.quantized_model = None
+        entry.inference_snapshot = None
+        entry.optimizer = None
+        entry.lr_scheduler = None
+        _empty_device_cache(self.device)
+
+
+def module_num_bytes(module) -> int:
+    """模块所有参数和 buffer 占用的字节数，也适用于动态量化后的模块。"""
+    return sum(_tensor_bytes(value) for value in module.state_dict().values())
+
+
+def optimizer_num_bytes(optimizer: torch.optim.Optimizer) -> int:
+    return sum(
+        _tensor_bytes(value)
+        for state in optimizer.state.values()
+        for value in state.values()
+    )
+
+
+def checkpoint_num_bytes(model_dir: str) -> int:
+    """model_dir 中权重文件的总大小，作为加载后占用内存的估计；不是本地目录时返回 0。"""
+    if not os.path.isdir(model_dir):
+        return 0
+    num_bytes = 0
+    for pattern in CHECKPOINT_PATTERNS:
+        files = glob.glob(os.path.join(model_dir, pattern))
+        if files:
+            num_bytes = sum(os.path.getsize(path) for path in files)
+            break
+    return num_bytes
+
+
+def _tensor_bytes(value) -> int:
+    if torch.is_tensor(value):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_bytes(item) for item in value)
+    return 0
+
+
+def _move_optimizer_state(optimizer: Optional[torch.optim.Optimizer], device: str):
+    if optimizer is None:
+        return
+    for state in optimizer.state.values():
+        for key, value in state.items():
+            # Adam 的 step 计数保存在 CPU 上，不需要移动
+            if torch.is_tensor(value) and value.dim() > 0:
+                state[key] = value.to(device)
+
+
+def _module_device(module) -> str:
+    for tensor in module.parameters():
+        return tensor.device.type
+    return "cpu"
+
+
+def _empty_device_cache(device: str):
+    if device == "cuda":
+        torch.cuda.empty_cache()
@@ -0,0 +1,118 @@
+import random
+from typing import List, Optional
+import torch
+from torch.utils.data import Dataset
+from transformers.trainer_pt_utils import LabelSmoother
+
+IGNORE_TOKEN_ID = LabelSmoother.ignore_index
+
+
+def pack_sequences(lengths: List[int], max_length: int) -> List[List[int]]:
+    """把序列装进长度不超过 max_length 的块里（first-fit decreasing）。
+
+    返回每个块包含的序列下标。序列不会被拆开，超过 max_length 的序列单独成块。
+    """
+    blocks: List[List[int]] = []
+    block_lengths: List[int] = []
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        length = lengths[index]
+        for block, block_length in enumerate(block_lengths):
+            if block_length + length <= max_length:
+                blocks[block].append(index)
+                block_lengths[block] += length
+                break
+        else:
+            blocks.append([index])
+            block_lengths.append(length)
+    return blocks
+
+
+def window_starts(length: int, max_length: Optional[int], overlap: int) -> List[int]:
+    """长度为 length 的序列按 max_length 切成相互重叠 overlap 个 token 的窗口时，
+    每个窗口的起始位置。"""
+    if max_length is None or length <= max_length:
+        return [0]
+    starts = [0]
+    while starts[-1] + max_length < length:
+        starts.append(starts[-1] + max_length - overlap)
+    return starts
+
+
+class PackedDataset(Dataset):
+    """把 DynamicHeartEchoDataset 的多条语料拼接成一个训练块。
+
+    块内每条语料的 position_ids 从 0 重新开始，只能注意到同一条语料里之前的
+    token；每条语料第一个 token 的 label 被屏蔽，不会用上一条语料去预测它。
+    entry_index 记录每个 token 属于哪条语料，用于按语料计算损失。
+    """
+
+    def __init__(self, dataset: Dataset, max_length: int, shuffle: bool = True):
+        self.items = [dataset[i] for i in range(len(dataset))]
+        self.blocks = pack_sequences(
+            [len(item["input_ids"]) for item in self.items], max_length
+        )
+        if shuffle:
+            random.shuffle(self.blocks)
+            for block in self.blocks:
+                random.shuffle(block)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, idx):
+        input_ids, position_ids, labels, entry_index = [], [], [], []
+        for item_index in self.blocks[idx]:
+            item = self.items[item_index]
+            length = len(item["input_ids"])
+            item_labels = item["labels"].clone()
+            item_labels[0] = IGNORE_TOKEN_ID
+            input_ids.append(item["input_ids"])
+            position_ids.append(torch.arange(length))
+            labels.append(item_labels)
+            entry_index.append(torch.full((length,), item["entry_index"]))
+
+        return {
+            "input_ids": torch.cat(input_ids),
+            "position_ids": torch.cat(position_ids),
+            "labels": torch.cat(labels),
+            "entry_index": torch.cat(entry_index),
+        }
+
+
+def collate_packed(batch):
+    max_length = max(len(item["input_ids"]) for item in batch)
+
+    input_ids = torch.zeros((len(batch), max_length), dtype=torch.long)
+    position_ids = torch.zeros((len(batch), max_length), dtype=torch.long)
+    labels = torch.full((len(batch), max_length), IGNORE_TOKEN_ID, dtype=torch.long)
+    entry_index = torch.full((len(batch), max_length), -1, dtype=torch.long)
+
+    for i, item in enumerate(batch):
+        length = len(item["input_ids"])
+        input_ids[i, :length] = item["input_ids"]
+        position_ids[i, :length] = item["position_ids"]
+        labels[i, :length] = item["labels"]
+        entry_index[i, :length] = item["entry_index"]
+
+    return {
+        "input_ids": input_ids,
+        "attention_mask": block_causal_mask(entry_index),
+        "position_ids": position_ids,
+        "labels": labels,
+        "entry_index": entry_index,
+    }
+
+
+def block_causal_mask(entry_index: torch.Tensor) -> torch.Tensor:
+    """按语料分块的因果 mask，形状为 (batch, 1, seq, seq)，True 表示可以注意。"""
+    same_entry = entry_index[:, :, None] == entry_index[:, None, :]
+    length = entry_index.size(1)
+    causal = torch.ones(length, length, dtype=torch.bool).tril()
+    valid = (entry_index >= 0)[:, :, None]
+    return (same_entry & causal & valid).unsqueeze(1)
+
+
+def to_additive_mask(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """把布尔 mask 转换成模型直接使用的 4D 加性 mask。"""
+    additive = torch.zeros(mask.shape, dtype=dtype, device=mask.device)
+    return additive.masked_fill(~mask, torch.finfo(dtype).min)
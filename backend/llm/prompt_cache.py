@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Optional, Tuple
+import torch
+from transformers import DynamicCache
+from utils.id_generator import IdGenerator
+
+
+@dataclass
+class PromptCacheEntry:
+    """一段对话已经计算过的 key/value，以及它对应的 token 序列。"""
+
+    session_name: str
+    token_ids: torch.Tensor  # 1D, 位于 CPU
+    past_key_values: DynamicCache
+
+    @property
+    def num_bytes(self) -> int:
+        return sum(
+            t.numel() * t.element_size()
+            for t in self.past_key_values.key_cache + self.past_key_values.value_cache
+        )
+
+
+class PromptCache:
+    """多轮对话的 KV 前缀缓存。
+
+    每条缓存对应一段对话。新请求到来时，找出与其 token 序列公共前缀最长的
+    缓存条目，把它取出并裁剪到公共前缀，只需预填充剩下的新 token。生成结束后
+    再把整段对话的 cache 放回。按 LRU 顺序淘汰，同时受条目数和显存/内存预算约束。
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, PromptCacheEntry]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        # 每次 clear 加一；在 clear 之前开始的生成不应再把 cache 放回
+        self.generation = 0
+
+    def take(
+        self, session_name: str, input_ids: torch.Tensor
+    ) -> Tuple[Optional[DynamicCache], int]:
+        """取出与 input_ids 公共前缀最长的 cache，并裁剪到该前缀。
+
+        返回 (cache, 复用的 token 数)。至少保留最后一个 token 不在 cache 中，
+        这样模型仍能为它计算 logits。被取出的条目会从缓存中移除，调用方在
+        生成结束后应通过 put 放回。
+        """
+        input_ids = input_ids.detach().cpu()
+        with self._lock:
+            best_key, best_len = None, 0
+            for key, entry in self._entries.items():
+                if entry.session_name != session_name:
+                    continue
+                prefix_len = _common_prefix_length(entry.token_ids, input_ids)
+                if prefix_len > best_len:
+                    best_key, best_len = key, prefix_len
+
+            best_len = min(best_len, len(input_ids) - 1)
+            if best_key is None or best_len <= 0:
+                self.misses += 1
+                return None, 0
+
+            entry = self._entries.pop(best_key)
+            self.hits += 1
+            self.reused_tokens += best_len
+
+        entry.past_key_values.crop(best_len)
+        return entry.past_key_values, best_len
+
+    def put(
+        self,
+        session_name: str,
+        token_ids: torch.Tensor,
+        past_key_values: DynamicCache,
+        generation: Optional[int] = None,
+    ):
+        seq_length = past_key_values.get_seq_length()
+        if seq_length == 0:
+            return
+        entry = PromptCacheEntry(
+            session_name=session_name,
+            token_ids=token_ids.detach().cpu()[:seq_length],
+            past_key_values=past_key_values,
+        )
+        if entry.num_bytes > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[IdGenerator.generate()] = entry
+            self._evict()
+
+    def clear(self):
+        """模型权重变化后，已缓存的 key/value 全部失效。"""
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(e.num_bytes for e in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "reused_tokens": self.reused_tokens,
+            }
+
+    def _evict(self):
+        total_bytes = sum(e.num_bytes for e in self._entries.values())
+        while self._entries and (
+            len(self._entries) > self.max_entries or total_bytes > self.max_bytes
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            total_bytes -= evicted.num_bytes
+
+
+def _common_prefix_length(a: torch.Tensor, b: torch.Tensor) -> int:
+    length = min(len(a), len(b))
+    if length == 0:
+        return 0
+    mismatch = (a[:length] != b[:length]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else length
@@ -0,0 +1,95 @@
+import hashlib
+import json
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from typing import Callable, Dict
+from llm.generation import GenerationParams
+
+
+class ResponseCache:
+    """对话回复的 LRU 缓存，并合并正在进行中的相同请求。
+
+    键由模板化后的对话历史、会话名、模型版本和生成参数计算得到。只有确定性
+    的请求（不采样，或指定了随机种子）会使用缓存：结果被缓存，相同的请求如果
+    正在生成中，后到的请求直接等待同一次生成的结果。其他请求每次都单独生成，
+    同时重新生成同一段对话也会得到不同的采样结果。
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(
+        text: str, session_name: str, model_version: int, params: GenerationParams
+    ) -> str:
+        payload = json.dumps(
+            {
+                "text": text,
+                "session": session_name,
+                "model_version": model_version,
+                "params": params.to_dict(),
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get_or_compute(
+        self, key: str, compute: Callable[[], str], cacheable: bool
+    ) -> str:
+        if not cacheable:
+            return compute()
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                owner = True
+                in_flight = self._in_flight[key] = Future()
+                self.misses += 1
+            else:
+                owner = False
+                self.coalesced += 1
+
+        if not owner:
+            return in_flight.result()
+
+        try:
+            response = compute()
+        except BaseException as e:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            in_flight.set_exception(e)
+            raise
+
+        with self._lock:
+            self._entries[key] = response
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._in_flight.pop(key, None)
+        in_flight.set_result(response)
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "in_flight": len(self._in_flight),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+            }
@@ -0,0 +1,81 @@
+import copy
+import threading
+from contextlib import contextmanager
+import torch
+
+
+class InferenceSnapshot:
+    """对话用的双缓冲模型快照。
+
+    持有训练模型的两份 eval 模式副本：对话总是在前台副本上运行，发布时把
+    训练模型的权重复制到后台副本，再原子地交换前后台。这样对话看到的始终是
+    某次发布时完整一致的权重，而不会看到训练到一半的权重，也不需要等待训练。
+    """
+
+    def __init__(self, model):
+        self._buffers = [self._copy_for_inference(model) for _ in range(2)]
+        self._readers = [0, 0]
+        self._front = 0
+        self._condition = threading.Condition()
+        self.version = 0
+
+    @contextmanager
+    def acquire(self):
+        with self._condition:
+            index = self._front
+            self._readers[index] += 1
+        try:
+            yield self._buffers[index]
+        finally:
+            self._release([index])
+
+    @contextmanager
+    def pin(self, model):
+        """在 acquire 取得 model 期间调用，退出 acquire 之后 model 所在的副本仍然
+        不会被发布覆盖，直到退出 pin。model 不是这里的副本时什么也不做。"""
+        with self._condition:
+            indices = [i for i, buffer in enumerate(self._buffers) if buffer is model]
+            for index in indices:
+                self._readers[index] += 1
+        try:
+            yield
+        finally:
+            self._release(indices)
+
+    def _release(self, indices):
+        with self._condition:
+            for index in indices:
+                self._readers[index] -= 1
+            self._condition.notify_all()
+
+    def publish(self, source_model, wait: bool = False) -> bool:
+        """把 source_model 的当前权重发布给对话。
+
+        后台副本可能还被上一次交换前开始的对话占用；wait=False 时直接放弃这次
+        发布并返回 False，wait=True 时等待这些对话结束。
+        """
+        with self._condition:
+            back = 1 - self._front
+            if self._readers[back] and not wait:
+                return False
+            self._condition.wait_for(lambda: self._readers[back] == 0)
+
+        # 新的读者只会拿到前台副本，可以在锁外复制权重（只允许一个发布者）
+        with torch.no_grad():
+            target = self._buffers[back]
+            for dst, src in zip(target.parameters(), source_model.parameters()):
+                dst.copy_(src)
+            for dst, src in zip(target.buffers(), source_model.buffers()):
+                dst.copy_(src)
+
+        with self._condition:
+            self._front = back
+            self.version += 1
+        return True
+
+    @staticmethod
+    def _copy_for_inference(model):
+        model_copy = copy.deepcopy(model)
+        model_copy.eval()
+        model_copy.requires_grad_(False)
+        return model_copy
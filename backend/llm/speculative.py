@@ -0,0 +1,113 @@
+import copy
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+
+SPECULATIVE_MODES = ["off", "draft", "prompt_lookup"]
+
+
+@dataclass
+class SpeculativeConfig:
+    """某个会话的投机解码设置。
+
+    - draft: 用一个小的草稿模型（与会话模型共用 tokenizer）提出候选 token
+    - prompt_lookup: 不需要草稿模型，从对话历史中查找 n-gram 作为候选
+    """
+
+    mode: str = "off"
+    draft_model: Optional[str] = None
+    num_speculative_tokens: int = 10
+
+    def __post_init__(self):
+        if self.mode not in SPECULATIVE_MODES:
+            raise ValueError(
+                f"Invalid speculative mode: {self.mode}. Must be one of {SPECULATIVE_MODES}"
+            )
+        if self.mode == "draft" and not self.draft_model:
+            raise ValueError("draft_model is required for draft speculative mode")
+        if self.num_speculative_tokens < 1:
+            raise ValueError("num_speculative_tokens must be positive")
+
+
+@dataclass
+class SpeculativeStats:
+    """累计的投机解码统计。
+
+    目标模型每次前向会验证一批候选 token，并产出 (接受数 + 1) 个 token，
+    因此接受的候选数 = 生成的 token 数 - 目标模型前向次数。草稿模型每次
+    前向提出一个候选，可据此计算接受率；prompt lookup 模式下候选数不可观测。
+    """
+
+    requests: int = 0
+    generated_tokens: int = 0
+    target_forwards: int = 0
+    draft_forwards: int = 0
+
+    def record(self, generated_tokens: int, target_forwards: int, draft_forwards: int):
+        self.requests += 1
+        self.generated_tokens += generated_tokens
+        self.target_forwards += target_forwards
+        self.draft_forwards += draft_forwards
+
+    def to_dict(self) -> dict:
+        accepted = max(0, self.generated_tokens - self.target_forwards)
+        return {
+            "requests": self.requests,
+            "generated_tokens": self.generated_tokens,
+            "target_forwards": self.target_forwards,
+            "draft_forwards": self.draft_forwards,
+            "accepted_tokens": accepted,
+            "tokens_per_target_forward": (
+                self.generated_tokens / self.target_forwards
+                if self.target_forwards
+                else None
+            ),
+            "acceptance_rate": (
+                min(1.0, accepted / self.draft_forwards) if self.draft_forwards else None
+            ),
+        }
+
+
+@contextmanager
+def count_forwards(*models) -> Iterator[List[int]]:
+    """统计 with 块内当前线程对每个模型的前向调用次数。
+
+    模型在并发的对话之间共用，其他线程的前向不计入。
+    """
+    counts = [0] * len(models)
+    thread_id = threading.get_ident()
+    handles = []
+    for i, model in enumerate(models):
+        if model is None:
+            continue
+
+        def hook(module, args, output, i=i):
+            if threading.get_ident() == thread_id:
+                counts[i] += 1
+
+        handles.append(model.register_forward_hook(hook))
+    try:
+        yield counts
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+def build_generate_kwargs(config: SpeculativeConfig, draft_model=None) -> Dict:
+    """把投机解码设置转换成 model.generate 的参数。
+
+    generate 从草稿模型的 generation_config 读取候选 token 数，并在生成过程中
+    改写它。这里给本次调用一个共用参数的浅拷贝，带有自己的 generation_config，
+    不修改共用的草稿模型。
+    """
+    if config.mode == "prompt_lookup":
+        return {"prompt_lookup_num_tokens": config.num_speculative_tokens}
+    if config.mode == "draft":
+        assistant_model = copy.copy(draft_model)
+        assistant_model.generation_config = copy.deepcopy(draft_model.generation_config)
+        assistant_model.generation_config.num_assistant_tokens = (
+            config.num_speculative_tokens
+        )
+        return {"assistant_model": assistant_model}
+    return {}
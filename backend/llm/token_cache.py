@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Dict, List
+import numpy as np
+import torch
+from domain.corpus import CorpusEntry
+
+
+def tokenizer_fingerprint(tokenizer, template: str) -> str:
+    """分词器和对话模板的指纹，任何一个变化都会得到不同的分词结果。"""
+    digest = hashlib.sha256()
+    digest.update(type(tokenizer).__name__.encode())
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        # fast tokenizer 的完整定义：词表、合并规则、normalizer 和 post-processor
+        digest.update(backend.to_str().encode())
+    else:
+        digest.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode())
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode())
+    digest.update(template.encode())
+    return digest.hexdigest()
+
+
+class TokenCache:
+    """按语料的 sha256 和分词器指纹缓存分词结果。
+
+    结果保存在本地的 sqlite 文件中，重启后仍然有效；最近用过的结果同时保存在
+    内存里。没有缓存的语料用 tokenize 分词，一次批量写入数据库。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fingerprint: str,
+        tokenize: Callable[[CorpusEntry], List[int]],
+        max_memory_entries: int = 4096,
+    ):
+        self.fingerprint = fingerprint
+        self.tokenize = tokenize
+        self.max_memory_entries = max_memory_entries
+        self._memory: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._lock = Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tokens ("
+            "fingerprint TEXT NOT NULL, sha256 TEXT NOT NULL, "
+            "token_ids BLOB NOT NULL, PRIMARY KEY (fingerprint, sha256))"
+        )
+        self._db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, entries: List[CorpusEntry]) -> List[torch.Tensor]:
+        """每条语料的 token id，顺序与 entries 一致。"""
+        with self._lock:
+            found: Dict[str, torch.Tensor] = {}
+            for entry in entries:
+                token_ids = self._memory.get(entry.sha256)
+                if token_ids is not None:
+                    self._memory.move_to_end(entry.sha256)
+                    found[entry.sha256] = token_ids
+            found.update(
+                self._load([e.sha256 for e in entries if e.sha256 not in found])
+            )
+
+            missing = {e.sha256: e for e in entries if e.sha256 not in found}
+            self.hits += len(entries) - len(missing)
+            self.misses += len(missing)
+            if missing:
+                tokenized = {
+                    sha256: torch.tensor(self.tokenize(entry), dtype=torch.long)
+                    for sha256, entry in missing.items()
+                }
+                self._store(tokenized)
+                found.update(tokenized)
+
+            for sha256, token_ids in found.items():
+                self._remember(sha256, token_ids)
+            return [found[entry.sha256] for entry in entries]
+
+    def count_tokens(self, entries: List[CorpusEntry]) -> List[int]:
+        return [len(token_ids) for token_ids in self.get_many(entries)]
+
+    def warm(self, entries: List[CorpusEntry]) -> int:
+        """预先分词并写入数据库，返回新分词的语料数。"""
+        misses = self.misses
+        self.get_many(entries)
+        return self.misses - misses
+
+    def stats(self) -> dict:
+        with self._lock:
+            (stored,) = self._db.execute(
+                "SELECT COUNT(*) FROM tokens WHERE fingerprint = ?", (self.fingerprint,)
+            ).fetchone()
+            return {
+                "fingerprint": self.fingerprint,
+                "stored_entries": stored,
+                "memory_entries": len(self._memory),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _load(self, sha256s: List[str]) -> Dict[str, torch.Tensor]:
+        loaded = {}
+        # sqlite 对一条语句的参数个数有限制，分批查询
+        for i in range(0, len(sha256s), 500):
+            chunk = sha256s[i : i + 500]
+            rows = self._db.execute(
+                "SELECT sha256, token_ids FROM tokens WHERE fingerprint = ? "
+                f"AND sha256 IN ({','.join('?' * len(chunk))})",
+                [self.fingerprint, *chunk],
+            )
+            for sha256, blob in rows:
+                loaded[sha256] = _from_blob(blob)
+        return loaded
+
+    def _store(self, tokenized: Dict[str, torch.Tensor]):
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO tokens (fingerprint, sha256, token_ids) "
+                "VALUES (?, ?, ?)",
+                [
+                    (self.fingerprint, sha256, _to_blob(token_ids))
+                    for sha256, token_ids in tokenized.items()
+                ],
+            )
+
+    def _remember(self, sha256: str, token_ids: torch.Tensor):
+        self._memory[sha256] = token_ids
+        self._memory.move_to_end(sha256)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+
+def _to_blob(token_ids: torch.Tensor) -> bytes:
+    # 词表大小远小于 2^31，按 int32 保存
+    return token_ids.numpy().astype(np.int32).tobytes()
+
+
+def _from_blob(blob: bytes) -> torch.Tensor:
+    return torch.from_numpy(np.frombuffer(blob, dtype=np.int32).astype(np.int64))
@@ -0,0 +1,242 @@
+import json
+import os
+import shutil
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from domain.corpus import CorpusEntry
+from llm.packing import IGNORE_TOKEN_ID, window_starts
+
+TOKENS_FILE = "tokens.bin"
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.json"
+# 记录当前版本子目录名的文件，整体替换，读取方总是看到一个完整的版本
+CURRENT_FILE = "CURRENT"
+# 保留的版本数，已经打开旧版本的读取方（如 DataLoader 的 worker）还可以继续读
+KEEP_GENERATIONS = 2
+# 每条语料的元数据，定长字符串数组，可以按 mmap 方式打开
+ENTRY_FIELDS = {"ids": "id", "corpora": "corpus", "sha256s": "sha256"}
+
+
+class TokenCorpusWriter:
+    """把语料的 token id 依次追加到一个扁平的 int32 文件中。
+
+    每次导出写到 path 下的一个新版本子目录，写完后原子地更新 CURRENT 指向它，
+    读取方不会看到写了一半的文件，已经打开的 TokenCorpus 继续读原来的版本。
+    offsets 记录每条语料在 token 文件中的起止位置。
+    """
+
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.generation = f"v-{datetime.now():%Y%m%d-%H%M%S-%f}"
+        self._tmp_path = os.path.join(path, f".tmp-{self.generation}")
+        os.makedirs(self._tmp_path)
+        self._tokens = open(os.path.join(self._tmp_path, TOKENS_FILE), "wb")
+        self._offsets = [0]
+        self._fields = {name: [] for name in ENTRY_FIELDS}
+
+    def add(self, entries: List[CorpusEntry], token_ids: List[torch.Tensor]):
+        for entry, ids in zip(entries, token_ids):
+            # 词表大小远小于 2^31，按 int32 保存
+            self._tokens.write(np.asarray(ids, dtype=np.int32).tobytes())
+            self._offsets.append(self._offsets[-1] + len(ids))
+            for name, attr in ENTRY_FIELDS.items():
+                self._fields[name].append(getattr(entry, attr))
+
+    def close(self) -> dict:
+        self._tokens.close()
+        np.save(
+            os.path.join(self._tmp_path, OFFSETS_FILE),
+            np.array(self._offsets, dtype=np.int64),
+        )
+        for name, values in self._fields.items():
+            np.save(
+                os.path.join(self._tmp_path, f"{name}.npy"),
+                np.array(values, dtype=str),
+            )
+        meta = {
+            "fingerprint": self.fingerprint,
+            "generation": self.generation,
+            "num_entries": len(self._offsets) - 1,
+            "num_tokens": self._offsets[-1],
+            "created_at": datetime.now().isoformat(),
+        }
+        with open(os.path.join(self._tmp_path, META_FILE), "w") as f:
+            json.dump(meta, f)
+
+        os.rename(self._tmp_path, os.path.join(self.path, self.generation))
+        tmp_current = os.path.join(self.path, f".{CURRENT_FILE}.tmp")
+        with open(tmp_current, "w") as f:
+            f.write(self.generation)
+        os.replace(tmp_current, os.path.join(self.path, CURRENT_FILE))
+        self._prune()
+        return meta
+
+    def _prune(self):
+        names = sorted(os.listdir(self.path))
+        generations = [name for name in names if name.startswith("v-")]
+        for name in generations[:-KEEP_GENERATIONS]:
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        # 导出在同一个工作线程中依次进行，其他临时目录都是之前中途退出留下的
+        for name in names:
+            if name.startswith(".tmp-"):
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+
+class TokenCorpus:
+    """只读打开 TokenCorpusWriter 写出的目录。
+
+    打开时读取 CURRENT 确定版本，之后只读这个版本的文件，重新导出不影响已经
+    打开的对象。token、offsets 和元数据都按需以 mmap 方式打开，不把语料读进
+    Python 对象。序列化时不带打开的 mmap，传给 DataLoader 的 worker 进程后在
+    各自进程里重新打开同一个版本，多个进程共享操作系统的页缓存。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, CURRENT_FILE)) as f:
+            self.generation = f.read().strip()
+        self._dir = os.path.join(path, self.generation)
+        with open(os.path.join(self._dir, META_FILE)) as f:
+            self.meta = json.load(f)
+        self._arrays = {}
+
+    @property
+    def fingerprint(self) -> str:
+        return self.meta["fingerprint"]
+
+    def __len__(self):
+        return self.meta["num_entries"]
+
+    @property
+    def tokens(self) -> np.ndarray:
+        if "tokens" not in self._arrays:
+            if self.meta["num_tokens"] == 0:
+                # 空文件不能 mmap
+                self._arrays["tokens"] = np.zeros(0, dtype=np.int32)
+            else:
+                self._arrays["tokens"] = np.memmap(
+                    os.path.join(self._dir, TOKENS_FILE),
+                    dtype=np.int32,
+                    mode="r",
+                    shape=(self.meta["num_tokens"],),
+                )
+        return self._arrays["tokens"]
+
+    @property
+    def offsets(self) -> np.ndarray:
+        return self._load("offsets")
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def token_ids(self, index: int) -> np.ndarray:
+        """第 index 条语料的 token id，是 mmap 上的视图，没有复制。"""
+        offsets = self.offsets
+        return self.tokens[offsets[index] : offsets[index + 1]]
+
+    def entry_id(self, index: int) -> str:
+        return str(self._load("ids")[index])
+
+    def entry_corpus(self, index: int) -> str:
+        return str(self._load("corpora")[index])
+
+    def entry_sha256(self, index: int) -> str:
+        return str(self._load("sha256s")[index])
+
+    def _load(self, name: str) -> np.ndarray:
+        if name not in self._arrays:
+            self._arrays[name] = np.load(
+                os.path.join(self._dir, f"{name}.npy"), mmap_mode="r"
+            )
+        return self._arrays[name]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+
+class TokenCorpusDataset(Dataset):
+    """从 TokenCorpus 读取样本的数据集，样本格式与 DynamicHeartEchoDataset 相同。
+
+    长语料按 max_length 切成重叠 overlap 个 token 的窗口，sample_entries 记录每个
+    样本属于哪条语料。__getitem__ 只复制当前窗口的 token。
+    指定 indices 时只包含这些语料，语料下标是在 indices 中的位置。
+    """
+
+    def __init__(
+        self,
+        corpus: TokenCorpus,
+        max_length: Optional[int] = None,
+        overlap: int = 0,
+        indices: Optional[Sequence[int]] = None,
+    ):
+        if max_length is not None and not 0 <= overlap < max_length:
+            raise ValueError("overlap must be smaller than max_length")
+        self.corpus = corpus
+        self.max_length = max_length
+        self.overlap = overlap
+        if indices is None:
+            self.indices = np.arange(len(corpus))
+        else:
+            self.indices = np.asarray(indices, dtype=np.int64)
+
+        lengths = self._lengths()
+        counts = np.ones(len(lengths), dtype=np.int64)
+        long_entries = (
+            np.nonzero(lengths > max_length)[0] if max_length is not None else []
+        )
+        extra_starts = {}
+        for idx in long_entries:
+            extra_starts[idx] = window_starts(int(lengths[idx]), max_length, overlap)
+            counts[idx] = len(extra_starts[idx])
+        # 每个样本的语料下标和窗口起始位置
+        self._sample_entries = np.repeat(np.arange(len(lengths)), counts)
+        self._sample_starts = np.zeros(len(self._sample_entries), dtype=np.int64)
+        first_samples = np.cumsum(counts) - counts
+        for idx, starts in extra_starts.items():
+            first = first_samples[idx]
+            self._sample_starts[first : first + len(starts)] = starts
+
+    @property
+    def sample_entries(self) -> List[int]:
+        return self._sample_entries.tolist()
+
+    @property
+    def samples(self) -> List[Tuple[int, int]]:
+        """(语料下标, 窗口起始位置)，与 DynamicHeartEchoDataset.samples 相同。"""
+        return list(zip(self.sample_entries, self._sample_starts.tolist()))
+
+    def entry_ids(self) -> List[str]:
+        return [self.corpus.entry_id(int(idx)) for idx in self.indices]
+
+    def entry_lengths(self) -> List[int]:
+        return self._lengths().tolist()
+
+    def _lengths(self) -> np.ndarray:
+        return self.corpus.lengths()[self.indices]
+
+    def __len__(self):
+        return len(self._sample_entries)
+
+    def __getitem__(self, idx):
+        entry_idx = int(self._sample_entries[idx])
+        start = int(self._sample_starts[idx])
+        window = self.corpus.token_ids(int(self.indices[entry_idx]))
+        end = start + self.max_length if self.max_length else len(window)
+        input_ids = torch.from_numpy(window[start:end].astype(np.int64))
+        labels = input_ids.clone()
+        if start > 0:
+            # 与上一个窗口重叠的部分已经计算过损失
+            labels[: self.overlap] = IGNORE_TOKEN_ID
+
+        return {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "labels": labels,
+            "entry_index": idx,
+        }
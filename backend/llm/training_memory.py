@@ -0,0 +1,52 @@
+import resource
+from contextlib import contextmanager, nullcontext
+import torch
+
+MEMORY_MODES = ["default", "lean"]
+
+
+@contextmanager
+def training_memory_mode(model, mode: str):
+    """训练期间使用的内存模式。
+
+    lean 模式开启激活检查点：前向时只保留每层的输入，反向时再重新计算层内的
+    激活，用大约多一次前向的时间换取与层数无关的激活内存。训练结束后关闭，
+    对话解码不受影响。
+    """
+    if mode not in MEMORY_MODES:
+        raise ValueError(f"Invalid training memory mode: {mode}")
+    if mode == "default":
+        yield
+        return
+
+    use_cache = model.config.use_cache
+    # 非 reentrant 的实现不要求输入带梯度，冻结了 embedding 的 lora 模型也可以使用
+    model.gradient_checkpointing_enable(
+        gradient_checkpointing_kwargs={"use_reentrant": False}
+    )
+    model.config.use_cache = False
+    try:
+        yield
+    finally:
+        model.gradient_checkpointing_disable()
+        model.config.use_cache = use_cache
+
+
+def autocast(device: str, mode: str):
+    """lean 模式下前向计算使用 bf16 autocast（CPU 和 CUDA 都支持），权重仍保持原精度。"""
+    if mode != "lean":
+        return nullcontext()
+    return torch.autocast(device_type=device, dtype=torch.bfloat16)
+
+
+def reset_peak_memory(device: str):
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_memory_mb(device: str) -> float:
+    """从上次 reset_peak_memory 以来的显存峰值；CPU 上是进程的内存峰值（无法重置）。"""
+    if device == "cuda":
+        return torch.cuda.max_memory_allocated() / 1024 / 1024
+    # Linux 上 ru_maxrss 的单位是 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
@@ -0,0 +1,28 @@
+import os
+import random
+from typing import Optional
+import torch
+
+# 与检查点一起保存的训练状态：计数器、随机数状态和还没有写入数据库的损失
+TRAINING_STATE_FILE = "training_state.pt"
+
+
+def capture_rng_state() -> dict:
+    state = {"python": random.getstate(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state: dict):
+    random.setstate(state["python"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def load_training_state(checkpoint_dir: str) -> Optional[dict]:
+    path = os.path.join(checkpoint_dir, TRAINING_STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, weights_only=True)
@@ -1,19 +1,103 @@
+import copy
 import os
 import random
-from typing import List
+import time
+from concurrent.futures import CancelledError, Future
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from threading import Lock, RLock, Thread
+from typing import Callable, Dict, Iterator, List, Optional
 import torch
-from torch.utils.data import Dataset, DataLoader
-from transformers import AutoModelForCausalLM, AutoTokenizer, Trainer, TrainingArguments
+from torch.utils.data import Dataset, DataLoader, Sampler
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    DynamicCache,
+    TextIteratorStreamer,
+    Trainer,
+    TrainingArguments,
+    get_constant_schedule_with_warmup,
+)
 from transformers.trainer_pt_utils import LabelSmoother
 from domain.corpus import CorpusEntry
 from domain.training_session import TrainingSession
+from peft import PeftModel, get_peft_model
+from llm.batch_scheduler import BatchScheduler
+from llm.checkpoint_writer import (
+    CheckpointSnapshot,
+    CheckpointWriter,
+    cpu_copy,
+    latest_checkpoint,
+    snapshot_state_dict,
+)
+from llm.generation import GenerationParams
+from llm.model_registry import ModelRegistry, RegisteredModel
+from llm.lora import (
+    adapter_base_model,
+    adapter_state_dict,
+    build_lora_config,
+    is_adapter_checkpoint,
+    merged_copy,
+    refresh_merged_copy,
+)
+from llm.packing import (
+    PackedDataset,
+    collate_packed,
+    to_additive_mask,
+    window_starts,
+)
+from llm.prompt_cache import PromptCache
+from llm.response_cache import ResponseCache
+from llm.snapshot import InferenceSnapshot
+from llm.token_cache import TokenCache, tokenizer_fingerprint
+from llm.token_corpus import TokenCorpus, TokenCorpusDataset
+from llm.training_state import (
+    TRAINING_STATE_FILE,
+    capture_rng_state,
+    load_training_state,
+)
+from llm.training_memory import (
+    autocast,
+    peak_memory_mb,
+    reset_peak_memory,
+    training_memory_mode,
+)
+from llm.speculative import (
+    SpeculativeConfig,
+    SpeculativeStats,
+    build_generate_kwargs,
+    count_forwards,
+)
 from models.training_loss import TrainingLoss
 from app.core.config import settings
 
 IGNORE_TOKEN_ID = LabelSmoother.ignore_index
+# 加载模型的各个阶段：读取权重、构建对话用的副本（量化模型或快照）、预热
+LOAD_STAGES = ["weights", "chat_model", "warmup"]
+# 训练时每学习这么多条数据执行一次优化器步骤
+ENTRIES_PER_OPTIMIZER_STEP = 16
+# 与模型一起保存在会话目录中的优化器和学习率调度器状态
+OPTIMIZER_STATE_FILE = "optimizer.pt"
+SCHEDULER_STATE_FILE = "scheduler.pt"
 TEMPLATE = "{% for message in messages %}{% if loop.first and messages[0]['role'] != 'system' %}{{ '<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n' }}{% endif %}{{'<|im_start|>' + message['role'] + '\n' + message['content']}}{% if loop.last %}{{ '<|im_end|>'}}{% else %}{{ '<|im_end|>\n' }}{% endif %}{% endfor %}"
 
 
+@dataclass
+class TrainingResult:
+    """一轮训练的结果。
+
+    loss 是按 token 数加权的平均损失；entry_losses 是训练到每条语料时前向计算
+    得到的平均 token 损失（{语料 id: 损失}），因内存不足被跳过的语料不在其中，
+    记录在 skipped_entry_ids。
+    """
+
+    loss: float
+    entry_losses: Dict[str, float] = field(default_factory=dict)
+    skipped_entry_ids: List[str] = field(default_factory=list)
+    # 在某次优化器步骤之后被 should_stop 中止，之后的语料没有训练
+    cancelled: bool = False
+
+
 class HeartEchoDataset(Dataset):
     def __init__(self, chats, knowledges, tokenizer, max_len):
         self.examples = []
@@ -47,255 +131,1259 @@ class HeartEchoDataset(Dataset):
 
 
 class DynamicHeartEchoDataset(Dataset):
-    def __init__(self, entries: List[CorpusEntry], tokenizer):
+    """训练和评估用的数据集，默认每条语料一个样本。
+
+    指定 max_length 时，超过 max_length 个 token 的语料被切成多个窗口，相邻窗口
+    重叠 overlap 个 token。重叠部分只作为上下文，label 被屏蔽，每个 token 只
+    计算一次损失。样本的 entry_index 是样本本身的下标，sample_entries 记录每个
+    样本属于哪条语料，用来把窗口的损失汇总回语料。
+    """
+
+    def __init__(
+        self,
+        entries: List[CorpusEntry],
+        tokenizer,
+        max_length: Optional[int] = None,
+        overlap: int = 0,
+        token_cache: Optional[TokenCache] = None,
+    ):
+        if max_length is not None and not 0 <= overlap < max_length:
+            raise ValueError("overlap must be smaller than max_length")
         self.entries = entries
         self.tokenizer = tokenizer
+        self.overlap = overlap
+        self.max_length = max_length
+        if token_cache is not None:
+            self.token_ids = token_cache.get_many(entries)
+        else:
+            self.token_ids = [
+                torch.tensor(tokenize_entry(tokenizer, entry), dtype=torch.long)
+                for entry in entries
+            ]
+        # (语料下标, 窗口起始位置)
+        self.samples = [
+            (idx, start)
+            for idx, ids in enumerate(self.token_ids)
+            for start in window_starts(len(ids), max_length, overlap)
+        ]
+
+    @property
+    def sample_entries(self) -> List[int]:
+        return [idx for idx, _ in self.samples]
+
+    def entry_lengths(self) -> List[int]:
+        return [len(ids) for ids in self.token_ids]
 
     def __len__(self):
-        return len(self.entries)
+        return len(self.samples)
 
     def __getitem__(self, idx):
-        entry = self.entries[idx]
-        if entry.entry_type == "chat":
-            text = self.tokenizer.apply_chat_template(
-                entry.messages,
-                tokenize=False,
-                add_generation_prompt=False,
-                chat_template=TEMPLATE,
-            )
-        else:  # knowledge
-            text = entry.content
-
-        encodings = self.tokenizer(
-            text,
-            truncation=True,
-            padding=False,
-            return_tensors="pt",
-        )
+        entry_idx, start = self.samples[idx]
+        end = start + self.max_length if self.max_length else None
+        input_ids = self.token_ids[entry_idx][start:end]
+        labels = input_ids.clone()
+        if start > 0:
+            # 与上一个窗口重叠的部分已经计算过损失
+            labels[: self.overlap] = IGNORE_TOKEN_ID
 
         # 修改：创建 attention_mask
-        attention_mask = torch.ones_like(encodings.input_ids[0])
+        attention_mask = torch.ones_like(input_ids)
 
         return {
-            "input_ids": encodings.input_ids[0],
+            "input_ids": input_ids,
             "attention_mask": attention_mask,
-            "labels": encodings.input_ids[0].clone(),
+            "labels": labels,
+            "entry_index": idx,
         }
 
 
+def tokenize_entry(tokenizer, entry: CorpusEntry) -> List[int]:
+    """语料的 token id：对话套用 TEMPLATE，知识直接分词，不截断。"""
+    if entry.entry_type == "chat":
+        text = tokenizer.apply_chat_template(
+            entry.messages,
+            tokenize=False,
+            add_generation_prompt=False,
+            chat_template=TEMPLATE,
+        )
+    elif entry.entry_type == "knowledge":
+        text = entry.content
+    else:
+        raise ValueError(f"Unknown entry type: {entry.entry_type}")
+    return tokenizer(text, padding=False)["input_ids"]
+
+
 def collate_fn(batch):
     max_length = max(len(item["input_ids"]) for item in batch)
 
-    input_ids = torch.full((len(batch), max_length), IGNORE_TOKEN_ID, dtype=torch.long)
+    # 补齐位置被 attention_mask 屏蔽，填 0 只是为了保证是合法的 token id
+    input_ids = torch.zeros((len(batch), max_length), dtype=torch.long)
     attention_mask = torch.zeros((len(batch), max_length), dtype=torch.long)
     labels = torch.full((len(batch), max_length), IGNORE_TOKEN_ID, dtype=torch.long)
+    entry_index = torch.full((len(batch), max_length), -1, dtype=torch.long)
 
     for i, item in enumerate(batch):
         input_len = len(item["input_ids"])
         input_ids[i, :input_len] = item["input_ids"]
         attention_mask[i, :input_len] = item["attention_mask"]
         labels[i, :input_len] = item["labels"]
+        entry_index[i, :input_len] = item["entry_index"]
 
     return {
         "input_ids": input_ids,
         "attention_mask": attention_mask,
         "labels": labels,
+        "entry_index": entry_index,
     }
 
 
+def per_entry_loss(
+    logits: torch.Tensor,
+    labels: torch.Tensor,
+    entry_index: torch.Tensor,
+    num_entries: int,
+):
+    """按 entry_index 把每个 token 的损失汇总到所属的语料上。
+
+    返回 (每条语料的损失之和, 每条语料参与计算的 token 数)，长度均为 num_entries。
+    一个 batch 里可以有多条语料（打包训练），也可以一条语料占一整行。
+    """
+    shift_logits = logits[:, :-1, :]
+    shift_labels = labels[:, 1:]
+    # 预测的是下一个 token，损失归属于被预测 token 所在的语料
+    shift_entries = entry_index[:, 1:]
+    token_losses = torch.nn.functional.cross_entropy(
+        shift_logits.reshape(-1, shift_logits.size(-1)).float(),
+        shift_labels.reshape(-1),
+        ignore_index=IGNORE_TOKEN_ID,
+        reduction="none",
+    )
+    valid = (shift_labels.reshape(-1) != IGNORE_TOKEN_ID) & (
+        shift_entries.reshape(-1) >= 0
+    )
+    entries = shift_entries.reshape(-1).clamp(min=0)
+    loss_sums = torch.zeros(num_entries, device=logits.device).index_add(
+        0, entries, token_losses * valid
+    )
+    counts = torch.zeros(num_entries, device=logits.device).index_add(
+        0, entries, valid.float()
+    )
+    return loss_sums, counts
+
+
+def length_bucketed_batches(lengths: List[int], max_tokens: int) -> List[List[int]]:
+    """按长度排序后分组，每组 padding 后的 token 总数不超过 max_tokens。"""
+    batches = []
+    batch = []
+    batch_max_length = 0
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        new_max_length = max(batch_max_length, lengths[index])
+        if batch and new_max_length * (len(batch) + 1) > max_tokens:
+            batches.append(batch)
+            batch = []
+            new_max_length = lengths[index]
+        batch.append(index)
+        batch_max_length = new_max_length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """按长度分组的 batch sampler，每个 batch 补齐后不超过 max_tokens 个 token。
+
+    先打乱顺序，再按 group_size 条一组切分（每组对应一次优化器步骤），只在组内
+    按长度分桶，因此每一步学习的条目与逐条训练时相同，只是合并成了更少的前向。
+    group_size 为 None 时不分组。
+    """
+
+    def __init__(
+        self,
+        lengths: List[int],
+        max_tokens: int,
+        group_size: Optional[int] = None,
+        shuffle: bool = True,
+    ):
+        indices = list(range(len(lengths)))
+        if shuffle:
+            random.shuffle(indices)
+        group_size = group_size or max(len(indices), 1)
+        self.batches = []
+        for start in range(0, len(indices), group_size):
+            group = indices[start : start + group_size]
+            group_batches = length_bucketed_batches(
+                [lengths[i] for i in group], max_tokens
+            )
+            if shuffle:
+                random.shuffle(group_batches)
+            self.batches.extend([group[i] for i in batch] for batch in group_batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def _run_in_thread(fn: Callable) -> Future:
+    future = Future()
+
+    def target():
+        try:
+            future.set_result(fn())
+        except Exception as e:
+            future.set_exception(e)
+
+    Thread(target=target, daemon=True).start()
+    return future
+
+
 class LLMManager:
     def __init__(self):
-        self.model = None
-        self.tokenizer = None
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        # 按会话保存已加载的模型，self.model 等属性指向当前会话的模型
+        self.model_registry = ModelRegistry(
+            self.device,
+            device_budget_bytes=settings.MODEL_REGISTRY_DEVICE_MB * 1024 * 1024,
+            host_budget_bytes=settings.MODEL_REGISTRY_HOST_MB * 1024 * 1024,
+            save_model=self._save_registered_model,
+        )
+        self.active_model: Optional[RegisteredModel] = None
+        self._activation_lock = Lock()
+        # 会话目录下的检查点在后台线程中写入
+        self.checkpoint_writer = CheckpointWriter(keep=settings.CHECKPOINT_KEEP)
+        # 最近一次加载模型的进度，由 /ready 报告
+        self.load_status = {"state": "idle"}
         self.cached_errors = {}
+        self.prompt_cache = (
+            PromptCache(
+                max_entries=settings.PROMPT_CACHE_MAX_ENTRIES,
+                max_bytes=settings.PROMPT_CACHE_MAX_MB * 1024 * 1024,
+            )
+            if settings.PROMPT_CACHE_ENABLED
+            else None
+        )
+        self.response_cache = (
+            ResponseCache(max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES)
+            if settings.RESPONSE_CACHE_ENABLED
+            else None
+        )
+        # 对话所用权重每变化一次加一，用作回复缓存键的一部分
+        self.model_version = 0
+        # 同一时刻只允许一个训练或解码步骤使用模型
+        self.model_lock = RLock()
+        self.batch_scheduler = None
+        self._batch_scheduler_lock = Lock()
+        # 指定了随机种子的生成逐个进行，结束后恢复全局随机数状态
+        self._seed_lock = Lock()
+        # 按会话配置的投机解码，以及按路径缓存的草稿模型
+        self.speculative_configs: Dict[str, SpeculativeConfig] = {}
+        self.speculative_stats: Dict[str, SpeculativeStats] = {}
+        self.draft_models = {}
+        # lora 会话的合并副本在每轮训练后原地刷新，刷新期间对话需要等待
+        self.merged_model_lock = RLock()
+
+    @property
+    def model(self):
+        return self.active_model.model if self.active_model else None
 
-    def load_model(self, model_path):
+    @property
+    def tokenizer(self):
+        return self.active_model.tokenizer if self.active_model else None
+
+    @property
+    def quantized_model(self):
+        # CPU 上用于对话的 int8 动态量化模型，训练仍使用全精度的 self.model
+        return self.active_model.quantized_model if self.active_model else None
+
+    @quantized_model.setter
+    def quantized_model(self, value):
+        self.active_model.quantized_model = value
+
+    @property
+    def inference_snapshot(self):
+        # 对话用的双缓冲快照，训练过程中按步或按轮发布
+        return self.active_model.inference_snapshot if self.active_model else None
+
+    @inference_snapshot.setter
+    def inference_snapshot(self, value):
+        self.active_model.inference_snapshot = value
+
+    @property
+    def merged_model(self):
+        # lora 会话对话时使用的、合并了 adapter 的副本
+        return self.active_model.merged_model if self.active_model else None
+
+    def load_model(self, model_path, session_name: Optional[str] = None):
+        session_name = session_name or model_path
+        self._start_loading(session_name)
+        try:
+            # 等待还在后台写入的检查点，从会话最新的完整检查点加载
+            self.checkpoint_writer.wait(model_path)
+            checkpoint_path = latest_checkpoint(model_path)
+            base_model = None
+            if is_adapter_checkpoint(checkpoint_path):
+                model, tokenizer, base_model = self._load_adapter(
+                    checkpoint_path, session_name
+                )
+            else:
+                model, tokenizer = self._load_pretrained(checkpoint_path, session_name)
+            # 修改：设置 pad_token_id
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+                model.config.pad_token_id = model.config.eos_token_id
+
+            self._set_loading_stage("chat_model")
+            self._activate_loaded_model(
+                session_name,
+                model_path,
+                model,
+                tokenizer,
+                adapter_name=session_name if base_model else None,
+                base_model=base_model,
+            )
+            self.warmup(session_name)
+        except Exception as e:
+            self._finish_loading(error=e)
+            raise
+        self._finish_loading()
+
+    def _load_pretrained(self, model_path: str, session_name: str):
+        # 加载期间其他会话的模型仍可以使用，只在腾出空间时持有 model_lock
+        with self.model_lock:
+            self.model_registry.reserve(model_path, protected=session_name)
         print(f"Loading model from {model_path}")
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_path, torch_dtype="auto", device_map="auto"
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype="auto",
+            # 直接加载到目标设备，不再先放在 device_map="auto" 选的位置再 .to()；
+            # low_cpu_mem_usage 按需从 safetensors 的内存映射中读取权重，
+            # 不会先在内存里随机初始化一份完整的模型
+            device_map=self.device,
+            low_cpu_mem_usage=True,
         )
-        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        return model, tokenizer
+
+    def _load_adapter(self, model_dir: str, session_name: str):
+        """加载 lora 会话：基础模型已经加载时只加入本会话的 adapter。"""
+        base_model = adapter_base_model(model_dir)
+        model = self.model_registry.find_lora_base(base_model)
+        if model is None:
+            base, _ = self._load_pretrained(base_model, session_name)
+            print(f"Loading adapter from {model_dir}")
+            model = PeftModel.from_pretrained(
+                base, model_dir, adapter_name=session_name, is_trainable=True
+            )
+            # is_trainable 会把模型留在 train 模式，与 from_pretrained 保持一致
+            model.eval()
+        else:
+            print(f"Loading adapter from {model_dir} onto shared {base_model}")
+            with self.model_lock:
+                model.load_adapter(
+                    model_dir, adapter_name=session_name, is_trainable=True
+                )
+        tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        return model, tokenizer, base_model
 
-        # 修改：设置 pad_token_id
-        if self.tokenizer.pad_token is None:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
-            self.model.config.pad_token_id = self.model.config.eos_token_id
+    def _activate_loaded_model(
+        self,
+        session_name: str,
+        model_dir: str,
+        model,
+        tokenizer,
+        dirty: bool = False,
+        quantize: bool = True,
+        adapter_name: Optional[str] = None,
+        base_model: Optional[str] = None,
+    ):
+        # 调度器每一步都要取模型，需要在持有 model_lock 之前停止
+        self._stop_batch_scheduler()
+        with self.model_lock:
+            self.model_registry.register(
+                session_name,
+                model_dir,
+                model,
+                tokenizer,
+                adapter_name=adapter_name,
+                base_model=base_model,
+            )
+            # 共用的基础模型可能已被卸载到 CPU，activate 会把它放回 device
+            self.active_model = self.model_registry.activate(session_name)
+            self.active_model.dirty = dirty
+            if adapter_name is not None:
+                self.model.set_adapter(adapter_name)
+            self._prepare_chat_models(quantize=quantize)
+            self._invalidate_chat_caches()
+            self.model_registry.trim(session_name)
 
-        self.model.to(self.device)
+    def _prepare_chat_models(self, quantize: bool = True):
+        """为当前会话准备对话用的副本：量化模型、lora 合并副本或推理快照。"""
+        if quantize and self.quantized_model is None:
+            self._rebuild_quantized_model()
+        if self.merged_model is None:
+            self._rebuild_merged_model()
+        if self.inference_snapshot is None:
+            self._create_inference_snapshot()
 
     def _load_model_if_not_loaded(self, session_name: str):
-        model_dir = self._get_model_dir_from_session_name(session_name)
-        if not self.model or not self.tokenizer:
-            self.load_model(model_dir)
+        self.activate_session(session_name)
+
+    def activate_session(self, session_name: str):
+        """切换到会话的模型：已在注册表中的直接换上，否则从会话目录加载。
+
+        并发的请求会等待正在进行的加载完成，而不会重复加载同一个模型。
+        """
+        with self._activation_lock:
+            active_model = self.active_model
+            if active_model is not None and active_model.session_name == session_name:
+                return
+
+            model_dir = self._get_model_dir_from_session_name(session_name)
+            if self.model_registry.get(session_name) is None:
+                self.load_model(model_dir, session_name)
+                return
+
+            self._stop_batch_scheduler()
+            with self.model_lock:
+                print(f"Switching to model of session {session_name}")
+                self.active_model = self.model_registry.activate(session_name)
+                if self.active_model.adapter_name is not None:
+                    self.model.set_adapter(self.active_model.adapter_name)
+                self._prepare_chat_models()
+                self._invalidate_chat_caches()
+                self.model_registry.trim(session_name)
+
+    def warmup(self, session_name: str):
+        """用一次很短的生成预热对话路径，让第一个真实请求不必承担初始化开销。"""
+        if settings.WARMUP_MAX_NEW_TOKENS <= 0:
+            return
+        self._set_loading_stage("warmup")
+        text = self.tokenizer.apply_chat_template(
+            [{"role": "user", "content": "你好"}],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        params = GenerationParams(
+            max_new_tokens=settings.WARMUP_MAX_NEW_TOKENS, do_sample=False
+        )
+        self._generate_response(text, session_name, params, None)
+
+    def get_load_status(self) -> dict:
+        status = dict(self.load_status)
+        if status["state"] == "loading":
+            status["progress"] = LOAD_STAGES.index(status["stage"]) / len(LOAD_STAGES)
+        elif status["state"] == "ready":
+            status["progress"] = 1.0
+        return status
+
+    def _start_loading(self, session_name: str):
+        now = time.time()
+        self.load_status = {
+            "state": "loading",
+            "session_name": session_name,
+            "stage": LOAD_STAGES[0],
+            "stage_started_at": now,
+            "started_at": now,
+            "stage_seconds": {},
+        }
+
+    def _set_loading_stage(self, stage: str):
+        now = time.time()
+        status = self.load_status
+        status["stage_seconds"][status["stage"]] = now - status["stage_started_at"]
+        status["stage"] = stage
+        status["stage_started_at"] = now
 
-    def init_new_model(self, base_model: str):
+    def _finish_loading(self, error: Optional[Exception] = None):
+        status = self.load_status
+        status["stage_seconds"][status["stage"]] = (
+            time.time() - status["stage_started_at"]
+        )
+        status["total_seconds"] = time.time() - status["started_at"]
+        if error is not None:
+            status["state"] = "failed"
+            status["error"] = str(error)
+        else:
+            status["state"] = "ready"
+            status["stage"] = None
+        print(f"Model loading {status['state']} in {status['total_seconds']:.1f}s")
+
+    def get_registry_stats(self) -> dict:
+        stats = self.model_registry.stats()
+        stats["active_session"] = (
+            self.active_model.session_name if self.active_model else None
+        )
+        return stats
+
+    def init_new_model(
+        self,
+        base_model: str,
+        session_name: Optional[str] = None,
+        lora_config: Optional[dict] = None,
+    ):
+        """从基础模型创建新会话的模型；指定 lora_config 时只训练新建的 adapter。"""
         # Initialize a new model from the base model
-        self.model = AutoModelForCausalLM.from_pretrained(
-            base_model,
-            torch_dtype="auto",
-            device_map="auto",
+        session_name = session_name or base_model
+        adapter_name = None
+        if lora_config is None:
+            model, tokenizer = self._load_pretrained(base_model, session_name)
+        else:
+            adapter_name = session_name
+            model = self.model_registry.find_lora_base(base_model)
+            if model is None:
+                base, tokenizer = self._load_pretrained(base_model, session_name)
+                model = get_peft_model(
+                    base,
+                    build_lora_config(lora_config, base_model),
+                    adapter_name=adapter_name,
+                )
+            else:
+                # 与已加载的 lora 会话共用基础模型
+                with self.model_lock:
+                    model.add_adapter(
+                        adapter_name, build_lora_config(lora_config, base_model)
+                    )
+                tokenizer = AutoTokenizer.from_pretrained(base_model)
+        # 新会话的权重还没有保存；量化模型会在 save_model 之后按新权重重建
+        self._activate_loaded_model(
+            session_name,
+            self._get_model_dir_from_session_name(session_name),
+            model,
+            tokenizer,
+            dirty=True,
+            quantize=False,
+            adapter_name=adapter_name,
+            base_model=base_model if adapter_name else None,
+        )
+
+    def _use_quantized_model(self) -> bool:
+        return settings.CHAT_INT8_ON_CPU and self.device == "cpu"
+
+    def _rebuild_quantized_model(self):
+        """用当前会话权重重新构建对话用的 int8 动态量化模型。"""
+        if not self._use_quantized_model():
+            return
+        print("Building int8 dynamic-quantized model for chat")
+        # 量化需要 float32 的 Linear 权重；在副本上进行，不影响训练用的模型
+        model_copy = merged_copy(self.model, self.active_model.adapter_name)
+        model_copy = model_copy.float().eval()
+        self.quantized_model = torch.ao.quantization.quantize_dynamic(
+            model_copy, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        # 批量解码的调度器每一步都重新取模型，进行中的请求用旧的量化模型生成完
+        self._invalidate_chat_caches()
+
+    def _use_merged_model(self) -> bool:
+        return (
+            settings.LORA_MERGE_FOR_INFERENCE
+            and self.active_model.adapter_name is not None
+            and not self._use_quantized_model()
         )
-        self.tokenizer = AutoTokenizer.from_pretrained(base_model)
 
-    def chat(self, history, session_name: str):
+    def _rebuild_merged_model(self):
+        """lora 会话对话时使用合并了 adapter 的副本，省去每层额外的低秩计算。"""
+        if not self._use_merged_model():
+            return
+        with self.merged_model_lock:
+            if self.merged_model is None:
+                print("Building merged model for chat")
+                merged_model = merged_copy(self.model, self.active_model.adapter_name)
+                merged_model.eval()
+                merged_model.requires_grad_(False)
+                self.active_model.merged_model = merged_model
+            else:
+                refresh_merged_copy(
+                    self.merged_model, self.model, self.active_model.adapter_name
+                )
+        self._invalidate_chat_caches()
+
+    def _create_inference_snapshot(self):
+        # 量化模型和 lora 的合并副本本身就是独立于训练的副本，此时不需要再建快照
+        if (
+            settings.INFERENCE_SNAPSHOT_ENABLED
+            and not self._use_quantized_model()
+            and not self._use_merged_model()
+        ):
+            self.inference_snapshot = InferenceSnapshot(self.model)
+        else:
+            self.inference_snapshot = None
+
+    def _publish_inference_snapshot(self, wait: bool):
+        if self.inference_snapshot is None:
+            return
+        if self.inference_snapshot.publish(self.model, wait=wait):
+            self._invalidate_chat_caches()
+
+    def _chat_model(self):
+        if self.quantized_model is not None:
+            return self.quantized_model
+        if self.merged_model is not None:
+            return self.merged_model
+        return self.model
+
+    @contextmanager
+    def _acquire_chat_model(self):
+        """取得对话使用的模型。
+
+        量化模型和推理快照都是训练模型之外的副本，对话不需要等待训练；
+        否则对话与训练共用 self.model，需要持有 model_lock。
+        """
+        if self.quantized_model is not None:
+            yield self.quantized_model
+        elif self.merged_model is not None:
+            with self.merged_model_lock:
+                yield self.merged_model
+        elif self.inference_snapshot is not None:
+            with self.inference_snapshot.acquire() as model:
+                yield model
+        else:
+            with self.model_lock:
+                yield self.model
+
+    def _pin_chat_model(self, model):
+        """推理快照的副本在批量解码期间不被发布覆盖，其他模型不需要固定。"""
+        if self.inference_snapshot is not None:
+            return self.inference_snapshot.pin(model)
+        return nullcontext()
+
+    @contextmanager
+    def _seeded_generation(self, seed: Optional[int]):
+        """用固定种子生成，不改变训练等其他代码使用的全局随机数状态。"""
+        if seed is None:
+            yield
+            return
+        devices = [torch.cuda.current_device()] if self.device == "cuda" else []
+        with self._seed_lock, torch.random.fork_rng(devices=devices):
+            torch.manual_seed(seed)
+            yield
+
+    def _invalidate_chat_caches(self):
+        """对话使用的权重发生了变化，之前缓存的 key/value 和回复都不再有效。"""
+        self.model_version += 1
+        if self.prompt_cache is not None:
+            self.prompt_cache.clear()
+        if self.response_cache is not None:
+            self.response_cache.clear()
+
+    def _use_prompt_cache(self) -> bool:
+        return self.prompt_cache is not None and getattr(
+            self._chat_model(), "_supports_cache_class", False
+        )
+
+    def _get_batch_scheduler(self) -> BatchScheduler:
+        # 并发的第一批请求只创建一个调度器
+        with self._batch_scheduler_lock:
+            if self.batch_scheduler is None:
+                self.batch_scheduler = BatchScheduler(
+                    self._acquire_chat_model,
+                    self.tokenizer,
+                    max_batch_size=settings.CHAT_MAX_BATCH_SIZE,
+                    temperature=GenerationParams.temperature,
+                    top_p=GenerationParams.top_p,
+                    top_k=GenerationParams.top_k,
+                    pin_model=self._pin_chat_model,
+                )
+            return self.batch_scheduler
+
+    def _stop_batch_scheduler(self):
+        """停止调度器并等待其线程退出，进行中的请求会失败。
+
+        调度器的每一步可能在等待 model_lock，不能在持有 model_lock 时调用。
+        """
+        with self._batch_scheduler_lock:
+            scheduler, self.batch_scheduler = self.batch_scheduler, None
+        if scheduler is not None:
+            scheduler.stop()
+
+    def set_speculative_config(self, session_name: str, config: SpeculativeConfig):
+        if config.mode == "draft":
+            self._load_model_if_not_loaded(session_name)
+            self._get_draft_model(config.draft_model)
+        self.speculative_configs[session_name] = config
+        self.speculative_stats[session_name] = SpeculativeStats()
+
+    def get_speculative_config(self, session_name: str) -> SpeculativeConfig:
+        return self.speculative_configs.get(session_name, SpeculativeConfig())
+
+    def get_speculative_stats(self, session_name: str) -> dict:
+        return self.speculative_stats.get(session_name, SpeculativeStats()).to_dict()
+
+    def _get_draft_model(self, draft_model_path: str):
+        if draft_model_path not in self.draft_models:
+            print(f"Loading draft model from {draft_model_path}")
+            draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_path, torch_dtype="auto"
+            ).to(self.device)
+            draft_model.eval()
+            if draft_model.config.vocab_size != self.model.config.vocab_size:
+                raise ValueError(
+                    "Draft model must share the tokenizer of the session model"
+                )
+            self.draft_models[draft_model_path] = draft_model
+        return self.draft_models[draft_model_path]
+
+    def chat(
+        self,
+        history,
+        session_name: str,
+        streamer=None,
+        params: Optional[GenerationParams] = None,
+    ):
         self._load_model_if_not_loaded(session_name)
+        params = params or GenerationParams()
 
         text = self.tokenizer.apply_chat_template(
             history, tokenize=False, add_generation_prompt=True
         )
+
+        if streamer is not None or self.response_cache is None:
+            return self._generate_response(text, session_name, params, streamer)
+
+        key = ResponseCache.make_key(text, session_name, self.model_version, params)
+        return self.response_cache.get_or_compute(
+            key,
+            lambda: self._generate_response(text, session_name, params, None),
+            cacheable=params.is_deterministic,
+        )
+
+    def _generate_response(
+        self, text: str, session_name: str, params: GenerationParams, streamer
+    ) -> str:
         model_inputs = self.tokenizer(text, return_tensors="pt").to(self.device)
+
+        if settings.CHAT_BATCHING_ENABLED and params.uses_default_sampling():
+            # 与其他并发请求合并成 batch 解码，调度器使用默认的采样参数
+            generated = self._get_batch_scheduler().generate(
+                model_inputs.input_ids[0],
+                max_new_tokens=params.max_new_tokens,
+                streamer=streamer,
+            )
+            response = self.tokenizer.decode(generated, skip_special_tokens=True)
+            return response.strip()
+
         input_ids = self.tokenizer.encode(text, return_tensors="pt")
         attention_mask = torch.ones(
             input_ids.shape, dtype=torch.long, device=self.device
         )
-        generated_ids = self.model.generate(
-            model_inputs.input_ids,
-            pad_token_id=self.tokenizer.eos_token_id,
-            attention_mask=attention_mask,
-            max_new_tokens=2048,
-            do_sample=True,
-            # Temperature (温度)
-            # 温度参数控制生成过程中的随机性。
-            # 较低的温度（例如 0.7）会让模型更“保守”，即更倾向于选择概率更高的下一个词，从而生成更确定性的输出；
-            # 较高的温度（例如 1.5）会增加随机性，使模型更愿意选择那些概率相对较低的词，从而生成更多样化和出乎意料的输出。
-            temperature=0.9,
-            # Top-p (核采样)
-            # 这个参数会在模型生成时考虑概率累积达到 p 值的词集合。
-            # 例如，top_p=0.95 意味着只考虑那些使得概率总和达到 95% 的词，而忽略剩下的低概率词。
-            # 这种方法可以动态地调整被考虑的词数量，确保模型生成的内容在合理范围内又不失随机性。
-            # top_p 像是在生成时只考虑“最有可能的一群词”，而不是所有可能的词，从而保持生成的合理性和多样性之间的平衡。
-            top_p=0.85,
-            # Top-k (最高 k 采样)
-            # 在生成过程中，只从概率最高的前 k 个词中进行采样。
-            # 设置 top_k=50，意味着模型只会从最可能的前 50 个词中选择下一个词。这种方法能有效地减少生成中引入的随机性，确保输出的连贯性。
-            # top_k 就像是在生成时限制“视野”，只看最可能的几个词，忽略那些可能性极低的词，从而使生成更加稳妥。
-            top_k=50,
+
+        speculative_config = self.get_speculative_config(session_name)
+        draft_model = (
+            self._get_draft_model(speculative_config.draft_model)
+            if speculative_config.mode == "draft"
+            else None
         )
+
+        # 复用这段对话此前已经计算过的 key/value，只预填充新增的 token
+        # （投机解码会自行裁剪 cache，两者不同时使用）
+        past_key_values = None
+        if speculative_config.mode == "off" and self._use_prompt_cache():
+            cache_generation = self.prompt_cache.generation
+            past_key_values, _ = self.prompt_cache.take(
+                session_name, model_inputs.input_ids[0]
+            )
+            if past_key_values is None:
+                past_key_values = DynamicCache()
+
+        with self._acquire_chat_model() as chat_model, (
+            count_forwards(chat_model, draft_model)
+            if speculative_config.mode != "off"
+            else nullcontext()
+        ) as forwards:
+            with self._seeded_generation(params.seed):
+                generated_ids = chat_model.generate(
+                    model_inputs.input_ids,
+                    **build_generate_kwargs(speculative_config, draft_model),
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    attention_mask=attention_mask,
+                    past_key_values=past_key_values,
+                    streamer=streamer,
+                    **params.to_generate_kwargs(),
+                )
+        if past_key_values is not None:
+            self.prompt_cache.put(
+                session_name,
+                generated_ids[0],
+                past_key_values,
+                generation=cache_generation,
+            )
+        if speculative_config.mode != "off":
+            self.speculative_stats.setdefault(session_name, SpeculativeStats()).record(
+                generated_tokens=len(generated_ids[0]) - len(model_inputs.input_ids[0]),
+                target_forwards=forwards[0],
+                draft_forwards=forwards[1],
+            )
+
         response = self.tokenizer.decode(
             generated_ids[0][len(model_inputs.input_ids[0]) :], skip_special_tokens=True
         )
         return response.strip()
 
-    def _count_tokens(self, entry: CorpusEntry) -> int:
+    def chat_stream(
+        self,
+        history,
+        session_name: str,
+        submit: Optional[Callable[[Callable], Future]] = None,
+        params: Optional[GenerationParams] = None,
+    ) -> Iterator[dict]:
+        """逐个 token 产出回复，生成过程在后台执行。
+
+        依次产出 {"token": str} 事件，结束时产出一条带有首 token 延迟
+        (ttft) 与总耗时的 {"done": True, ...} 事件；生成失败时最后一条是
+        {"error": 异常类型, "detail": 信息}。生成任务在调用时立即通过 submit
+        提交（默认新开一个后台线程），提交失败会直接抛出。
+        """
+        start_time = time.perf_counter()
+        self._load_model_if_not_loaded(session_name)
+
+        streamer = TextIteratorStreamer(
+            self.tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True,
+            timeout=settings.CHAT_STREAM_TIMEOUT,
+        )
+
+        def generate():
+            return self.chat(history, session_name, streamer=streamer, params=params)
+
+        def end_on_failure(future: Future):
+            # 生成失败、在队列中超时或被取消（此时 generate 没有执行）时唤醒消费者
+            if future.cancelled() or future.exception() is not None:
+                streamer.end()
+
+        future = (submit or _run_in_thread)(generate)
+        future.add_done_callback(end_on_failure)
+        return self._iter_stream(streamer, future, start_time)
+
+    def _iter_stream(
+        self, streamer: TextIteratorStreamer, future: Future, start_time: float
+    ) -> Iterator[dict]:
+        ttft = None
+        num_chunks = 0
+        for text in streamer:
+            if not text:
+                continue
+            if ttft is None:
+                ttft = time.perf_counter() - start_time
+            num_chunks += 1
+            yield {"token": text}
+
+        error = (
+            CancelledError("Generation was cancelled")
+            if future.cancelled()
+            else future.exception()
+        )
+        if error is not None:
+            yield {"error": type(error).__name__, "detail": str(error)}
+            return
+
+        yield {
+            "done": True,
+            "ttft": ttft,
+            "total_time": time.perf_counter() - start_time,
+            "chunks": num_chunks,
+        }
+
+    def count_tokens(self, entries: List[CorpusEntry]) -> List[int]:
+        """每条语料套用对话模板后的 token 数，与训练时的分词一致。"""
         if not self.tokenizer:
             raise ValueError("Tokenizer is not initialized. Call load_model() first.")
+        token_cache = self._get_token_cache()
+        if token_cache is not None:
+            return token_cache.count_tokens(entries)
+        return [len(tokenize_entry(self.tokenizer, entry)) for entry in entries]
 
-        if entry.entry_type == "knowledge":
-            return len(self.tokenizer.encode(entry.content))
-        elif entry.entry_type == "chat":
-            # Apply chat template and count tokens
-            formatted_chat = self.tokenizer.apply_chat_template(
-                entry.messages,
-                tokenize=False,
-                add_generation_prompt=False,
-                chat_template=TEMPLATE,
+    def tokenize_entries(self, entries: List[CorpusEntry]) -> List[torch.Tensor]:
+        """每条语料的 token id，优先从分词缓存中读取。"""
+        if not self.tokenizer:
+            raise ValueError("Tokenizer is not initialized. Call load_model() first.")
+        token_cache = self._get_token_cache()
+        if token_cache is not None:
+            return token_cache.get_many(entries)
+        return [
+            torch.tensor(tokenize_entry(self.tokenizer, entry), dtype=torch.long)
+            for entry in entries
+        ]
+
+    def tokenizer_fingerprint(self) -> str:
+        if not self.tokenizer:
+            raise ValueError("Tokenizer is not initialized. Call load_model() first.")
+        return tokenizer_fingerprint(self.tokenizer, TEMPLATE)
+
+    def warm_token_cache(self, entries: List[CorpusEntry]) -> int:
+        """预先为语料分词并写入缓存，返回新分词的语料数。"""
+        token_cache = self._get_token_cache()
+        if token_cache is None:
+            return 0
+        return token_cache.warm(entries)
+
+    def get_token_cache_stats(self) -> Optional[dict]:
+        token_cache = self._get_token_cache()
+        return token_cache.stats() if token_cache is not None else None
+
+    def _get_token_cache(self) -> Optional[TokenCache]:
+        """当前会话分词器对应的缓存，不同会话的分词器相同时共用数据库中的记录。"""
+        if not settings.TOKEN_CACHE_ENABLED or self.active_model is None:
+            return None
+        entry = self.active_model
+        if entry.token_cache is None:
+            tokenizer = entry.tokenizer
+            entry.token_cache = TokenCache(
+                settings.TOKEN_CACHE_PATH,
+                tokenizer_fingerprint(tokenizer, TEMPLATE),
+                lambda corpus_entry: tokenize_entry(tokenizer, corpus_entry),
+                max_memory_entries=settings.TOKEN_CACHE_MEMORY_ENTRIES,
             )
-            return len(self.tokenizer.encode(formatted_chat))
-        else:
-            raise ValueError(f"Unknown entry type: {entry.entry_type}")
+        return entry.token_cache
+
+    def score_entries(
+        self, session_name: str, entries: List[CorpusEntry]
+    ) -> Dict[str, float]:
+        """在 eval 模式、不计算梯度的情况下，计算每条语料的平均 token 损失。
+
+        语料按 token 长度分桶组成 batch，每个 batch padding 后不超过
+        SCORE_MAX_BATCH_TOKENS 个 token。返回 {语料 id: 损失}。
+        """
+        self._load_model_if_not_loaded(session_name)
+        dataset = self._windowed_dataset(entries)
+        items = [dataset[i] for i in range(len(dataset))]
+        batches = length_bucketed_batches(
+            [len(item["input_ids"]) for item in items],
+            settings.SCORE_MAX_BATCH_TOKENS,
+        )
+
+        # 超长语料的多个窗口汇总成一条语料的损失
+        sample_entries = torch.tensor(dataset.sample_entries, device=self.device)
+        entry_loss_sums = torch.zeros(len(entries), device=self.device)
+        entry_counts = torch.zeros(len(entries), device=self.device)
+        with self.model_lock, torch.no_grad():
+            self.model.eval()
+            for batch_indices in batches:
+                batch = collate_fn([items[i] for i in batch_indices])
+                batch = {k: v.to(self.device) for k, v in batch.items()}
+                outputs = self.model(
+                    input_ids=batch["input_ids"],
+                    attention_mask=batch["attention_mask"],
+                )
+                loss_sums, counts = per_entry_loss(
+                    outputs.logits, batch["labels"], batch["entry_index"], len(items)
+                )
+                entry_loss_sums.index_add_(0, sample_entries, loss_sums)
+                entry_counts.index_add_(0, sample_entries, counts.float())
+        losses = (entry_loss_sums / entry_counts.clamp(min=1)).tolist()
+        return {entry.id: loss for entry, loss in zip(entries, losses)}
 
-    def train_on_entries(self, session_name: str, entries: List[CorpusEntry]) -> float:
-        # 确保模型已加载到正确的设备上
+    def _windowed_dataset(self, entries: List[CorpusEntry]) -> DynamicHeartEchoDataset:
+        # 超过 TRAIN_MAX_LENGTH 的语料切成多个窗口，避免长语料内存不足
+        return DynamicHeartEchoDataset(
+            entries,
+            self.tokenizer,
+            max_length=settings.TRAIN_MAX_LENGTH,
+            overlap=settings.TRAIN_WINDOW_OVERLAP,
+            token_cache=self._get_token_cache(),
+        )
+
+    def train_on_entries(
+        self,
+        session_name: str,
+        entries: List[CorpusEntry],
+        on_step: Optional[Callable[[dict], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ) -> TrainingResult:
+        """训练一轮。on_step 在每个 batch 之后收到进度；should_stop 在每次优化器
+        步骤之后检查，返回 True 时结束本轮，剩下的语料不再训练。"""
+        # 确保模型已加载到正确的设备上（切换模型需要在持有 model_lock 之前进行）
         self._load_model_if_not_loaded(session_name)
+        # 训练期间不允许直接使用 self.model 的解码步骤运行
+        with self.model_lock, training_memory_mode(
+            self.model, settings.TRAIN_MEMORY_MODE
+        ):
+            # 创建数据集，超长的语料被切成多个窗口（样本）
+            return self._train_on_dataset(
+                self._windowed_dataset(entries),
+                [entry.id for entry in entries],
+                on_step,
+                should_stop,
+            )
+
+    def train_on_token_corpus(
+        self,
+        session_name: str,
+        corpus: TokenCorpus,
+        indices: List[int],
+        on_step: Optional[Callable[[dict], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ) -> TrainingResult:
+        """用导出的 token 文件中第 indices 条语料训练一轮，不读取语料对象也不重新分词。
+
+        导出时的分词器必须与当前模型的分词器一致。
+        """
+        self._load_model_if_not_loaded(session_name)
+        if corpus.fingerprint != self.tokenizer_fingerprint():
+            raise ValueError(
+                "Token corpus was built with a different tokenizer, rebuild it first"
+            )
+        dataset = TokenCorpusDataset(
+            corpus,
+            max_length=settings.TRAIN_MAX_LENGTH,
+            overlap=settings.TRAIN_WINDOW_OVERLAP,
+            indices=indices,
+        )
+        with self.model_lock, training_memory_mode(
+            self.model, settings.TRAIN_MEMORY_MODE
+        ):
+            return self._train_on_dataset(
+                dataset, dataset.entry_ids(), on_step, should_stop
+            )
 
-        # 创建数据集
-        train_dataset = DynamicHeartEchoDataset(entries, self.tokenizer)
+    def _train_on_dataset(
+        self,
+        dataset: Dataset,
+        entry_ids: List[str],
+        on_step: Optional[Callable[[dict], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ) -> TrainingResult:
+        """训练一轮。dataset 是 DynamicHeartEchoDataset 或 TokenCorpusDataset，
+        entry_ids 按语料下标排列。"""
+        sample_entries = torch.tensor(dataset.sample_entries, device=self.device)
+        sample_lengths = [len(dataset[i]["input_ids"]) for i in range(len(dataset))]
+        # 每个样本新增的 token 数（不含与上一个窗口重叠的部分），用于按 token 比例加权
+        sample_tokens = torch.tensor(
+            [
+                length - (dataset.overlap if start > 0 else 0)
+                for length, (_, start) in zip(sample_lengths, dataset.samples)
+            ],
+            dtype=torch.float,
+            device=self.device,
+        )
 
-        # 创建数据加载器，batch_size=1 确保每次只处理一个条目
+        if settings.TRAIN_PACKING_ENABLED:
+            # 打包模式：多条语料拼接成一个不超过 TRAIN_PACK_MAX_LENGTH 的块
+            train_dataset = PackedDataset(
+                dataset, settings.TRAIN_PACK_MAX_LENGTH, shuffle=True
+            )
+            batch_sampler = TokenBudgetBatchSampler(
+                [len(block["input_ids"]) for block in train_dataset],
+                settings.TRAIN_MAX_BATCH_TOKENS,
+            )
+            batch_collate_fn = collate_packed
+        else:
+            # 长度相近的条目合并成一个 batch，每16条仍然对应一次优化器步骤
+            batch_sampler = TokenBudgetBatchSampler(
+                sample_lengths,
+                settings.TRAIN_MAX_BATCH_TOKENS,
+                group_size=ENTRIES_PER_OPTIMIZER_STEP,
+            )
+            train_dataset = dataset
+            batch_collate_fn = collate_fn  # 使用自定义的 collate 函数
+        # CUDA 上 batch 放在锁页内存中，拷贝到显存时不阻塞
         train_dataloader = DataLoader(
             train_dataset,
-            batch_size=1,
-            shuffle=True,  # 随机打乱数据
-            collate_fn=collate_fn,  # 使用自定义的 collate 函数
+            batch_sampler=batch_sampler,
+            collate_fn=batch_collate_fn,
+            pin_memory=self.device == "cuda",
         )
 
         # 将模型设置为训练模式
         self.model.train()
 
-        # 初始化优化器
-        optimizer = torch.optim.AdamW(self.model.parameters(), lr=1e-5)
+        # 优化器和学习率调度器随会话保存，在多轮训练之间复用
+        optimizer, lr_scheduler = self._get_optimizer()
+        # 上一轮中途出错时可能留下还没有用于优化器步骤的梯度
+        optimizer.zero_grad(set_to_none=True)
 
         total_loss = 0.0  # 用于累积和计算平均损失
+        # 每条语料的损失之和与 token 数，直接取自训练的前向计算
+        round_loss_sums = torch.zeros(len(entry_ids), device=self.device)
+        round_counts = torch.zeros(len(entry_ids), device=self.device)
+        # 当前梯度累积周期内的损失，优化器步骤之后才计入本轮的结果
+        group_loss_sums = torch.zeros(len(entry_ids), device=self.device)
+        group_counts = torch.zeros(len(entry_ids), device=self.device)
         accumulated_loss = 0.0  # 用于当前梯度累积周期的损失
-        total_tokens = sum(self._count_tokens(entry) for entry in entries)
+        entries_since_step = 0  # 当前梯度累积周期内学习过的条目数
+        total_tokens = sum(dataset.entry_lengths())
         max_token_length = 0
         max_token_entry = None
+        tokens_seen = 0
+        cancelled = False
+        start_time = time.perf_counter()
 
         print("开始训练过程！我们将一步步学习新的知识。")
-        print(f"我们总共有 {len(train_dataloader)} 条数据要学习。")
+        print(
+            f"我们总共有 {len(entry_ids)} 条数据要学习，分成 {len(train_dataloader)} 批。"
+        )
         print("我们会每学习16条数据后，就整理一下我们学到的东西。")
 
-        # 遍历数据集
-        for step, batch in enumerate(train_dataloader):
-            # 计算当前批次的 token 长度
-            token_length = batch["input_ids"].size(1)  # 获取序列长度
-            print(
-                f"\n--- 正在学习第 {step + 1} 条数据 (Token 长度: {token_length}) ---"
-            )
-            # 每批只有1个条目，打印出这个条目的内容的前100个 token的字符串表示
-            print(
-                f"内容: {self.tokenizer.decode(batch['input_ids'][0, :100], skip_special_tokens=True)}"
-            )
-
-            # 更新最大 token 长度
-            if token_length > max_token_length:
-                max_token_length = token_length
-                max_token_entry = step + 1
-
-            # 将批次数据移动到正确的设备上
-            batch = {k: v.to(self.device) for k, v in batch.items()}
-            print("1. 我已经仔细阅读了这条数据。")
-
-            try:
-
-                # 前向传播
-                outputs = self.model(**batch)
-                loss = outputs.loss
+        try:
+            # 遍历数据集
+            for step, batch in enumerate(train_dataloader):
+                # 计算当前批次的 token 长度
+                token_length = batch["input_ids"].size(1)  # 获取序列长度
+                batch_entries = batch["entry_index"].unique()
+                batch_entries = batch_entries[batch_entries >= 0]
                 print(
-                    f"2. 我尝试理解这条数据，并估算了我的理解程度。我的理解误差是: {loss.item():.4f}"
+                    f"\n--- 正在学习第 {step + 1} 批数据 "
+                    f"({len(batch_entries)} 条, Token 长度: {token_length}) ---"
                 )
-
-                # Calculate the gradient weight based on token proportion
-                gradient_weight = token_length / total_tokens
-                weighted_loss = loss * gradient_weight
+                # 打印出这批数据开头的前100个 token的字符串表示
                 print(
-                    f"3. Weighted loss (based on token proportion): {weighted_loss.item():.4f}"
+                    f"内容: {self.tokenizer.decode(batch['input_ids'][0, :100], skip_special_tokens=True)}"
                 )
 
-                # 反向传播
-                weighted_loss.backward()
-                print("4. Backward pass completed.")
+                # 更新最大 token 长度
+                if token_length > max_token_length:
+                    max_token_length = token_length
+                    max_token_entry = step + 1
+
+                tokens_seen += int((batch["entry_index"] >= 0).sum())
+                # 将批次数据移动到正确的设备上
+                batch = {
+                    k: v.to(self.device, non_blocking=True) for k, v in batch.items()
+                }
+                print("1. 我已经仔细阅读了这批数据。")
+                # 内存不足而跳过的条目也计入，保证优化器步骤仍然落在每16条的边界上
+                entries_since_step += len(batch_entries)
+
+                reset_peak_memory(self.device)
+                batch_loss = None
+                backward_started = False
 
-                accumulated_loss += loss.item() * gradient_weight
-                total_loss += loss.item() * gradient_weight
+                try:
 
-                # 每16步或在最后一步执行优化器步骤
-                if (step + 1) % 16 == 0 or (step + 1) == len(train_dataloader):
-                    # 执行优化器步骤
-                    optimizer.step()
-                    # 清零梯度
-                    optimizer.zero_grad()
+                    # 前向传播，损失按条目分别计算
+                    with autocast(self.device, settings.TRAIN_MEMORY_MODE):
+                        outputs = self.model(
+                            input_ids=batch["input_ids"],
+                            attention_mask=self._training_attention_mask(batch),
+                            position_ids=batch.get("position_ids"),
+                        )
+                    loss_sums, counts = per_entry_loss(
+                        outputs.logits,
+                        batch["labels"],
+                        batch["entry_index"],
+                        len(dataset),
+                    )
+                    batch_entries = batch_entries.to(self.device)
+                    entry_losses = loss_sums[batch_entries] / counts[
+                        batch_entries
+                    ].clamp(min=1)
+                    loss = entry_losses.mean()
+                    batch_loss = loss.item()
+                    print(
+                        f"2. 我尝试理解这批数据，并估算了我的理解程度。我的理解误差是: {batch_loss:.4f}"
+                    )
 
+                    # Calculate the gradient weight based on token proportion
+                    gradient_weights = sample_tokens[batch_entries] / total_tokens
+                    weighted_loss = (entry_losses * gradient_weights).sum()
                     print(
-                        f"5. 我已经学习了16条数据（或所有数据），现在我要整理一下我学到的东西。"
+                        f"3. Weighted loss (based on token proportion): {weighted_loss.item():.4f}"
                     )
+
+                    # 反向传播
+                    backward_started = True
+                    weighted_loss.backward()
                     print(
-                        f"   在这16条数据中，我的平均理解误差是: {accumulated_loss:.4f}"
+                        f"4. Backward pass completed. "
+                        f"Peak memory: {peak_memory_mb(self.device):.0f} MB"
+                    )
+                    # 反向传播成功之后才计入结果，同一条语料的多个窗口汇总到一起
+                    group_loss_sums.index_add_(
+                        0,
+                        sample_entries[batch_entries],
+                        loss_sums[batch_entries].detach(),
                     )
+                    group_counts.index_add_(
+                        0, sample_entries[batch_entries], counts[batch_entries].float()
+                    )
+
+                    accumulated_loss += weighted_loss.item()
+                except RuntimeError as e:
+                    if "out of memory" in str(e):
+                        print(
+                            f"警告：处理第 {step + 1} 批数据时内存不足。这批数据的 token 长度为 {token_length}。"
+                        )
+                        print("跳过这批数据并继续训练。")
+                        if backward_started:
+                            # 反向传播到一半的梯度已经混入之前累积的梯度，无法分开，
+                            # 丢弃整个梯度累积周期，周期中之前的语料也算作跳过
+                            optimizer.zero_grad(set_to_none=True)
+                            group_loss_sums.zero_()
+                            group_counts.zero_()
+                            accumulated_loss = 0.0
+                        # 前向传播中内存不足时还没有产生梯度，之前累积的梯度保留
+                        if settings.TRAIN_MEMORY_MODE == "default":
+                            print("可以设置 TRAIN_MEMORY_MODE=lean 来训练更长的语料。")
+                        if torch.cuda.is_available():
+                            torch.cuda.empty_cache()
+                    else:
+                        raise e
+
+                # 每16条数据或在最后一步执行优化器步骤
+                if entries_since_step >= ENTRIES_PER_OPTIMIZER_STEP or (
+                    step + 1
+                ) == len(train_dataloader):
+                    if group_counts.any():
+                        # 执行优化器步骤
+                        optimizer.step()
+                        lr_scheduler.step()
+                        # 清零梯度
+                        optimizer.zero_grad()
+                        if settings.INFERENCE_SNAPSHOT_PUBLISH == "step":
+                            self._publish_inference_snapshot(wait=False)
+
+                        print(
+                            f"5. 我已经学习了16条数据（或所有数据），现在我要整理一下我学到的东西。"
+                        )
+                        print(
+                            f"   在这16条数据中，我的平均理解误差是: {accumulated_loss:.4f}"
+                        )
+                        round_loss_sums += group_loss_sums
+                        round_counts += group_counts
+                        total_loss += accumulated_loss
+                    group_loss_sums.zero_()
+                    group_counts.zero_()
                     accumulated_loss = 0.0
-                else:
+                    entries_since_step = 0
+                    # 最后一步之后已经没有剩下的数据，不算中止
+                    cancelled = (
+                        should_stop is not None
+                        and (step + 1) < len(train_dataloader)
+                        and should_stop()
+                    )
+                elif batch_loss is not None:
                     print("5. 我还没学够16条数据，我会继续学习下一条。")
-            except RuntimeError as e:
-                if "out of memory" in str(e):
-                    print(
-                        f"警告：处理第 {step + 1} 条数据时内存不足。这条数据的 token 长度为 {token_length}。"
+
+                if on_step is not None:
+                    elapsed = time.perf_counter() - start_time
+                    on_step(
+                        {
+                            "step": step + 1,
+                            "total_steps": len(train_dataloader),
+                            "loss": batch_loss,
+                            "tokens": tokens_seen,
+                            "tokens_per_sec": (
+                                tokens_seen / elapsed if elapsed else None
+                            ),
+                        }
                     )
-                    print("跳过这条数据并继续训练。")
-                    if torch.cuda.is_available():
-                        torch.cuda.empty_cache()
-                else:
-                    raise e
+                if cancelled:
+                    print("训练被中止，剩下的数据这一轮不再学习。")
+                    break
+        finally:
+            # 中途出错时也让模型回到 eval 模式，不影响之后的对话
+            self.model.eval()
+
+        # 本轮训练结束，对话使用的模型切换到最新权重
+        self.active_model.dirty = True
+        self.active_model.revision += 1
+        if self.inference_snapshot is not None:
+            self._publish_inference_snapshot(wait=True)
+        elif self.merged_model is not None:
+            self._rebuild_merged_model()
+        else:
+            # 权重已经更新，之前缓存的 key/value 和回复不再有效
+            self._invalidate_chat_caches()
 
         # 计算平均损失
         average_loss = total_loss
@@ -304,7 +1392,60 @@ class LLMManager:
         print(
             f"最长的语料是第 {max_token_entry} 条，长度为 {max_token_length} 个 token。"
         )
-        return average_loss
+        result = TrainingResult(loss=average_loss, cancelled=cancelled)
+        round_losses = (round_loss_sums / round_counts.clamp(min=1)).tolist()
+        for entry_id, entry_loss, count in zip(
+            entry_ids, round_losses, round_counts.tolist()
+        ):
+            if count == 0:
+                result.skipped_entry_ids.append(entry_id)
+            else:
+                result.entry_losses[entry_id] = entry_loss
+        return result
+
+    def _get_optimizer(self):
+        """当前会话的优化器和学习率调度器，第一次训练时创建。
+
+        会话目录中有之前保存的状态时从中恢复，这样重启之后 Adam 的动量也不会丢失。
+        """
+        entry = self.active_model
+        if entry.optimizer is None:
+            optimizer = torch.optim.AdamW(
+                [p for p in self.model.parameters() if p.requires_grad],
+                lr=settings.TRAIN_LEARNING_RATE,
+            )
+            lr_scheduler = get_constant_schedule_with_warmup(
+                optimizer, num_warmup_steps=settings.TRAIN_WARMUP_STEPS
+            )
+            checkpoint_path = latest_checkpoint(entry.model_dir)
+            optimizer_path = os.path.join(checkpoint_path, OPTIMIZER_STATE_FILE)
+            scheduler_path = os.path.join(checkpoint_path, SCHEDULER_STATE_FILE)
+            if os.path.exists(optimizer_path):
+                print(f"Restoring optimizer state from {optimizer_path}")
+                try:
+                    optimizer.load_state_dict(
+                        torch.load(
+                            optimizer_path, map_location=self.device, weights_only=True
+                        )
+                    )
+                    if os.path.exists(scheduler_path):
+                        lr_scheduler.load_state_dict(
+                            torch.load(scheduler_path, weights_only=True)
+                        )
+                except ValueError as e:
+                    print(f"警告：优化器状态与当前模型不匹配，重新开始: {e}")
+            entry.optimizer = optimizer
+            entry.lr_scheduler = lr_scheduler
+        return entry.optimizer, entry.lr_scheduler
+
+    def _training_attention_mask(self, batch):
+        attention_mask = batch["attention_mask"]
+        if attention_mask.dim() != 4:
+            return attention_mask
+        if self.model.config._attn_implementation == "flash_attention_2":
+            # flash attention 不接受 4D mask，根据重新开始的 position_ids 区分打包的语料
+            return None
+        return to_additive_mask(attention_mask, self.model.dtype)
 
     def get_error_distribution(self):
         current_session = self.training_session_service.get_current_session()
@@ -347,15 +1488,131 @@ class LLMManager:
 
         return updated_distribution
 
-    def save_model(self, session: TrainingSession):
+    def save_model(
+        self,
+        session: TrainingSession,
+        training_state: Optional[dict] = None,
+        on_saved: Optional[Callable[[], None]] = None,
+    ):
+        self.checkpoint_model(session, training_state, on_saved)
+        self._rebuild_quantized_model()
+        self._invalidate_chat_caches()
+        return True
+
+    def checkpoint_model(
+        self,
+        session: TrainingSession,
+        training_state: Optional[dict] = None,
+        on_saved: Optional[Callable[[], None]] = None,
+    ):
+        """只写入检查点，不重建对话用的量化模型，适合每轮训练之后调用。
+
+        training_state 与权重一起保存在检查点中；on_saved 在检查点完整写入之后调用。
+        """
         if not self.model:
             raise ValueError("Model not loaded. Call load_model() first.")
+        # 保存的是当前模型，不能写到其他会话的目录中
+        assert (
+            self.active_model.session_name == session.name
+        ), f"Active model belongs to {self.active_model.session_name}, not {session.name}"
 
         model_dir = self._get_model_dir_from_session_name(session.name)
 
-        self.model.save_pretrained(model_dir)
-        self.tokenizer.save_pretrained(model_dir)
-        return True
+        self._save_registered_model(
+            self.active_model, model_dir, training_state, on_saved
+        )
+
+    def load_training_state(self, session_name: str) -> Optional[dict]:
+        """会话最新检查点中的训练状态，旧的检查点没有时返回 None。"""
+        model_dir = self._get_model_dir_from_session_name(session_name)
+        self.checkpoint_writer.wait(model_dir)
+        return load_training_state(latest_checkpoint(model_dir))
+
+    def _save_registered_model(
+        self,
+        entry: RegisteredModel,
+        model_dir: Optional[str] = None,
+        training_state: Optional[dict] = None,
+        on_saved: Optional[Callable[[], None]] = None,
+    ):
+        """把会话的模型保存为会话目录下的一个新检查点。
+
+        权重和优化器状态先复制到 CPU，CHECKPOINT_ASYNC 时由后台线程写入文件，
+        不阻塞训练和对话。检查点写入成功之后才清除 dirty，写入期间又训练过时不清除。
+        """
+        model_dir = model_dir or entry.model_dir
+        snapshot = self._checkpoint_snapshot(entry)
+        if training_state is not None:
+            snapshot.objects[TRAINING_STATE_FILE] = {
+                **training_state,
+                "rng": capture_rng_state(),
+            }
+        revision = entry.revision
+
+        def saved():
+            if entry.revision == revision:
+                entry.dirty = False
+            if on_saved is not None:
+                on_saved()
+
+        if not settings.CHECKPOINT_ASYNC:
+            self.checkpoint_writer.write(model_dir, snapshot)
+            saved()
+            return
+        future = self.checkpoint_writer.submit(model_dir, snapshot)
+        # 写入失败时结果为 None，LATEST 仍指向上一个检查点
+        future.add_done_callback(lambda f: f.result() and saved())
+
+    def _checkpoint_snapshot(self, entry: RegisteredModel) -> CheckpointSnapshot:
+        tokenizer = entry.tokenizer
+        if entry.adapter_name is not None:
+            # lora 会话只保存 adapter，基础模型不变
+            adapter_config = copy.deepcopy(entry.model.peft_config[entry.adapter_name])
+
+            def save_config(checkpoint_dir: str):
+                adapter_config.save_pretrained(checkpoint_dir)
+                tokenizer.save_pretrained(checkpoint_dir)
+
+            snapshot = CheckpointSnapshot(
+                weights_name="adapter_model",
+                weights=adapter_state_dict(entry.model, entry.adapter_name),
+                save_config=save_config,
+                max_shard_size=None,
+            )
+        else:
+            config = copy.deepcopy(entry.model.config)
+            # 与 save_pretrained 写入的配置一致
+            config.architectures = [type(entry.model).__name__]
+            config.torch_dtype = entry.model.dtype
+            generation_config = (
+                copy.deepcopy(entry.model.generation_config)
+                if entry.model.can_generate()
+                else None
+            )
+
+            def save_config(checkpoint_dir: str):
+                config.save_pretrained(checkpoint_dir)
+                if generation_config is not None:
+                    generation_config.save_pretrained(checkpoint_dir)
+                tokenizer.save_pretrained(checkpoint_dir)
+
+            snapshot = CheckpointSnapshot(
+                weights_name="model",
+                weights=snapshot_state_dict(entry.model),
+                save_config=save_config,
+            )
+        if entry.optimizer is not None:
+            snapshot.objects[OPTIMIZER_STATE_FILE] = cpu_copy(
+                entry.optimizer.state_dict()
+            )
+            snapshot.objects[SCHEDULER_STATE_FILE] = copy.deepcopy(
+                entry.lr_scheduler.state_dict()
+            )
+        return snapshot
+
+    def wait_for_checkpoints(self):
+        """等待所有已提交的检查点写完，退出前调用。"""
+        self.checkpoint_writer.wait()
 
     def _get_model_dir_from_session_name(self, session_name: str):
         return os.path.join("./trained", session_name)
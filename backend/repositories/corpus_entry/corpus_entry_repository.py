@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from typing import List, Optional, Set
 from domain.corpus import CorpusEntry
 
 
@@ -22,9 +22,17 @@ class CorpusEntryRepository(ABC):
     ) -> List[CorpusEntry]:
         pass
 
+    @abstractmethod
+    def list_all(self, skip: int = 0, limit: int = 100) -> List[CorpusEntry]:
+        pass
+
     @abstractmethod
     def sample_new_entries(
-        self, batch_size: int, total_entries: int, session_id: str
+        self,
+        batch_size: int,
+        total_entries: int,
+        session_id: str,
+        exclude_ids: Optional[Set[str]] = None,
     ) -> List[CorpusEntry]:
         pass
 
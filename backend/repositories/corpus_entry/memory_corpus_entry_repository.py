@@ -27,6 +27,9 @@ class MemoryCorpusEntryRepository(CorpusEntryRepository):
         ]
         return corpus_entries[skip : skip + limit]
 
+    def list_all(self, skip: int = 0, limit: int = 100) -> List[CorpusEntry]:
+        return list(self.entries.values())[skip : skip + limit]
+
     def delete(self, entry_id: str) -> bool:
         if entry_id in self.entries:
             entry = self.entries[entry_id]
@@ -1,6 +1,6 @@
 from datetime import datetime
 import random
-from typing import List, Optional
+from typing import List, Optional, Set
 from mongoengine import (
     Document,
     StringField,
@@ -63,10 +63,19 @@ class MongoDBCorpusEntryRepository(CorpusEntryRepository):
         mongo_entries = MongoCorpusEntry.objects(corpus=corpus).skip(skip).limit(limit)
         return [self._to_domain(me) for me in mongo_entries]
 
+    def list_all(self, skip: int = 0, limit: int = 100) -> List[CorpusEntry]:
+        mongo_entries = MongoCorpusEntry.objects().order_by("_id").skip(skip).limit(limit)
+        return [self._to_domain(me) for me in mongo_entries]
+
     def sample_new_entries(
-        self, batch_size: int, total_entries: int, session_id: str
+        self,
+        batch_size: int,
+        total_entries: int,
+        session_id: str,
+        exclude_ids: Optional[Set[str]] = None,
     ) -> List[CorpusEntry]:
         new_entries = []
+        exclude_ids = exclude_ids or set()
         page_size = 100
         skip = 0
 
@@ -77,9 +86,12 @@ class MongoDBCorpusEntryRepository(CorpusEntryRepository):
             )
 
             for entry in entries:
+                # 正在训练、还没有记录损失的条目由调用方排除
+                if str(entry.id) in exclude_ids:
+                    continue
                 # 检查该条目是否已经被训练过
                 if not MongoTrainingLoss.objects(
-                    corpus_entry_id=entry.id, session_id=session_id
+                    corpus_entry_id=entry.id, session_id=session_id, trained__ne=False
                 ).first():
                     new_entries.append(self._to_domain(entry))
                     if len(new_entries) == batch_size:
@@ -0,0 +1,59 @@
+from typing import Dict, List, Optional
+from domain.training_loss import TrainingLoss
+from .training_loss_repository import TrainingLossRepository
+
+
+class MemoryTrainingLossRepository(TrainingLossRepository):
+    def __init__(self):
+        # (corpus_entry_id, session_id) -> TrainingLoss
+        self.losses: Dict[tuple, TrainingLoss] = {}
+
+    def save(self, training_loss: TrainingLoss) -> TrainingLoss:
+        key = (training_loss.corpus_entry_id, training_loss.session_id)
+        existing_loss = self.losses.get(key)
+        if existing_loss:
+            existing_loss.loss_rank = training_loss.loss_rank
+            existing_loss.timestamp = training_loss.timestamp
+            existing_loss.loss_value = training_loss.loss_value
+            existing_loss.trained = existing_loss.trained or training_loss.trained
+            return existing_loss
+        self.losses[key] = training_loss
+        return training_loss
+
+    def get_by_id(self, training_loss_id: str) -> Optional[TrainingLoss]:
+        for loss in self.losses.values():
+            if loss.id == training_loss_id:
+                return loss
+        return None
+
+    def get_by_session_id(self, session_id: str) -> List[TrainingLoss]:
+        return [loss for loss in self.losses.values() if loss.session_id == session_id]
+
+    def get_by_corpus_entry_id(self, corpus_entry_id: str) -> List[TrainingLoss]:
+        return [
+            loss
+            for loss in self.losses.values()
+            if loss.corpus_entry_id == corpus_entry_id
+        ]
+
+    def count_by_loss_rank(self, session_id: str, loss_rank: str) -> int:
+        return sum(
+            1
+            for loss in self.get_by_session_id(session_id)
+            if loss.loss_rank == loss_rank
+        )
+
+    def count_trained_by_session_id(self, session_id: str) -> int:
+        return sum(1 for loss in self.get_by_session_id(session_id) if loss.trained)
+
+    def get_highest_loss_entries(
+        self, session_id: str, limit: int
+    ) -> List[TrainingLoss]:
+        losses = self.get_by_session_id(session_id)
+        return sorted(losses, key=lambda loss: -loss.loss_value)[:limit]
+
+    def get_lowest_loss_entries(
+        self, session_id: str, limit: int
+    ) -> List[TrainingLoss]:
+        losses = self.get_by_session_id(session_id)
+        return sorted(losses, key=lambda loss: loss.loss_value)[:limit]
@@ -1,5 +1,6 @@
 from typing import List, Optional
 from mongoengine import (
+    BooleanField,
     Document,
     IntField,
     StringField,
@@ -20,6 +21,8 @@ class MongoTrainingLoss(Document):
     timestamp = DateTimeField(required=True)
     loss_value = FloatField(required=True)
     loss_rank = StringField(required=True, index=True)
+    # 旧记录没有这个字段，都是训练时写入的
+    trained = BooleanField(default=True)
     meta = {"collection": "training_losses"}
 
 
@@ -39,6 +42,8 @@ class MongoDBTrainingLossRepository(TrainingLossRepository):
             existing_loss.loss_rank = training_loss.loss_rank
             existing_loss.timestamp = training_loss.timestamp
             existing_loss.loss_value = training_loss.loss_value
+            # 训练过的语料再评估仍然算作训练过
+            existing_loss.trained = existing_loss.trained or training_loss.trained
             existing_loss.save()
             print(
                 f"Training loss updated for corpus_entry_id: {training_loss.corpus_entry_id}, session_id: {training_loss.session_id}"
@@ -53,6 +58,7 @@ class MongoDBTrainingLossRepository(TrainingLossRepository):
                 session_id=training_loss.session_id,
                 timestamp=training_loss.timestamp,
                 loss_value=training_loss.loss_value,
+                trained=training_loss.trained,
             )
             mongo_loss.save()
             print(
@@ -77,8 +83,10 @@ class MongoDBTrainingLossRepository(TrainingLossRepository):
             session_id=session_id, loss_rank=loss_rank
         ).count()
 
-    def count_by_session_id(self, session_id: str) -> int:
-        return MongoTrainingLoss.objects(session_id=session_id).count()
+    def count_trained_by_session_id(self, session_id: str) -> int:
+        return MongoTrainingLoss.objects(
+            session_id=session_id, trained__ne=False
+        ).count()
 
     def get_highest_loss_entries(
         self, session_id: str, limit: int
@@ -108,4 +116,5 @@ class MongoDBTrainingLossRepository(TrainingLossRepository):
             session_id=mongo_loss.session_id,
             timestamp=mongo_loss.timestamp,
             loss_value=mongo_loss.loss_value,
+            trained=mongo_loss.trained is not False,
         )
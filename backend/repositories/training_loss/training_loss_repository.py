@@ -25,7 +25,7 @@ class TrainingLossRepository(ABC):
         pass
 
     @abstractmethod
-    def count_by_session_id(self, session_id: str) -> int:
+    def count_trained_by_session_id(self, session_id: str) -> int:
         pass
 
     @abstractmethod
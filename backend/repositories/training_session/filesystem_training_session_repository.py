@@ -79,7 +79,10 @@ class FileSystemTrainingSessionRepository(TrainingSessionRepository):
             "start_time": session.start_time.isoformat(),
             "last_trained": session.last_trained.isoformat(),
             "tokens_trained": session.tokens_trained,
+            "rounds_trained": session.rounds_trained,
             "metrics": session.metrics,
+            "training_mode": session.training_mode,
+            "lora_config": session.lora_config,
         }
         with open(info_path, "w") as f:
             json.dump(info, f, indent=2)
@@ -92,5 +95,8 @@ class FileSystemTrainingSessionRepository(TrainingSessionRepository):
             start_time=datetime.fromisoformat(info["start_time"]),
             last_trained=datetime.fromisoformat(info["last_trained"]),
             tokens_trained=info["tokens_trained"] if "tokens_trained" in info else 0,
+            rounds_trained=info.get("rounds_trained", 0),
             metrics=info["metrics"],
+            training_mode=info.get("training_mode", "full"),
+            lora_config=info.get("lora_config", {}),
         )
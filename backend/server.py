@@ -1,21 +1,36 @@
+import json
 import os
 import time
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 from app.core.dependencies import (
+    get_auto_smelt_service,
+    get_chat_worker,
+    get_corpus_service,
     get_llm_manager,
     get_model_training_service,
     get_training_session_service,
+    get_training_worker,
 )
+from llm.generation import GenerationParams
 from llm_manager import LLMManager
 
 import logging
 import app.api.routes.corpus as corpus_routes
+import app.api.routes.jobs as jobs_routes
 import app.api.routes.sessions as sessions_routes
 from app.core.config import settings
+from services.auto_smelt_service import AutoSmeltService
+from services.corpus_management_service import CorpusManagementService
 from services.model_training_service import ModelTrainingService
+from services.model_worker import (
+    DeadlineExceededError,
+    ModelWorker,
+    WorkerOverloadedError,
+)
 from services.training_session_service import TrainingSessionService
 
 logger = logging.getLogger(__name__)
@@ -26,45 +41,194 @@ print(corpus_routes.router.routes)
 
 app.include_router(corpus_routes.router, prefix="/corpus", tags=["corpus"])
 app.include_router(sessions_routes.router, prefix="/sessions", tags=["sessions"])
+app.include_router(jobs_routes.router, prefix="/jobs", tags=["jobs"])
 # app.include_router(model.router, prefix="/model", tags=["model"])
 # app.include_router(training.router, prefix="/training", tags=["training"])
 
 
+@app.exception_handler(WorkerOverloadedError)
+async def worker_overloaded_handler(request: Request, exc: WorkerOverloadedError):
+    return JSONResponse(
+        status_code=429, content={"detail": str(exc)}, headers={"Retry-After": "5"}
+    )
+
+
+@app.exception_handler(DeadlineExceededError)
+async def deadline_exceeded_handler(request: Request, exc: DeadlineExceededError):
+    return JSONResponse(status_code=504, content={"detail": str(exc)})
+
+
 class ChatInput(BaseModel):
     history: List[Dict[str, Any]]
+    max_new_tokens: int = GenerationParams.max_new_tokens
+    do_sample: bool = GenerationParams.do_sample
+    temperature: float = GenerationParams.temperature
+    top_p: float = GenerationParams.top_p
+    top_k: int = GenerationParams.top_k
+    seed: Optional[int] = None
+
+    def generation_params(self) -> GenerationParams:
+        return GenerationParams(**self.model_dump(exclude={"history"}))
+
+
+@app.on_event("startup")
+def load_startup_session():
+    if not settings.STARTUP_LOAD_SESSION:
+        return
+    # 在模型 worker 上后台加载，服务可以立即开始接受请求，进度通过 /ready 查询
+    future = get_training_worker().submit(
+        get_training_session_service().load_startup_session
+    )
+    app.state.startup_load = future
+
+    def report(future):
+        if future.exception() is not None:
+            logger.error("Failed to load startup session: %s", future.exception())
+
+    future.add_done_callback(report)
+
+
+@app.on_event("startup")
+def start_auto_smelt():
+    if settings.AUTO_SMELT_ENABLED:
+        get_auto_smelt_service().start()
+
+
+@app.on_event("shutdown")
+def stop_auto_smelt():
+    get_auto_smelt_service().stop()
+
+
+@app.on_event("shutdown")
+def flush_checkpoints():
+    # 后台写入的检查点必须在退出前写完
+    get_llm_manager().wait_for_checkpoints()
+
+
+@app.get("/ready")
+async def ready(llm_manager: LLMManager = Depends(get_llm_manager)):
+    """模型加载完成、可以对话时返回 200，正在加载或加载失败时返回 503。
+
+    没有加载过模型时，如果配置了启动加载并且还没有结束也返回 503；没有配置
+    启动加载或者没有可以加载的会话时返回 200。
+    """
+    status = llm_manager.get_load_status()
+    if status["state"] == "idle" and settings.STARTUP_LOAD_SESSION:
+        startup_load = getattr(app.state, "startup_load", None)
+        if startup_load is None or not startup_load.done():
+            # 启动加载还在 worker 队列中排队
+            status["state"] = "pending"
+        elif startup_load.exception() is not None:
+            # 开始加载模型之前就失败了，比如找不到 STARTUP_SESSION_ID 指定的会话
+            status["state"] = "failed"
+            status["error"] = str(startup_load.exception())
+    if status["state"] not in ("ready", "idle"):
+        return JSONResponse(
+            status_code=503, content=status, headers={"Retry-After": "5"}
+        )
+    return status
+
+
+def _require_current_session(
+    training_session_service: TrainingSessionService, llm_manager: LLMManager
+):
+    session = training_session_service.get_current_session()
+    if session:
+        return session
+    if llm_manager.get_load_status()["state"] == "loading":
+        raise HTTPException(
+            status_code=503,
+            detail="Model is still loading",
+            headers={"Retry-After": "5"},
+        )
+    raise HTTPException(status_code=404, detail="Training session not found")
 
 
 @app.post("/chat")
-def chat(
+async def chat(
     chat_input: ChatInput,
     llm_manager: LLMManager = Depends(get_llm_manager),
     training_session_service: TrainingSessionService = Depends(
         get_training_session_service
     ),
+    chat_worker: ModelWorker = Depends(get_chat_worker),
 ):
+    session = _require_current_session(training_session_service, llm_manager)
     try:
-        response = llm_manager.chat(
-            chat_input.history, training_session_service.get_current_session().name
+        response = await chat_worker.run(
+            llm_manager.chat,
+            chat_input.history,
+            session.name,
+            params=chat_input.generation_params(),
+            timeout=settings.CHAT_REQUEST_TIMEOUT,
         )
         return {"response": response}
+    except (WorkerOverloadedError, DeadlineExceededError):
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/chat/stream")
+def chat_stream(
+    chat_input: ChatInput,
+    llm_manager: LLMManager = Depends(get_llm_manager),
+    training_session_service: TrainingSessionService = Depends(
+        get_training_session_service
+    ),
+    chat_worker: ModelWorker = Depends(get_chat_worker),
+):
+    session = _require_current_session(training_session_service, llm_manager)
+
+    # 生成任务在返回响应前就提交给 chat worker，队列已满时直接返回 429
+    events = llm_manager.chat_stream(
+        chat_input.history,
+        session.name,
+        submit=lambda fn: chat_worker.submit(
+            fn, timeout=settings.CHAT_REQUEST_TIMEOUT
+        ),
+        params=chat_input.generation_params(),
+    )
+
+    def event_stream():
+        try:
+            for event in events:
+                if "error" in event:
+                    event_type = "error"
+                elif event.get("done"):
+                    event_type = "done"
+                else:
+                    event_type = "token"
+                yield f"event: {event_type}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            logger.exception("Streaming chat failed")
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)}, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/smelt_new_corpus")
 async def smelt_new_corpus(
     model_training_service: ModelTrainingService = Depends(get_model_training_service),
     training_session_service: TrainingSessionService = Depends(
         get_training_session_service
     ),
+    training_worker: ModelWorker = Depends(get_training_worker),
 ):
     session = training_session_service.get_current_session()
     if not session:
         raise HTTPException(status_code=404, detail="Training session not found")
 
-    result = model_training_service.smelt_new_corpus()
+    result = await training_worker.run(
+        model_training_service.smelt_new_corpus,
+        timeout=settings.TRAINING_REQUEST_TIMEOUT,
+    )
     return result
 
 
@@ -74,12 +238,16 @@ async def smelt_new_old(
     training_session_service: TrainingSessionService = Depends(
         get_training_session_service
     ),
+    training_worker: ModelWorker = Depends(get_training_worker),
 ):
     session = training_session_service.get_current_session()
     if not session:
         raise HTTPException(status_code=404, detail="Training session not found")
 
-    result = model_training_service.smelt_new_old()
+    result = await training_worker.run(
+        model_training_service.smelt_new_old,
+        timeout=settings.TRAINING_REQUEST_TIMEOUT,
+    )
     return result
 
 
@@ -87,16 +255,163 @@ async def smelt_new_old(
 async def train_single_entry(
     entry_id: str,
     model_training_service: ModelTrainingService = Depends(get_model_training_service),
+    training_worker: ModelWorker = Depends(get_training_worker),
 ):
     try:
-        result = model_training_service.train_single_entry(entry_id)
+        result = await training_worker.run(
+            model_training_service.train_single_entry,
+            entry_id,
+            timeout=settings.TRAINING_REQUEST_TIMEOUT,
+        )
         return result
+    except (WorkerOverloadedError, DeadlineExceededError):
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+class ScoreEntriesInput(BaseModel):
+    entry_ids: List[str]
+
+
+class ScoreCorpusInput(BaseModel):
+    corpus_id: Optional[str] = None
+
+
+@app.post("/score/entries")
+async def score_entries(
+    input: ScoreEntriesInput,
+    model_training_service: ModelTrainingService = Depends(get_model_training_service),
+    training_worker: ModelWorker = Depends(get_training_worker),
+):
+    try:
+        return await training_worker.run(
+            model_training_service.score_entries,
+            input.entry_ids,
+            timeout=settings.TRAINING_REQUEST_TIMEOUT,
+        )
+    except (WorkerOverloadedError, DeadlineExceededError):
+        raise
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/score/corpus", status_code=202)
+async def score_corpus(
+    input: ScoreCorpusInput,
+    model_training_service: ModelTrainingService = Depends(get_model_training_service),
+    training_session_service: TrainingSessionService = Depends(
+        get_training_session_service
+    ),
+    training_worker: ModelWorker = Depends(get_training_worker),
+):
+    if not training_session_service.get_current_session():
+        raise HTTPException(status_code=404, detail="Training session not found")
+    if model_training_service.get_scoring_status()["state"] == "running":
+        raise HTTPException(status_code=409, detail="A scoring job is already running")
+
+    # 后台执行，进度通过 /score/status 查询
+    training_worker.submit(model_training_service.score_corpus, input.corpus_id)
+    return {"message": "Scoring job submitted", "corpus_id": input.corpus_id}
+
+
+@app.get("/score/status")
+async def get_scoring_status(
+    model_training_service: ModelTrainingService = Depends(get_model_training_service),
+):
+    return model_training_service.get_scoring_status()
+
+
+class TokenCorpusInput(BaseModel):
+    corpus_id: Optional[str] = None
+
+
+@app.post("/tokens/warm")
+async def warm_token_cache(
+    input: TokenCorpusInput,
+    model_training_service: ModelTrainingService = Depends(get_model_training_service),
+    training_session_service: TrainingSessionService = Depends(
+        get_training_session_service
+    ),
+    training_worker: ModelWorker = Depends(get_training_worker),
+):
+    if not training_session_service.get_current_session():
+        raise HTTPException(status_code=404, detail="Training session not found")
+    return await training_worker.run(
+        model_training_service.warm_token_cache,
+        input.corpus_id,
+        timeout=settings.TRAINING_REQUEST_TIMEOUT,
+    )
+
+
+@app.post("/tokens/corpus")
+async def build_token_corpus(
+    input: TokenCorpusInput,
+    model_training_service: ModelTrainingService = Depends(get_model_training_service),
+    training_session_service: TrainingSessionService = Depends(
+        get_training_session_service
+    ),
+    corpus_service: CorpusManagementService = Depends(get_corpus_service),
+    training_worker: ModelWorker = Depends(get_training_worker),
+):
+    if not training_session_service.get_current_session():
+        raise HTTPException(status_code=404, detail="Training session not found")
+    # corpus_id 用作导出目录名，只接受已有的语料库
+    if input.corpus_id is not None and not corpus_service.get_corpus(input.corpus_id):
+        raise HTTPException(status_code=404, detail="Corpus not found")
+    try:
+        return await training_worker.run(
+            model_training_service.build_token_corpus,
+            input.corpus_id,
+            timeout=settings.TRAINING_REQUEST_TIMEOUT,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/tokens/stats")
+async def get_token_cache_stats(llm_manager: LLMManager = Depends(get_llm_manager)):
+    stats = llm_manager.get_token_cache_stats()
+    if stats is None:
+        raise HTTPException(status_code=404, detail="Token cache is not available")
+    return stats
+
+
+@app.get("/auto_smelt")
+async def get_auto_smelt_status(
+    auto_smelt_service: AutoSmeltService = Depends(get_auto_smelt_service),
+):
+    return auto_smelt_service.get_status()
+
+
+@app.post("/auto_smelt/start")
+async def start_auto_smelt_service(
+    auto_smelt_service: AutoSmeltService = Depends(get_auto_smelt_service),
+):
+    auto_smelt_service.start()
+    return auto_smelt_service.get_status()
+
+
+@app.post("/auto_smelt/stop")
+async def stop_auto_smelt_service(
+    auto_smelt_service: AutoSmeltService = Depends(get_auto_smelt_service),
+):
+    auto_smelt_service.stop()
+    return auto_smelt_service.get_status()
+
+
+@app.get("/workers")
+async def get_worker_stats(
+    chat_worker: ModelWorker = Depends(get_chat_worker),
+    training_worker: ModelWorker = Depends(get_training_worker),
+):
+    return {"workers": [chat_worker.stats(), training_worker.stats()]}
+
+
 @app.post("/create_training_session")
 async def create_training_session():
     try:
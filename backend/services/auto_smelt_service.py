@@ -0,0 +1,164 @@
+import threading
+import time
+from datetime import datetime
+from datetime import time as time_of_day
+from typing import List, Optional, Tuple
+from app.core.config import settings
+from services.model_training_service import ModelTrainingService
+from services.model_worker import ModelWorker
+from services.training_job_service import TrainingJobService
+from services.training_session_service import TrainingSessionService
+
+TimeWindow = Tuple[time_of_day, time_of_day]
+
+
+class AutoSmeltService:
+    """后台定时检查，在合适的时候自动提交训练任务。
+
+    新语料足够一轮时执行 smelt_new_corpus；处于空闲时段且没有新语料时执行
+    smelt_new_old 复习旧语料。最近有对话请求或已有训练任务时不开始新的一轮，
+    训练过之后按 AUTO_SMELT_SAVE_INTERVAL_SECONDS 定期保存会话。
+    """
+
+    def __init__(
+        self,
+        model_training_service: ModelTrainingService,
+        training_session_service: TrainingSessionService,
+        training_job_service: TrainingJobService,
+        chat_worker: ModelWorker,
+    ):
+        self.model_training_service = model_training_service
+        self.training_session_service = training_session_service
+        self.training_job_service = training_job_service
+        self.chat_worker = chat_worker
+        self.idle_windows = parse_time_windows(settings.AUTO_SMELT_IDLE_WINDOWS)
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_job_id: Optional[str] = None
+        # 上次保存之后是否训练过
+        self._trained_since_save = False
+        self._last_saved_at = time.monotonic()
+        self.status = {"state": "stopped", "jobs_submitted": 0}
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        print("Starting auto smelt")
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="auto-smelt", daemon=True
+        )
+        self._thread.start()
+        self.status["state"] = "idle"
+
+    def stop(self):
+        """停止定时检查；已经提交的训练任务会继续执行完。"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.status["state"] = "stopped"
+
+    def get_status(self) -> dict:
+        return dict(self.status)
+
+    def _run(self):
+        while not self._stop_event.wait(settings.AUTO_SMELT_POLL_SECONDS):
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Auto smelt check failed: {e}")
+                self.status["error"] = str(e)
+
+    def tick(self) -> Optional[str]:
+        """检查一次是否需要训练，提交了任务时返回任务 id。"""
+        self.status["last_checked_at"] = datetime.now().isoformat()
+        self._check_last_job()
+        session = self.training_session_service.get_current_session()
+        if not session:
+            return self._wait("no_session")
+        if self.training_job_service.has_active_job():
+            return self._wait("job_running")
+        self._maybe_save()
+        if self.chat_worker.idle_seconds() < settings.AUTO_SMELT_CHAT_QUIET_SECONDS:
+            return self._wait("chat_active")
+
+        new_entries = self.model_training_service.count_new_entries(session.id)
+        self.status["new_entries"] = new_entries
+        if new_entries >= settings.AUTO_SMELT_BATCH_SIZE:
+            job_type = "smelt_new_corpus"
+        elif in_time_windows(datetime.now().time(), self.idle_windows):
+            job_type = "smelt_new_old"
+        else:
+            return self._wait("waiting_for_entries")
+
+        job = self.training_job_service.submit_job(
+            job_type, batch_size=settings.AUTO_SMELT_BATCH_SIZE
+        )
+        print(f"Auto smelt submitted {job_type} job {job.id}")
+        self._last_job_id = job.id
+        self.status["state"] = "training"
+        self.status["last_job_id"] = job.id
+        self.status["jobs_submitted"] += 1
+        return job.id
+
+    def _wait(self, reason: str) -> None:
+        self.status["state"] = reason
+        return None
+
+    def _check_last_job(self):
+        if self._last_job_id is None:
+            return
+        try:
+            job = self.training_job_service.get_job(self._last_job_id)
+        except ValueError:
+            job = None
+        if job is None or job.is_finished:
+            if job is not None and job.rounds_completed:
+                self._trained_since_save = True
+            self._last_job_id = None
+
+    def _maybe_save(self):
+        interval = settings.AUTO_SMELT_SAVE_INTERVAL_SECONDS
+        if not interval or not self._trained_since_save:
+            return
+        if time.monotonic() - self._last_saved_at < interval:
+            return
+        print("Auto smelt saving the current session")
+        # 保存模型和训练共用模型 worker，不会与训练同时进行
+        self.training_job_service.training_worker.submit(
+            self.training_session_service.save_current_session
+        )
+        self._trained_since_save = False
+        self._last_saved_at = time.monotonic()
+        self.status["last_saved_at"] = datetime.now().isoformat()
+
+
+def parse_time_windows(spec: str) -> List[TimeWindow]:
+    """解析 "01:00-07:00,13:00-14:00" 形式的时段，结束时间早于开始时间表示跨过午夜。"""
+    windows = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            start, end = part.split("-")
+            windows.append(
+                (
+                    time_of_day.fromisoformat(start.strip()),
+                    time_of_day.fromisoformat(end.strip()),
+                )
+            )
+        except ValueError:
+            raise ValueError(f"Invalid time window: {part}")
+    return windows
+
+
+def in_time_windows(now: time_of_day, windows: List[TimeWindow]) -> bool:
+    for start, end in windows:
+        if start <= end:
+            if start <= now < end:
+                return True
+        elif now >= start or now < end:
+            return True
+    return False
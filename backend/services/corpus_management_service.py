@@ -27,6 +27,9 @@ class CorpusManagementService:
     def list_corpora(self, skip: int = 0, limit: int = 100) -> List[Corpus]:
         return self.corpus_repo.list(skip=skip, limit=limit)
 
+    def get_corpus(self, corpus_id: str) -> Optional[Corpus]:
+        return self.corpus_repo.get_by_id(corpus_id)
+
     def count_corpora(self) -> int:
         return self.corpus_repo.count()
 
@@ -1,6 +1,14 @@
-from typing import List
+import math
+import os
+import re
+import threading
+import time
+from typing import Callable, List, Optional, Set, Tuple
+import numpy as np
+from app.core.config import settings
 from domain.corpus import CorpusEntry
-from llm_manager import LLMManager
+from llm.token_corpus import CURRENT_FILE, TokenCorpus, TokenCorpusWriter
+from llm_manager import LLMManager, TrainingResult
 from repositories.corpus_entry.corpus_entry_repository import CorpusEntryRepository
 from services.training_loss_service import TrainingLossService
 from services.training_session_service import TrainingSessionService
@@ -18,24 +26,36 @@ class ModelTrainingService:
         self.corpus_entry_repo = corpus_entry_repo
         self.training_session_service = training_session_service
         self.training_loss_service = training_loss_service
+        self._scoring_lock = threading.Lock()
+        self.scoring_status = {"state": "idle"}
+        # smelt_token_corpus 当前一遍的顺序：导出版本、打乱后的语料下标和读到的位置
+        self._token_corpus_epoch: Optional[dict] = None
 
-    def _count_tokens(self, entry: CorpusEntry) -> int:
-        if entry.entry_type == "knowledge":
-            return len(self.llm_manager.tokenizer.encode(entry.content))
-        elif entry.entry_type == "chat":
-            return sum(
-                len(self.llm_manager.tokenizer.encode(msg["content"]))
-                for msg in entry.messages
-            )
-        else:
-            raise ValueError(f"Unknown entry type: {entry.entry_type}")
+    def count_new_entries(self, session_id: str) -> int:
+        """会话还没有训练过的语料数。
+
+        已训练、损失还没有随检查点写入数据库的语料不计入，与 sample_new_entries
+        能抽取的语料一致。
+        """
+        new_entries_count = self.training_loss_service.get_new_corpus_entries_count(
+            session_id, self.corpus_entry_repo.count()
+        )
+        return max(0, new_entries_count - len(self._with_pending_ids(None)))
 
-    def sample_new_entries(self, batch_size: int, session_id: str) -> List[CorpusEntry]:
+    def sample_new_entries(
+        self,
+        batch_size: int,
+        session_id: str,
+        exclude_ids: Optional[Set[str]] = None,
+    ) -> List[CorpusEntry]:
         # 前置检查：确保新语料数量大于 batch_size
         total_entries = self.corpus_entry_repo.count()
         new_entries_count = self.training_loss_service.get_new_corpus_entries_count(
             session_id, total_entries
         )
+        exclude_ids = self._with_pending_ids(exclude_ids)
+        # 排除的语料（包括损失还没有写入数据库的）也被算作新语料
+        new_entries_count -= len(exclude_ids)
 
         if new_entries_count < batch_size:
             raise ValueError(
@@ -43,56 +63,99 @@ class ModelTrainingService:
             )
 
         return self.corpus_entry_repo.sample_new_entries(
-            batch_size, total_entries, session_id
+            batch_size, total_entries, session_id, exclude_ids
         )
 
-    def smelt_new_corpus(self, batch_size: int = 16) -> dict:
+    def prepare_round(
+        self,
+        job_type: str,
+        batch_size: int,
+        exclude_ids: Optional[Set[str]] = None,
+    ) -> List[CorpusEntry]:
+        """为 smelt_new_corpus 或 smelt_new_old 的下一轮抽取新语料并预先分词。
+
+        可以在后台线程中与当前一轮的训练同时执行，exclude_ids 是当前一轮正在训练、
+        还没有记录损失的语料。复习用的旧语料依赖上一轮的损失，仍在训练开始时选取。
+        """
+        session = self.training_session_service.get_current_session()
+        assert session, "No active training session"
+        if job_type == "smelt_new_corpus":
+            entries = self.sample_new_entries(batch_size, session.id, exclude_ids)
+        elif job_type == "smelt_new_old":
+            entries = self.corpus_entry_repo.sample_new_entries(
+                int(batch_size / 2),
+                self.corpus_entry_repo.count(),
+                session.id,
+                self._with_pending_ids(exclude_ids),
+            )
+        else:
+            raise ValueError(f"Rounds of {job_type} cannot be prepared in advance")
+        # 写入分词缓存，训练开始时直接从内存中读取
+        self.llm_manager.warm_token_cache(entries)
+        return entries
+
+    def smelt_new_corpus(
+        self,
+        batch_size: int = 16,
+        on_step: Optional[Callable[[dict], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+        new_entries: Optional[List[CorpusEntry]] = None,
+    ) -> dict:
         assert (
             self.training_session_service.get_current_session()
         ), "No active training session"
         self.llm_manager._load_model_if_not_loaded(
             self.training_session_service.get_current_session().name
         )
-        # Randomly sample batch_size entries
-        selected_entries = self.sample_new_entries(
-            batch_size, self.training_session_service.get_current_session().id
-        )
-
-        total_tokens = sum(self._count_tokens(entry) for entry in selected_entries)
+        # Randomly sample batch_size entries（已经由 prepare_round 抽取时直接使用）
+        if new_entries is not None:
+            selected_entries = list(new_entries)
+        else:
+            selected_entries = self.sample_new_entries(
+                batch_size, self.training_session_service.get_current_session().id
+            )
 
         # Train the model
-        loss = self.llm_manager.train_on_entries(
-            self.training_session_service.get_current_session().name, selected_entries
+        result = self.llm_manager.train_on_entries(
+            self.training_session_service.get_current_session().name,
+            selected_entries,
+            on_step=on_step,
+            should_stop=should_stop,
         )
 
-        self.training_session_service.update_tokens_trained(total_tokens)
-
-        for entry in selected_entries:
-            self.training_loss_service.update_loss(
-                entry.id,
-                loss,
-                self.training_session_service.get_current_session(),
-            )
+        trained_entries, _ = self._record_round(selected_entries, result)
 
         return {
             "message": "New corpus smelting completed",
-            "loss": loss,
-            "entries_trained": len(selected_entries),
+            "loss": result.loss,
+            "entries_trained": len(trained_entries),
+            "entries_skipped": len(result.skipped_entry_ids),
+            "cancelled": result.cancelled,
         }
 
-    def smelt_new_old(self, batch_size: int = 16) -> dict:
+    def smelt_new_old(
+        self,
+        batch_size: int = 16,
+        on_step: Optional[Callable[[dict], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+        new_entries: Optional[List[CorpusEntry]] = None,
+    ) -> dict:
         assert (
             self.training_session_service.get_current_session()
         ), "No active training session"
         self.llm_manager._load_model_if_not_loaded(
             self.training_session_service.get_current_session().name
         )
-        # Randomly sample batch_size entries
-        selected_entries = self.corpus_entry_repo.sample_new_entries(
-            int(batch_size / 2),
-            self.corpus_entry_repo.count(),
-            self.training_session_service.get_current_session().id,
-        )
+        # Randomly sample batch_size entries（已经由 prepare_round 抽取时直接使用）
+        if new_entries is not None:
+            selected_entries = list(new_entries)
+        else:
+            selected_entries = self.corpus_entry_repo.sample_new_entries(
+                int(batch_size / 2),
+                self.corpus_entry_repo.count(),
+                self.training_session_service.get_current_session().id,
+                self._with_pending_ids(None),
+            )
 
         if len(selected_entries) < int(batch_size / 2):
             highest_loss_entries = self.training_loss_service.get_highest_loss_entries(
@@ -101,7 +164,8 @@ class ModelTrainingService:
             )
             selected_entries += highest_loss_entries
 
-        total_tokens = sum(self._count_tokens(entry) for entry in selected_entries)
+        # 复习的低损失语料不计入已训练的 token 数
+        counted_entries = list(selected_entries)
 
         lowest_loss_entries = self.training_loss_service.get_lowest_loss_entries(
             self.training_session_service.get_current_session().id,
@@ -110,26 +174,98 @@ class ModelTrainingService:
         selected_entries += lowest_loss_entries
 
         # Train the model
-        loss = self.llm_manager.train_on_entries(
-            self.training_session_service.get_current_session().name, selected_entries
+        result = self.llm_manager.train_on_entries(
+            self.training_session_service.get_current_session().name,
+            selected_entries,
+            on_step=on_step,
+            should_stop=should_stop,
         )
 
-        self.training_session_service.update_tokens_trained(total_tokens)
-
-        for entry in selected_entries:
-            self.training_loss_service.update_loss(
-                entry.id,
-                loss,
-                self.training_session_service.get_current_session(),
-            )
+        trained_entries, _ = self._record_round(
+            selected_entries, result, counted_entries
+        )
 
         return {
             "message": "New corpus smelting completed",
-            "loss": loss,
-            "entries_trained": len(selected_entries),
+            "loss": result.loss,
+            "entries_trained": len(trained_entries),
+            "entries_skipped": len(result.skipped_entry_ids),
+            "cancelled": result.cancelled,
+        }
+
+    def smelt_token_corpus(
+        self,
+        batch_size: int = 16,
+        on_step: Optional[Callable[[dict], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+        new_entries: Optional[List[CorpusEntry]] = None,
+    ) -> dict:
+        """用 build_token_corpus 导出的全部语料（TOKEN_CORPUS_DIR/all）训练一轮。
+
+        按打乱的顺序依次取 batch_size 条，取完一遍后重新打乱开始下一遍；重新导出
+        后从新版本的第一遍开始。不区分新旧语料，也不读取语料对象。
+        """
+        session = self.training_session_service.get_current_session()
+        assert session, "No active training session"
+        path = os.path.join(settings.TOKEN_CORPUS_DIR, "all")
+        if not os.path.exists(os.path.join(path, CURRENT_FILE)):
+            raise ValueError("Token corpus has not been built, build it first")
+        corpus = TokenCorpus(path)
+        if len(corpus) == 0:
+            raise ValueError("Token corpus is empty")
+
+        epoch = self._token_corpus_epoch
+        if (
+            epoch is None
+            or epoch["generation"] != corpus.generation
+            or epoch["position"] >= len(epoch["order"])
+        ):
+            epoch = self._token_corpus_epoch = {
+                "generation": corpus.generation,
+                "order": np.random.permutation(len(corpus)),
+                "position": 0,
+                "epoch": (
+                    epoch["epoch"] + 1
+                    if epoch is not None and epoch["generation"] == corpus.generation
+                    else 1
+                ),
+            }
+        indices = epoch["order"][epoch["position"] : epoch["position"] + batch_size]
+        epoch["position"] += len(indices)
+
+        result = self.llm_manager.train_on_token_corpus(
+            session.name,
+            corpus,
+            indices.tolist(),
+            on_step=on_step,
+            should_stop=should_stop,
+        )
+
+        # 只记录实际训练过的语料，token 数取自导出的长度
+        lengths = corpus.lengths()
+        tokens = sum(
+            int(lengths[idx])
+            for idx in indices
+            if corpus.entry_id(int(idx)) in result.entry_losses
+        )
+        self.training_session_service.record_round(result.entry_losses, tokens)
+
+        return {
+            "message": "Token corpus smelting completed",
+            "loss": result.loss,
+            "entries_trained": len(result.entry_losses),
+            "entries_skipped": len(result.skipped_entry_ids),
+            "cancelled": result.cancelled,
+            "epoch": epoch["epoch"],
+            "epoch_progress": epoch["position"] / len(epoch["order"]),
         }
 
-    def train_single_entry(self, entry_id: str) -> dict:
+    def train_single_entry(
+        self,
+        entry_id: str,
+        on_step: Optional[Callable[[dict], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ) -> dict:
         assert (
             self.training_session_service.get_current_session()
         ), "No active training session"
@@ -143,24 +279,201 @@ class ModelTrainingService:
             raise ValueError(f"Corpus entry with id {entry_id} not found")
 
         # 训练模型
-        loss = self.llm_manager.train_on_entries(
-            self.training_session_service.get_current_session().name, [entry]
+        result = self.llm_manager.train_on_entries(
+            self.training_session_service.get_current_session().name,
+            [entry],
+            on_step=on_step,
+            should_stop=should_stop,
         )
 
-        # 更新已训练的token数量
-        tokens_count = self._count_tokens(entry)
-        self.training_session_service.update_tokens_trained(tokens_count)
-
-        # 更新训练损失
-        self.training_loss_service.update_loss(
-            entry.id,
-            loss,
-            self.training_session_service.get_current_session(),
-        )
+        # 更新已训练的token数量和训练损失
+        _, tokens_count = self._record_round([entry], result)
 
         return {
             "message": "Single entry training completed",
-            "loss": loss,
+            # 因内存不足被跳过时为 None
+            "loss": result.entry_losses.get(entry.id),
             "entry_id": entry_id,
             "tokens_trained": tokens_count,
         }
+
+    def _record_round(
+        self,
+        entries: List[CorpusEntry],
+        result: TrainingResult,
+        counted_entries: Optional[List[CorpusEntry]] = None,
+    ) -> Tuple[List[CorpusEntry], int]:
+        """记录一轮训练的结果：已训练的 token 数（只统计 counted_entries，默认是
+        全部语料）和每条语料的损失。
+
+        只记录 result.entry_losses 中实际训练过的语料；因内存不足被跳过或本轮被
+        中止时没有训练到的语料仍然算作新语料。返回记录了损失的语料和 token 数。
+        """
+        entries = [entry for entry in entries if entry.id in result.entry_losses]
+        trained_ids = {entry.id for entry in entries}
+        counted_entries = entries if counted_entries is None else counted_entries
+        # token 数与训练时的分词一致（套用对话模板），直接读取分词缓存
+        tokens = sum(
+            self.llm_manager.count_tokens(
+                [entry for entry in counted_entries if entry.id in trained_ids]
+            )
+        )
+        # 损失随下一个检查点写入数据库
+        entry_losses = {entry.id: result.entry_losses[entry.id] for entry in entries}
+        self.training_session_service.record_round(entry_losses, tokens)
+        return entries, tokens
+
+    def _with_pending_ids(self, exclude_ids: Optional[Set[str]]) -> Set[str]:
+        """加上已训练、损失还没有写入数据库的语料，它们不应再被当作新语料抽取。"""
+        pending_ids = self.training_session_service.get_pending_entry_ids()
+        return set(exclude_ids or ()) | pending_ids
+
+    def score_entries(self, entry_ids: List[str]) -> dict:
+        """不训练，只计算指定语料在当前模型上的损失，并写入训练损失记录。
+
+        评估写入的记录不算作训练过，这些语料仍然是新语料。
+        """
+        session = self.training_session_service.get_current_session()
+        assert session, "No active training session"
+
+        entries = self.corpus_entry_repo.get_entries_by_ids(entry_ids)
+        found_ids = {entry.id for entry in entries}
+        missing_ids = [entry_id for entry_id in entry_ids if entry_id not in found_ids]
+        if missing_ids:
+            raise ValueError(f"Corpus entries not found: {missing_ids}")
+
+        losses = self._score_and_record(session, entries)
+        return {
+            "message": "Scoring completed",
+            "entries_scored": len(losses),
+            "losses": {
+                entry_id: {"loss": loss, "perplexity": _perplexity(loss)}
+                for entry_id, loss in losses.items()
+            },
+        }
+
+    def score_corpus(self, corpus_id: Optional[str] = None) -> dict:
+        """分页评估整个语料库（不指定 corpus_id 时评估全部语料），进度记录在 scoring_status。"""
+        session = self.training_session_service.get_current_session()
+        assert session, "No active training session"
+        if not self._scoring_lock.acquire(blocking=False):
+            raise ValueError("A scoring job is already running")
+
+        try:
+            total = self.corpus_entry_repo.count()
+            self.scoring_status = {
+                "state": "running",
+                "corpus_id": corpus_id,
+                "session_id": session.id,
+                "total_entries": total if corpus_id is None else None,
+                "entries_scored": 0,
+                "mean_loss": None,
+                "started_at": time.time(),
+            }
+            loss_sum = 0.0
+            skip = 0
+            page_size = settings.SCORE_PAGE_SIZE
+            while True:
+                if corpus_id is None:
+                    entries = self.corpus_entry_repo.list_all(skip, page_size)
+                else:
+                    entries = self.corpus_entry_repo.list_by_corpus(
+                        corpus_id, skip, page_size
+                    )
+                if not entries:
+                    break
+                losses = self._score_and_record(session, entries)
+                loss_sum += sum(losses.values())
+                self.scoring_status["entries_scored"] += len(losses)
+                self.scoring_status["mean_loss"] = (
+                    loss_sum / self.scoring_status["entries_scored"]
+                )
+                skip += page_size
+
+            self.scoring_status["state"] = "completed"
+            self.scoring_status["finished_at"] = time.time()
+            return dict(self.scoring_status)
+        except Exception as e:
+            self.scoring_status["state"] = "failed"
+            self.scoring_status["error"] = str(e)
+            raise
+        finally:
+            self._scoring_lock.release()
+
+    def warm_token_cache(self, corpus_id: Optional[str] = None) -> dict:
+        """分页为语料库（不指定 corpus_id 时为全部语料）预先分词，写入分词缓存。"""
+        session = self.training_session_service.get_current_session()
+        assert session, "No active training session"
+        self.llm_manager._load_model_if_not_loaded(session.name)
+
+        entries_seen = 0
+        entries_tokenized = 0
+        skip = 0
+        page_size = settings.SCORE_PAGE_SIZE
+        while True:
+            if corpus_id is None:
+                entries = self.corpus_entry_repo.list_all(skip, page_size)
+            else:
+                entries = self.corpus_entry_repo.list_by_corpus(
+                    corpus_id, skip, page_size
+                )
+            if not entries:
+                break
+            entries_tokenized += self.llm_manager.warm_token_cache(entries)
+            entries_seen += len(entries)
+            skip += page_size
+
+        return {
+            "message": "Token cache warmed",
+            "entries": entries_seen,
+            "entries_tokenized": entries_tokenized,
+            "cache": self.llm_manager.get_token_cache_stats(),
+        }
+
+    def build_token_corpus(self, corpus_id: Optional[str] = None) -> dict:
+        """把语料库（不指定 corpus_id 时为全部语料）导出成 mmap 格式的 token 文件。
+
+        分词结果来自分词缓存，导出到 TOKEN_CORPUS_DIR 下以语料库 id 命名的目录。
+        corpus_id 只能包含字母、数字、下划线和连字符，不能指向其他目录。
+        """
+        dir_name = corpus_id or "all"
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", dir_name):
+            raise ValueError(f"Invalid corpus id: {corpus_id}")
+        session = self.training_session_service.get_current_session()
+        assert session, "No active training session"
+        self.llm_manager._load_model_if_not_loaded(session.name)
+
+        path = os.path.join(settings.TOKEN_CORPUS_DIR, dir_name)
+        os.makedirs(path, exist_ok=True)
+        writer = TokenCorpusWriter(path, self.llm_manager.tokenizer_fingerprint())
+        skip = 0
+        page_size = settings.SCORE_PAGE_SIZE
+        while True:
+            if corpus_id is None:
+                entries = self.corpus_entry_repo.list_all(skip, page_size)
+            else:
+                entries = self.corpus_entry_repo.list_by_corpus(
+                    corpus_id, skip, page_size
+                )
+            if not entries:
+                break
+            writer.add(entries, self.llm_manager.tokenize_entries(entries))
+            skip += page_size
+        meta = writer.close()
+
+        return {"message": "Token corpus built", "path": path, **meta}
+
+    def get_scoring_status(self) -> dict:
+        return dict(self.scoring_status)
+
+    def _score_and_record(self, session, entries: List[CorpusEntry]) -> dict:
+        losses = self.llm_manager.score_entries(session.name, entries)
+        for entry_id, loss in losses.items():
+            self.training_loss_service.update_loss(
+                entry_id, loss, session, trained=False
+            )
+        return losses
+
+
+def _perplexity(loss: float) -> float:
+    return math.exp(min(loss, 50.0))
@@ -0,0 +1,114 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+
+class WorkerOverloadedError(Exception):
+    """队列已满，请求被拒绝。"""
+
+
+class DeadlineExceededError(Exception):
+    """请求在截止时间之前没有完成。"""
+
+
+@dataclass
+class _WorkItem:
+    fn: Callable
+    args: tuple
+    kwargs: dict
+    future: Future
+    deadline: Optional[float]
+
+
+class ModelWorker:
+    """在专用线程上执行模型相关的阻塞任务，API 层通过有界队列提交任务。
+
+    队列满时立即拒绝（由 API 层转换为 429），等待执行的任务如果超过了截止
+    时间则不再执行。已经开始执行的任务不会被中断。
+    """
+
+    def __init__(self, name: str, max_queue_size: int, num_threads: int = 1):
+        self.name = name
+        self._queue: "queue.Queue[_WorkItem]" = queue.Queue(maxsize=max_queue_size)
+        self._running = 0
+        # 最近一次开始或结束任务的时间，用于判断 worker 空闲了多久
+        self._last_active = time.monotonic()
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+            for i in range(num_threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(
+        self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs
+    ) -> Future:
+        deadline = time.monotonic() + timeout if timeout else None
+        item = _WorkItem(fn, args, kwargs, Future(), deadline)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            raise WorkerOverloadedError(
+                f"{self.name} worker is busy, {self._queue.qsize()} requests queued"
+            )
+        return item.future
+
+    async def run(
+        self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs
+    ) -> Any:
+        """提交任务并在事件循环中等待结果，不阻塞其他请求。"""
+        future = self.submit(fn, *args, timeout=timeout, **kwargs)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            raise DeadlineExceededError(
+                f"{self.name} request did not finish within {timeout} seconds"
+            )
+
+    def idle_seconds(self) -> float:
+        """没有正在执行或排队的任务的时长；忙碌时返回 0。"""
+        with self._lock:
+            if self._running or self._queue.qsize():
+                return 0.0
+            return time.monotonic() - self._last_active
+
+    def stats(self) -> dict:
+        with self._lock:
+            running = self._running
+        return {
+            "name": self.name,
+            "queued": self._queue.qsize(),
+            "running": running,
+            "max_queue_size": self._queue.maxsize,
+            "idle_seconds": self.idle_seconds(),
+        }
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if not item.future.set_running_or_notify_cancel():
+                continue
+            if item.deadline is not None and time.monotonic() > item.deadline:
+                item.future.set_exception(
+                    DeadlineExceededError(
+                        f"{self.name} request expired before it could start"
+                    )
+                )
+                continue
+
+            with self._lock:
+                self._running += 1
+                self._last_active = time.monotonic()
+            try:
+                item.future.set_result(item.fn(*item.args, **item.kwargs))
+            except BaseException as e:
+                item.future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._last_active = time.monotonic()
@@ -0,0 +1,218 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Iterator, List, Optional
+from app.core.config import settings
+from domain.corpus import CorpusEntry
+from domain.training_job import PREPARABLE_JOB_TYPES, TrainingJob
+from services.model_training_service import ModelTrainingService
+from services.model_worker import ModelWorker
+from services.training_session_service import TrainingSessionService
+from utils.id_generator import IdGenerator
+
+
+class TrainingJobService:
+    """在训练 worker 上排队执行训练任务，记录进度，支持在优化器步骤之间取消。
+
+    任务只保存在内存中，最多保留最近 TRAINING_JOB_HISTORY 个已结束的任务。
+    多轮任务在训练当前一轮时，由后台线程抽取并分词下一轮的语料。
+    """
+
+    def __init__(
+        self,
+        model_training_service: ModelTrainingService,
+        training_session_service: TrainingSessionService,
+        training_worker: ModelWorker,
+    ):
+        self.model_training_service = model_training_service
+        self.training_session_service = training_session_service
+        self.training_worker = training_worker
+        self.jobs: "OrderedDict[str, TrainingJob]" = OrderedDict()
+        # 任务状态的每次变化都会通知订阅者
+        self._changed = threading.Condition()
+        # 数据库查询和分词大部分时间不持有 GIL，可以与训练同时进行
+        self._prefetch_pool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="round-prefetch"
+        )
+
+    def submit_job(
+        self,
+        job_type: str,
+        rounds: int = 1,
+        batch_size: int = 16,
+        entry_id: Optional[str] = None,
+    ) -> TrainingJob:
+        session = self.training_session_service.get_current_session()
+        if not session:
+            raise ValueError("No active training session")
+        job = TrainingJob(
+            id=IdGenerator.generate(),
+            job_type=job_type,
+            session_id=session.id,
+            rounds=rounds,
+            batch_size=batch_size,
+            entry_id=entry_id,
+        )
+        # 队列已满时 submit 抛出 WorkerOverloadedError，任务不会被记录
+        self.training_worker.submit(self._run_job, job)
+        with self._changed:
+            self.jobs[job.id] = job
+            self._prune()
+        return job
+
+    def get_job(self, job_id: str) -> TrainingJob:
+        with self._changed:
+            job = self.jobs.get(job_id)
+        if not job:
+            raise ValueError(f"Job with id {job_id} not found")
+        return job
+
+    def has_active_job(self) -> bool:
+        with self._changed:
+            return any(not job.is_finished for job in self.jobs.values())
+
+    def list_jobs(self) -> List[TrainingJob]:
+        with self._changed:
+            return list(reversed(self.jobs.values()))
+
+    def cancel_job(self, job_id: str) -> TrainingJob:
+        """排队中的任务直接取消；运行中的任务在下一次优化器步骤之后停止。"""
+        job = self.get_job(job_id)
+        with self._changed:
+            if job.is_finished:
+                return job
+            job.cancel_requested = True
+            if job.status == "queued":
+                self._finish(job, "cancelled")
+            else:
+                self._notify(job)
+        return job
+
+    def watch_job(self, job_id: str, timeout: float = 15.0) -> Iterator[Optional[dict]]:
+        """任务状态每次变化时产生一个快照，任务结束后停止。
+
+        超过 timeout 秒没有变化时产生 None，调用方可以借此发送心跳。
+        """
+        job = self.get_job(job_id)
+        version = -1
+        while True:
+            with self._changed:
+                if job.version == version:
+                    self._changed.wait(timeout)
+                if job.version == version:
+                    snapshot = None
+                else:
+                    version = job.version
+                    snapshot = job_snapshot(job)
+                finished = job.is_finished
+            yield snapshot
+            if finished:
+                return
+
+    def _run_job(self, job: TrainingJob):
+        with self._changed:
+            if job.is_finished:
+                return
+            job.status = "running"
+            job.started_at = datetime.now()
+            self._notify(job)
+
+        try:
+            session = self.training_session_service.get_current_session()
+            if not session or session.id != job.session_id:
+                raise ValueError("The training session changed before the job started")
+            prefetch = (
+                settings.TRAIN_PREFETCH_NEXT_ROUND
+                and job.job_type in PREPARABLE_JOB_TYPES
+                and job.rounds > 1
+            )
+            entries: Optional[List[CorpusEntry]] = None
+            while job.rounds_completed < job.rounds and not job.cancel_requested:
+                if prefetch and entries is None:
+                    entries = self.model_training_service.prepare_round(
+                        job.job_type, job.batch_size
+                    )
+                next_round = None
+                if prefetch and job.rounds_completed + 1 < job.rounds:
+                    next_round = self._prefetch_pool.submit(
+                        self.model_training_service.prepare_round,
+                        job.job_type,
+                        job.batch_size,
+                        {entry.id for entry in entries},
+                    )
+                result = self._run_round(job, entries)
+                with self._changed:
+                    job.results.append(result)
+                    if not result.get("cancelled"):
+                        job.rounds_completed += 1
+                    self._notify(job)
+                entries = _prefetched(next_round)
+            status = "cancelled" if job.cancel_requested else "completed"
+        except Exception as e:
+            print(f"Training job {job.id} failed: {e}")
+            job.error = str(e)
+            status = "failed"
+
+        with self._changed:
+            self._finish(job, status)
+
+    def _run_round(
+        self, job: TrainingJob, entries: Optional[List[CorpusEntry]] = None
+    ) -> dict:
+        def on_step(progress: dict):
+            with self._changed:
+                job.progress = {"round": job.rounds_completed + 1, **progress}
+                self._notify(job)
+
+        def should_stop() -> bool:
+            return job.cancel_requested
+
+        if job.job_type == "train_single_entry":
+            return self.model_training_service.train_single_entry(
+                job.entry_id, on_step=on_step, should_stop=should_stop
+            )
+        run_round = getattr(self.model_training_service, job.job_type)
+        return run_round(
+            job.batch_size,
+            on_step=on_step,
+            should_stop=should_stop,
+            new_entries=entries,
+        )
+
+    def _finish(self, job: TrainingJob, status: str):
+        job.status = status
+        job.finished_at = datetime.now()
+        self._notify(job)
+
+    def _notify(self, job: TrainingJob):
+        job.version += 1
+        self._changed.notify_all()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.is_finished]
+        for job_id in finished[: max(0, len(finished) - settings.TRAINING_JOB_HISTORY)]:
+            del self.jobs[job_id]
+
+
+def _prefetched(future: Optional[Future]) -> Optional[List[CorpusEntry]]:
+    """后台准备好的下一轮语料；准备失败时返回 None，由下一轮重新同步抽取。"""
+    if future is None:
+        return None
+    try:
+        return future.result()
+    except Exception as e:
+        print(f"Prefetching the next round failed: {e}")
+        return None
+
+
+def job_snapshot(job: TrainingJob) -> dict:
+    return {
+        "id": job.id,
+        "job_type": job.job_type,
+        "status": job.status,
+        "rounds": job.rounds,
+        "rounds_completed": job.rounds_completed,
+        "progress": dict(job.progress),
+        "error": job.error,
+    }
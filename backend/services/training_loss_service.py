@@ -23,6 +23,7 @@ class TrainingLossService:
         corpus_entry_id: str,
         loss: float,
         session: TrainingSession,
+        trained: bool = True,
     ):
         training_loss = TrainingLoss(
             id=IdGenerator.generate(),
@@ -31,6 +32,7 @@ class TrainingLossService:
             timestamp=datetime.now(),
             loss_value=loss,
             loss_rank=TrainingLoss.calculate_loss_rank(loss),
+            trained=trained,
         )
         self.training_loss_repo.save(training_loss)
 
@@ -72,12 +74,12 @@ class TrainingLossService:
         return distribution
 
     def count_trained_entries_for_session(self, session_id: str) -> int:
-        return self.training_loss_repo.count_by_session_id(session_id)
+        return self.training_loss_repo.count_trained_by_session_id(session_id)
 
     def get_new_corpus_entries_count(
         self, session_id: str, total_corpus_entries: int
     ) -> int:
-        trained_entries_count = self.training_loss_repo.count_by_session_id(session_id)
+        trained_entries_count = self.training_loss_repo.count_trained_by_session_id(session_id)
         return max(0, total_corpus_entries - trained_entries_count)
 
     def get_highest_loss_entries(
@@ -1,59 +1,210 @@
-from typing import List, Optional, Set
+import threading
+import time
+from typing import Dict, List, Optional, Set
 from datetime import datetime
+from app.core.config import settings
 from domain.corpus import CorpusEntry
 from domain.training_session import TrainingSession
+from llm.training_state import restore_rng_state
 from llm_manager import LLMManager
 from repositories.training_session.training_session_repository import (
     TrainingSessionRepository,
 )
+from services.training_loss_service import TrainingLossService
 from utils.id_generator import IdGenerator
 
 
 class TrainingSessionService:
+    """管理当前训练会话。
+
+    每轮训练的损失先记在 pending_losses 中，与模型权重一起写入检查点之后才写入
+    数据库，数据库中的训练记录不会领先于已保存的模型。进程中途退出时，从最新
+    检查点恢复的会话与数据库一致，没有保存的那几轮语料仍然算作新语料。
+    """
+
     def __init__(
-        self, session_repo: TrainingSessionRepository, llm_manager: LLMManager
+        self,
+        session_repo: TrainingSessionRepository,
+        llm_manager: LLMManager,
+        training_loss_service: TrainingLossService,
     ):
         self.session_repo = session_repo
         self.current_session: Optional[TrainingSession] = None
         self.llm_manager = llm_manager
+        self.training_loss_service = training_loss_service
+        # 当前会话已训练、还没有随检查点保存的语料损失 {语料 id: 损失}
+        self.pending_losses: Dict[str, float] = {}
+        self._pending_lock = threading.Lock()
+        # 距上一个检查点训练的轮数和时间，决定 record_round 何时写入检查点
+        self._rounds_since_checkpoint = 0
+        self._last_checkpoint_time = time.monotonic()
 
-    def create_session(self, name: str, base_model: str) -> TrainingSession:
-        assert self.current_session is None, "There is already an active session"
+    def create_session(
+        self,
+        name: str,
+        base_model: str,
+        training_mode: str = "full",
+        lora_config: Optional[dict] = None,
+    ) -> TrainingSession:
+        # 先构造会话，training_mode 不合法时在创建任何东西之前就报错
         session = TrainingSession(
             id=IdGenerator.generate(),
             name=name,
             base_model=base_model,
             start_time=datetime.now(),
             last_trained=datetime.now(),
+            training_mode=training_mode,
+            lora_config=lora_config or {},
         )
+        self._leave_current_session()
         created_session = self.session_repo.create(session)
         self.current_session = created_session
-        self.llm_manager.init_new_model(created_session.base_model)
+        self.llm_manager.init_new_model(
+            created_session.base_model,
+            created_session.name,
+            lora_config=(
+                created_session.lora_config
+                if created_session.training_mode == "lora"
+                else None
+            ),
+        )
         self.llm_manager.save_model(created_session)
         return created_session
 
     def load_session(self, session_id: str) -> TrainingSession:
-        assert self.current_session is None, "There is already an active session"
         session = self.session_repo.get_by_id(session_id)
         if not session:
             raise ValueError(f"Session with id {session_id} not found")
+        if self.current_session and self.current_session.id == session.id:
+            return self.current_session
+        self._leave_current_session()
+        # 切换到该会话的模型（已在注册表中则不需要重新加载）
+        self.llm_manager.activate_session(session.name)
+        self._restore_training_state(session)
         self.current_session = session
         return session
 
+    def _restore_training_state(self, session: TrainingSession):
+        """按最新检查点中的训练状态恢复计数器和随机数状态，补写检查点中的损失。
+
+        session_info.json 中的计数可能领先于检查点（之后的几轮没有保存），以检查点
+        为准。损失按 (语料, 会话) 覆盖写入，重复补写没有副作用。
+        """
+        state = self.llm_manager.load_training_state(session.name)
+        if state is None:
+            return
+        session.tokens_trained = state["tokens_trained"]
+        session.rounds_trained = state["rounds_trained"]
+        restore_rng_state(state["rng"])
+        self._write_losses(session, state["pending_losses"])
+        self.session_repo.update(session)
+
+    def load_startup_session(self) -> Optional[TrainingSession]:
+        """启动时加载的会话：STARTUP_SESSION_ID 指定的会话，否则是最近训练过的会话。"""
+        if self.current_session:
+            return self.current_session
+        if settings.STARTUP_SESSION_ID:
+            return self.load_session(settings.STARTUP_SESSION_ID)
+        sessions = self.session_repo.list_sessions()
+        if not sessions:
+            return None
+        latest_session = max(sessions, key=lambda session: session.last_trained)
+        return self.load_session(latest_session.id)
+
+    def _leave_current_session(self):
+        # 离开当前会话时只保存会话信息；模型留在注册表中，被淘汰前会自动保存。
+        # 还有没保存的损失时先写检查点，淘汰时的保存不带训练状态
+        if self.current_session:
+            if self.pending_losses:
+                self.llm_manager.checkpoint_model(
+                    self.current_session, *self._training_state()
+                )
+                # 这些损失由检查点写入之后的回调写入数据库
+                with self._pending_lock:
+                    self.pending_losses = {}
+            self.session_repo.update(self.current_session)
+            self.current_session = None
+
     def save_current_session(self):
         if not self.current_session:
             raise ValueError("No active training session")
         # Save the session to the repository
         self.session_repo.update(self.current_session)
         # Save the model using LLMManager
-        self.llm_manager.save_model(self.current_session)
+        self.llm_manager.save_model(self.current_session, *self._training_state())
         return self.current_session
 
+    def checkpoint_current_session(self):
+        """只写入检查点，不重建对话模型，每轮训练之后使用。"""
+        if not self.current_session:
+            raise ValueError("No active training session")
+        self.session_repo.update(self.current_session)
+        self.llm_manager.checkpoint_model(self.current_session, *self._training_state())
+        return self.current_session
+
+    def record_round(self, entry_losses: Dict[str, float], tokens: int):
+        """记录一轮训练：累加计数并立即写入会话信息，损失等到检查点写入后再写入数据库。"""
+        if not self.current_session:
+            raise ValueError("No active training session")
+        self.current_session.tokens_trained += tokens
+        self.current_session.rounds_trained += 1
+        self.current_session.last_trained = datetime.now()
+        with self._pending_lock:
+            self.pending_losses.update(entry_losses)
+        self.session_repo.update(self.current_session)
+        self._rounds_since_checkpoint += 1
+        if self._checkpoint_due():
+            self.checkpoint_current_session()
+
+    def _checkpoint_due(self) -> bool:
+        every_rounds = settings.CHECKPOINT_EVERY_ROUNDS
+        every_seconds = settings.CHECKPOINT_EVERY_SECONDS
+        return (every_rounds > 0 and self._rounds_since_checkpoint >= every_rounds) or (
+            every_seconds > 0
+            and time.monotonic() - self._last_checkpoint_time >= every_seconds
+        )
+
+    def get_pending_entry_ids(self) -> Set[str]:
+        with self._pending_lock:
+            return set(self.pending_losses)
+
+    def _training_state(self):
+        """随检查点保存的训练状态，以及检查点写入之后把其中的损失写入数据库的回调。
+
+        每次写入检查点时调用，检查点的间隔从这里重新计算。
+        """
+        session = self.current_session
+        self._rounds_since_checkpoint = 0
+        self._last_checkpoint_time = time.monotonic()
+        with self._pending_lock:
+            losses = dict(self.pending_losses)
+        state = {
+            "tokens_trained": session.tokens_trained,
+            "rounds_trained": session.rounds_trained,
+            "pending_losses": losses,
+        }
+
+        def on_saved():
+            self._write_losses(session, losses)
+            with self._pending_lock:
+                # 写入期间又训练过的语料保留较新的损失，等下一个检查点
+                for entry_id, loss in losses.items():
+                    if self.pending_losses.get(entry_id) == loss:
+                        del self.pending_losses[entry_id]
+
+        return state, on_saved
+
+    def _write_losses(self, session: TrainingSession, losses: Dict[str, float]):
+        for entry_id, loss in losses.items():
+            self.training_loss_service.update_loss(entry_id, loss, session)
+
     def get_current_session(self) -> Optional[TrainingSession]:
         return self.current_session
 
     def end_current_session(self) -> None:
         if self.current_session:
+            if self.pending_losses:
+                self.save_current_session()
             self.current_session.end_session()
             self.session_repo.update(self.current_session)
             self.current_session = None
@@ -71,3 +222,4 @@ class TrainingSessionService:
         if not self.current_session:
             raise ValueError("No active training session")
         self.current_session.tokens_trained += new_tokens
+        self.session_repo.update(self.current_session)
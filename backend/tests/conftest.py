@@ -0,0 +1,111 @@
+from datetime import datetime
+import pytest
+import torch
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import WhitespaceSplit
+from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2ForCausalLM
+from app.core.config import settings
+from domain.corpus import CorpusEntry
+from domain.training_session import TrainingSession
+from llm_manager import LLMManager
+
+
+def _tiny_model(seed: int = 0) -> Qwen2ForCausalLM:
+    torch.manual_seed(seed)
+    config = Qwen2Config(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        eos_token_id=0,
+    )
+    return Qwen2ForCausalLM(config).eval()
+
+
+def _tiny_tokenizer() -> PreTrainedTokenizerFast:
+    # 与 _tiny_model 的词表一致：0 是 eos，其余 token 写作 t<id>
+    vocab = {"<eos>": 0, "<unk>": 1}
+    vocab.update({f"t{i}": i for i in range(2, 64)})
+    backend = Tokenizer(WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = WhitespaceSplit()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        eos_token="<eos>",
+        unk_token="<unk>",
+        clean_up_tokenization_spaces=False,
+    )
+    tokenizer.chat_template = (
+        "{% for message in messages %}{{ message['content'] }} {% endfor %}"
+    )
+    return tokenizer
+
+
+def _entry(content: str) -> CorpusEntry:
+    return CorpusEntry(
+        id=f"id-{content}",
+        corpus="c",
+        entry_type="knowledge",
+        created_at=datetime.now(),
+        content=content,
+    )
+
+
+def _session(name: str = "session") -> TrainingSession:
+    return TrainingSession(
+        id=name,
+        name=name,
+        base_model="base",
+        start_time=datetime.now(),
+        last_trained=datetime.now(),
+    )
+
+
+@pytest.fixture
+def make_tiny_model():
+    """随机初始化的很小的 Qwen2 模型（eval 模式），种子相同时权重相同。"""
+    return _tiny_model
+
+
+@pytest.fixture
+def tiny_model():
+    return _tiny_model()
+
+
+@pytest.fixture
+def tiny_tokenizer():
+    """与 tiny_model 配套的分词器，按空格切分，带简单的对话模板。"""
+    return _tiny_tokenizer()
+
+
+@pytest.fixture
+def make_entry():
+    """内容为 content、id 为 id-<content> 的语料。"""
+    return _entry
+
+
+@pytest.fixture
+def make_session():
+    """id 和名字都是 name 的训练会话。"""
+    return _session
+
+
+@pytest.fixture
+def tiny_llm_manager(tiny_model, tiny_tokenizer, tmp_path, monkeypatch):
+    """当前会话为 session、模型为 tiny_model 的 LLMManager，不使用分词缓存。
+
+    工作目录切换到 tmp_path，会话目录是其中的 ./trained/session。
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(settings, "TOKEN_CACHE_ENABLED", False)
+    manager = LLMManager()
+    manager._activate_loaded_model(
+        "session",
+        manager._get_model_dir_from_session_name("session"),
+        tiny_model,
+        tiny_tokenizer,
+        quantize=False,
+    )
+    return manager
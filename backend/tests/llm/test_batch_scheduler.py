@@ -0,0 +1,123 @@
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+import torch
+from llm.batch_scheduler import BatchScheduler
+from llm.snapshot import InferenceSnapshot
+
+
+def _greedy(model, prompt, max_new_tokens):
+    expected = model.generate(
+        prompt.unsqueeze(0),
+        attention_mask=torch.ones(1, len(prompt), dtype=torch.long),
+        max_new_tokens=max_new_tokens,
+        do_sample=False,
+        pad_token_id=0,
+    )[0][len(prompt) :].tolist()
+    return [token for token in expected if token != 0]
+
+
+def test_batched_greedy_decoding_matches_generate(tiny_model):
+    model = tiny_model
+    tokenizer = SimpleNamespace(eos_token_id=0)
+
+    @contextmanager
+    def acquire_model():
+        yield model
+
+    scheduler = BatchScheduler(
+        acquire_model, tokenizer, max_batch_size=4, top_k=1, top_p=1.0
+    )
+    prompts = [
+        torch.tensor([5, 6, 7]),
+        torch.tensor([8, 9, 10, 11, 12, 13, 14]),
+        torch.tensor([15, 16]),
+    ]
+    try:
+        futures = [scheduler.submit(prompt, max_new_tokens=12) for prompt in prompts]
+        results = [future.result(timeout=60) for future in futures]
+    finally:
+        scheduler.stop()
+
+    for prompt, generated in zip(prompts, results):
+        assert generated == _greedy(model, prompt, 12)
+
+
+def test_in_flight_requests_finish_on_the_model_they_started_with(make_tiny_model):
+    old_model, new_model = make_tiny_model(0), make_tiny_model(1)
+    current = [old_model]
+
+    @contextmanager
+    def acquire_model():
+        yield current[0]
+
+    scheduler = BatchScheduler(
+        acquire_model, SimpleNamespace(eos_token_id=0), top_k=1, top_p=1.0
+    )
+    first_prompt, second_prompt = torch.tensor([5, 6, 7]), torch.tensor([8, 9])
+    futures = []
+
+    class SwapOnFirstToken:
+        def __init__(self):
+            self.tokens = 0
+
+        def put(self, value):
+            self.tokens += 1
+            if self.tokens == 2:
+                # 第一个请求生成第一个 token 后换模型，并提交第二个请求
+                current[0] = new_model
+                futures.append(scheduler.submit(second_prompt, max_new_tokens=12))
+
+        def end(self):
+            pass
+
+    try:
+        first = scheduler.submit(first_prompt, 12, streamer=SwapOnFirstToken())
+        first_result = first.result(timeout=60)
+        second_result = futures[0].result(timeout=60)
+    finally:
+        scheduler.stop()
+
+    assert first_result == _greedy(old_model, first_prompt, 12)
+    assert second_result == _greedy(new_model, second_prompt, 12)
+
+
+def test_publish_does_not_overwrite_the_model_of_an_active_batch(make_tiny_model):
+    model = make_tiny_model(0)
+    snapshot = InferenceSnapshot(model)
+    steps = []
+    paused, resume = threading.Event(), threading.Event()
+
+    @contextmanager
+    def acquire_model():
+        steps.append(None)
+        if len(steps) == 3:
+            # 请求已经进入 batch，在两步之间（没有 acquire 快照时）暂停
+            paused.set()
+            resume.wait(timeout=60)
+        with snapshot.acquire() as inference_model:
+            yield inference_model
+
+    scheduler = BatchScheduler(
+        acquire_model,
+        SimpleNamespace(eos_token_id=0),
+        top_k=1,
+        top_p=1.0,
+        pin_model=snapshot.pin,
+    )
+    prompt = torch.tensor([5, 6, 7])
+    try:
+        future = scheduler.submit(prompt, max_new_tokens=12)
+        assert paused.wait(timeout=60)
+        source = make_tiny_model(1)
+        # 第一次发布写入后台副本；batch 使用的副本成了后台副本，不能再被覆盖
+        assert snapshot.publish(source)
+        assert not snapshot.publish(source)
+        resume.set()
+        result = future.result(timeout=60)
+    finally:
+        resume.set()
+        scheduler.stop()
+
+    assert result == _greedy(model, prompt, 12)
+    assert snapshot.publish(source)
@@ -0,0 +1,68 @@
+import os
+import threading
+
+import pytest
+from app.core.config import settings
+from llm.checkpoint_writer import latest_checkpoint
+
+
+@pytest.fixture
+def trained(tiny_llm_manager, make_entry):
+    tiny_llm_manager.train_on_entries("session", [make_entry("t5 t6 t7")])
+    assert tiny_llm_manager.active_model.dirty
+    return tiny_llm_manager
+
+
+def test_rejects_a_session_that_is_not_active(trained, make_session):
+    with pytest.raises(AssertionError):
+        trained.checkpoint_model(make_session("other"))
+    with pytest.raises(AssertionError):
+        trained.save_model(make_session("other"))
+    assert not os.path.exists("./trained/other")
+
+
+@pytest.mark.parametrize("checkpoint_async", [True, False])
+def test_dirty_is_cleared_after_the_checkpoint_is_written(
+    trained, make_session, monkeypatch, checkpoint_async
+):
+    monkeypatch.setattr(settings, "CHECKPOINT_ASYNC", checkpoint_async)
+    trained.checkpoint_model(make_session())
+    trained.wait_for_checkpoints()
+
+    assert not trained.active_model.dirty
+    assert latest_checkpoint("./trained/session") != "./trained/session"
+
+
+def test_dirty_is_kept_when_the_write_fails(trained, make_session, monkeypatch):
+    def fail(model_dir, snapshot):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(trained.checkpoint_writer, "write", fail)
+    saved = []
+    trained.checkpoint_model(make_session(), on_saved=lambda: saved.append(None))
+    trained.wait_for_checkpoints()
+
+    assert trained.active_model.dirty
+    assert saved == []
+
+
+def test_dirty_is_kept_when_training_continues_during_the_write(
+    trained, make_session, make_entry, monkeypatch
+):
+    started, release = threading.Event(), threading.Event()
+    write = trained.checkpoint_writer.write
+
+    def slow_write(model_dir, snapshot):
+        started.set()
+        release.wait(5)
+        return write(model_dir, snapshot)
+
+    monkeypatch.setattr(trained.checkpoint_writer, "write", slow_write)
+    trained.checkpoint_model(make_session())
+    started.wait(5)
+    # 检查点的快照是这一轮训练之前的权重
+    trained.train_on_entries("session", [make_entry("t8 t9")])
+    release.set()
+    trained.wait_for_checkpoints()
+
+    assert trained.active_model.dirty
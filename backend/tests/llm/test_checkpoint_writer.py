@@ -0,0 +1,99 @@
+import json
+import os
+import threading
+import torch
+from safetensors.torch import load_file
+from llm.checkpoint_writer import (
+    CheckpointSnapshot,
+    CheckpointWriter,
+    latest_checkpoint,
+    snapshot_state_dict,
+)
+
+
+def make_snapshot(weights, before_save=None):
+    def save_config(checkpoint_dir):
+        if before_save is not None:
+            before_save()
+        with open(os.path.join(checkpoint_dir, "config.json"), "w") as f:
+            json.dump({}, f)
+
+    return CheckpointSnapshot(
+        weights_name="model",
+        weights=weights,
+        save_config=save_config,
+        objects={"optimizer.pt": {"step": 1}},
+        max_shard_size=100,
+    )
+
+
+def test_links_unchanged_shards_and_keeps_latest_checkpoints(tmp_path):
+    model_dir = str(tmp_path)
+    assert latest_checkpoint(model_dir) == model_dir
+
+    writer = CheckpointWriter(keep=2)
+    weights = {"a": torch.zeros(20), "b": torch.ones(20)}
+    first = writer.write(model_dir, make_snapshot(weights))
+    weights = {"a": torch.zeros(20), "b": torch.full((20,), 2.0)}
+    second = writer.submit(model_dir, make_snapshot(weights)).result()
+
+    files = sorted(os.listdir(second))
+    assert "model.safetensors.index.json" in files and "optimizer.pt" in files
+    shards = [name for name in files if name.endswith(".safetensors")]
+    assert len(shards) == 2
+    # 内容没有变化的分片是同一个文件
+    a_shard, b_shard = shards
+    assert os.path.samefile(
+        os.path.join(first, a_shard), os.path.join(second, a_shard)
+    )
+    assert not os.path.samefile(
+        os.path.join(first, b_shard), os.path.join(second, b_shard)
+    )
+
+    writer.submit(model_dir, make_snapshot(weights))
+    writer.wait()
+    latest = latest_checkpoint(model_dir)
+    checkpoints = os.listdir(os.path.join(model_dir, "checkpoints"))
+    assert len(checkpoints) == 2 and os.path.basename(latest) in checkpoints
+    assert not os.path.exists(first)
+
+
+def test_queued_snapshots_of_a_session_are_coalesced(tmp_path):
+    model_dir = str(tmp_path)
+    writer = CheckpointWriter(keep=5)
+    started, release = threading.Event(), threading.Event()
+
+    def block():
+        started.set()
+        release.wait(timeout=60)
+
+    writing = writer.submit(model_dir, make_snapshot({"a": torch.zeros(4)}, block))
+    assert started.wait(timeout=60)
+    # 第一个检查点正在写，之后提交的快照只保留最新的一个
+    queued = writer.submit(model_dir, make_snapshot({"a": torch.ones(4)}))
+    latest = writer.submit(model_dir, make_snapshot({"a": torch.full((4,), 2.0)}))
+    assert latest is queued and latest is not writing
+
+    release.set()
+    writer.wait(model_dir)
+    assert len(os.listdir(os.path.join(model_dir, "checkpoints"))) == 2
+    assert latest_checkpoint(model_dir) == latest.result()
+    weights = load_file(os.path.join(latest.result(), "model.safetensors"))
+    assert weights["a"].tolist() == [2.0] * 4
+
+
+def test_snapshot_keeps_one_copy_of_tied_weights():
+    class Tied(torch.nn.Module):
+        _tied_weights_keys = ["head.weight"]
+
+        def __init__(self):
+            super().__init__()
+            self.embed = torch.nn.Embedding(4, 2)
+            self.head = torch.nn.Linear(2, 4, bias=False)
+            self.head.weight = self.embed.weight
+
+    model = Tied()
+    weights = snapshot_state_dict(model)
+    assert list(weights) == ["embed.weight"]
+    weights["embed.weight"].zero_()
+    assert model.embed.weight.abs().sum() > 0
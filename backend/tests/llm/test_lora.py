@@ -0,0 +1,81 @@
+import os
+import pytest
+import torch
+from peft import get_peft_model
+from app.core.config import settings
+from llm.checkpoint_writer import latest_checkpoint
+from llm.lora import (
+    build_lora_config,
+    merged_copy,
+    refresh_merged_copy,
+)
+from llm_manager import LLMManager
+
+
+@pytest.fixture
+def lora_model(tiny_model):
+    model = get_peft_model(
+        tiny_model,
+        build_lora_config({"rank": 4, "dropout": 0.0}, "base"),
+        adapter_name="a",
+    )
+    model.add_adapter("b", build_lora_config({"rank": 4, "dropout": 0.0}, "base"))
+    model.set_adapter("a")
+    return model.eval()
+
+
+def perturb_adapter(model, adapter_name):
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if f"lora_B.{adapter_name}." in name:
+                param.normal_()
+
+
+def test_merged_copy_matches_adapter_and_refreshes_in_place(lora_model):
+    model = lora_model
+    input_ids = torch.tensor([[1, 2, 3, 4]])
+    perturb_adapter(model, "a")
+    merged = merged_copy(model, "a")
+
+    def same_outputs():
+        with torch.no_grad():
+            expected = model(input_ids).logits
+            return torch.allclose(expected, merged(input_ids).logits, atol=1e-5)
+
+    assert same_outputs()
+    perturb_adapter(model, "a")
+    assert not same_outputs()
+    refresh_merged_copy(merged, model, "a")
+    assert same_outputs()
+
+
+def test_lora_checkpoint_holds_only_the_adapter(
+    tiny_model, tiny_tokenizer, make_session, tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(settings, "TOKEN_CACHE_ENABLED", False)
+    monkeypatch.setattr(settings, "CHECKPOINT_ASYNC", False)
+    tiny_model.save_pretrained("base")
+    tiny_tokenizer.save_pretrained("base")
+    manager = LLMManager()
+    manager.init_new_model("base", "chat", lora_config={"rank": 4, "dropout": 0.0})
+    perturb_adapter(manager.model, "chat")
+
+    manager.checkpoint_model(make_session("chat"))
+
+    checkpoint_dir = latest_checkpoint("./trained/chat")
+    files = os.listdir(checkpoint_dir)
+    assert "adapter_model.safetensors" in files
+    assert "adapter_config.json" in files
+    assert "tokenizer.json" in files
+    # 基础模型的权重不随会话保存
+    assert not [name for name in files if name.startswith("model")]
+
+    input_ids = torch.tensor([[2, 3, 4, 5]])
+    with torch.no_grad():
+        expected = manager.model(input_ids).logits
+    reloaded = LLMManager()
+    reloaded.load_model("./trained/chat", "chat")
+    assert reloaded.active_model.adapter_name == "chat"
+    with torch.no_grad():
+        assert torch.allclose(reloaded.model(input_ids).logits, expected, atol=1e-5)
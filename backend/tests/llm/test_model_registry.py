@@ -0,0 +1,44 @@
+import torch
+from llm.model_registry import ModelRegistry, module_num_bytes
+
+
+def make_model():
+    return torch.nn.Linear(16, 16)
+
+
+def test_evicts_least_recently_used_and_saves_dirty_models():
+    model_bytes = module_num_bytes(make_model())
+    saved = []
+    registry = ModelRegistry(
+        "cpu",
+        device_budget_bytes=0,
+        host_budget_bytes=model_bytes * 2,
+        save_model=lambda entry: saved.append(entry.session_name),
+    )
+
+    registry.register("a", "dir/a", make_model(), None).dirty = True
+    registry.register("b", "dir/b", make_model(), None)
+    registry.activate("a")
+    registry.register("c", "dir/c", make_model(), None)
+
+    assert registry.get("b") is None
+    assert registry.get("a") is not None and registry.get("c") is not None
+    assert saved == []
+
+    registry.activate("c")
+    registry.register("d", "dir/d", make_model(), None)
+    assert registry.get("a") is None
+    assert saved == ["a"]
+
+
+def test_never_evicts_protected_model():
+    registry = ModelRegistry(
+        "cpu", device_budget_bytes=0, host_budget_bytes=0, save_model=lambda e: None
+    )
+
+    registry.register("a", "dir/a", make_model(), None)
+    registry.register("b", "dir/b", make_model(), None)
+
+    assert registry.get("a") is None
+    assert registry.get("b") is not None
+    assert [m["session_name"] for m in registry.stats()["models"]] == ["b"]
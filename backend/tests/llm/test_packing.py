@@ -0,0 +1,57 @@
+import torch
+from llm.packing import (
+    PackedDataset,
+    collate_packed,
+    pack_sequences,
+    to_additive_mask,
+)
+from llm_manager import collate_fn, per_entry_loss
+
+
+def _item(index, token_ids):
+    input_ids = torch.tensor(token_ids)
+    return {
+        "input_ids": input_ids,
+        "attention_mask": torch.ones_like(input_ids),
+        "labels": input_ids.clone(),
+        "entry_index": index,
+    }
+
+
+def test_pack_sequences_never_exceeds_max_length_or_splits():
+    lengths = [7, 3, 12, 5, 2, 9]
+    blocks = pack_sequences(lengths, max_length=10)
+
+    assert sorted(i for block in blocks for i in block) == list(range(len(lengths)))
+    for block in blocks:
+        assert len(block) == 1 or sum(lengths[i] for i in block) <= 10
+
+
+def test_packed_losses_match_unpacked_losses(tiny_model):
+    model = tiny_model
+    items = [
+        _item(i, torch.randint(1, 64, (length,)).tolist())
+        for i, length in enumerate([5, 9, 3, 12, 7])
+    ]
+
+    with torch.no_grad():
+        expected = []
+        for item in items:
+            batch = collate_fn([item])
+            expected.append(
+                model(**{k: batch[k] for k in ("input_ids", "labels")}).loss
+            )
+
+        dataset = PackedDataset(items, max_length=16)
+        batch = collate_packed([dataset[i] for i in range(len(dataset))])
+        outputs = model(
+            input_ids=batch["input_ids"],
+            attention_mask=to_additive_mask(batch["attention_mask"], model.dtype),
+            position_ids=batch["position_ids"],
+        )
+        loss_sums, counts = per_entry_loss(
+            outputs.logits, batch["labels"], batch["entry_index"], len(items)
+        )
+
+    assert len(dataset) < len(items)
+    assert torch.allclose(loss_sums / counts, torch.stack(expected), atol=1e-5)
@@ -0,0 +1,57 @@
+import torch
+from transformers import DynamicCache
+from llm.prompt_cache import PromptCache
+
+
+def _make_cache(seq_len: int, num_layers: int = 2) -> DynamicCache:
+    cache = DynamicCache()
+    for layer_idx in range(num_layers):
+        key = torch.zeros(1, 2, seq_len, 4)
+        value = torch.zeros(1, 2, seq_len, 4)
+        cache.update(key, value, layer_idx)
+    return cache
+
+
+def test_take_returns_longest_common_prefix():
+    prompt_cache = PromptCache(max_entries=4, max_bytes=1024 * 1024)
+    prompt_cache.put("s", torch.tensor([1, 2, 3, 4, 5]), _make_cache(5))
+    prompt_cache.put("s", torch.tensor([1, 2, 9]), _make_cache(3))
+
+    cache, reused = prompt_cache.take("s", torch.tensor([1, 2, 3, 4, 7, 8]))
+
+    assert reused == 4
+    assert cache.get_seq_length() == 4
+    # 被取出的条目不再留在缓存中
+    assert prompt_cache.stats()["entries"] == 1
+
+
+def test_take_keeps_last_token_uncached():
+    prompt_cache = PromptCache(max_entries=4, max_bytes=1024 * 1024)
+    prompt_cache.put("s", torch.tensor([1, 2, 3]), _make_cache(3))
+
+    cache, reused = prompt_cache.take("s", torch.tensor([1, 2, 3]))
+
+    assert reused == 2
+    assert cache.get_seq_length() == 2
+
+
+def test_take_is_scoped_to_session():
+    prompt_cache = PromptCache(max_entries=4, max_bytes=1024 * 1024)
+    prompt_cache.put("a", torch.tensor([1, 2, 3]), _make_cache(3))
+
+    cache, reused = prompt_cache.take("b", torch.tensor([1, 2, 3, 4]))
+
+    assert cache is None
+    assert reused == 0
+
+
+def test_evicts_least_recently_used_over_budget():
+    entry_bytes = 2 * 2 * (1 * 2 * 3 * 4) * 4  # layers * (k, v) * numel * float32
+    prompt_cache = PromptCache(max_entries=8, max_bytes=2 * entry_bytes)
+    prompt_cache.put("s", torch.tensor([1, 1, 1]), _make_cache(3))
+    prompt_cache.put("s", torch.tensor([2, 2, 2]), _make_cache(3))
+    prompt_cache.put("s", torch.tensor([3, 3, 3]), _make_cache(3))
+
+    assert prompt_cache.stats()["entries"] == 2
+    cache, _ = prompt_cache.take("s", torch.tensor([1, 1, 1, 1]))
+    assert cache is None
@@ -0,0 +1,73 @@
+import pytest
+import torch
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+from app.core.config import settings
+from llm_manager import LLMManager
+
+
+@pytest.fixture
+def load(tiny_model, tiny_tokenizer, tmp_path, monkeypatch):
+    """按 CHAT_INT8_ON_CPU 加载 tiny_model 的 LLMManager，与 load_model 一样量化。"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(settings, "TOKEN_CACHE_ENABLED", False)
+    monkeypatch.setattr(settings, "CHECKPOINT_ASYNC", False)
+
+    def load(int8_on_cpu: bool) -> LLMManager:
+        monkeypatch.setattr(settings, "CHAT_INT8_ON_CPU", int8_on_cpu)
+        manager = LLMManager()
+        manager._activate_loaded_model(
+            "session",
+            manager._get_model_dir_from_session_name("session"),
+            tiny_model,
+            tiny_tokenizer,
+        )
+        return manager
+
+    return load
+
+
+INPUT_IDS = torch.tensor([[2, 3, 4, 5]])
+
+
+def logits(model) -> torch.Tensor:
+    with torch.no_grad():
+        return model(INPUT_IDS).logits
+
+
+def test_chat_uses_an_int8_copy_on_cpu(load):
+    manager = load(int8_on_cpu=True)
+    quantized = manager.quantized_model
+
+    assert manager._chat_model() is quantized
+    assert manager.inference_snapshot is None
+    layers = [m for m in quantized.modules() if isinstance(m, DynamicQuantizedLinear)]
+    assert layers and all(layer.weight().dtype == torch.qint8 for layer in layers)
+    # 训练用的模型不受影响
+    assert not any(
+        isinstance(m, DynamicQuantizedLinear) for m in manager.model.modules()
+    )
+
+    output = logits(quantized)
+    assert output.shape == (1, 4, 64)
+    assert output.dtype == torch.float32
+    assert torch.allclose(output, logits(manager.model), atol=0.05)
+
+
+def test_save_rebuilds_the_int8_copy(load, make_entry, make_session):
+    manager = load(int8_on_cpu=True)
+    before = logits(manager.quantized_model)
+    manager.train_on_entries("session", [make_entry("t5 t6 t7"), make_entry("t8 t9")])
+
+    manager.save_model(make_session())
+
+    assert not torch.equal(logits(manager.quantized_model), before)
+    assert torch.allclose(
+        logits(manager.quantized_model), logits(manager.model), atol=0.05
+    )
+
+
+def test_full_precision_chat_without_int8(load):
+    manager = load(int8_on_cpu=False)
+
+    assert manager.quantized_model is None
+    assert manager._chat_model() is manager.model
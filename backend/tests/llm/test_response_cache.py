@@ -0,0 +1,95 @@
+import threading
+from llm.generation import GenerationParams
+from llm.response_cache import ResponseCache
+
+
+def test_make_key_depends_on_model_version_and_params():
+    params = GenerationParams(seed=1)
+    key = ResponseCache.make_key("text", "s", 1, params)
+
+    assert key == ResponseCache.make_key("text", "s", 1, GenerationParams(seed=1))
+    assert key != ResponseCache.make_key("text", "s", 2, params)
+    assert key != ResponseCache.make_key("text", "s", 1, GenerationParams(seed=2))
+
+
+def test_caches_only_cacheable_responses():
+    cache = ResponseCache(max_entries=4)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return f"response {len(calls)}"
+
+    assert cache.get_or_compute("a", compute, cacheable=True) == "response 1"
+    assert cache.get_or_compute("a", compute, cacheable=True) == "response 1"
+    assert cache.get_or_compute("b", compute, cacheable=False) == "response 2"
+    assert cache.get_or_compute("b", compute, cacheable=False) == "response 3"
+
+    cache.clear()
+    assert cache.get_or_compute("a", compute, cacheable=True) == "response 4"
+
+
+def test_coalesces_identical_in_flight_requests():
+    cache = ResponseCache(max_entries=4)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "response"
+
+    results = []
+    first = threading.Thread(
+        target=lambda: results.append(cache.get_or_compute("a", compute, True))
+    )
+    first.start()
+    started.wait(5)
+    second = threading.Thread(
+        target=lambda: results.append(cache.get_or_compute("a", compute, True))
+    )
+    second.start()
+    while cache.stats()["coalesced"] == 0:
+        pass
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert results == ["response", "response"]
+    assert len(calls) == 1
+
+
+def test_uncacheable_requests_are_not_coalesced():
+    cache = ResponseCache(max_entries=4)
+    both_started = threading.Barrier(2, timeout=5)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        # 两个请求都开始生成才返回，合并时这里会超时
+        both_started.wait()
+        return "sample"
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.get_or_compute("a", compute, False))
+        )
+        for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ["sample", "sample"]
+    assert len(calls) == 2
+    assert cache.stats()["coalesced"] == 0
+
+
+def test_sampling_without_seed_is_not_deterministic():
+    assert not GenerationParams().is_deterministic
+    assert GenerationParams(seed=0).is_deterministic
+    assert GenerationParams(do_sample=False).is_deterministic
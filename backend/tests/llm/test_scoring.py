@@ -0,0 +1,72 @@
+import torch
+from types import SimpleNamespace
+from llm_manager import (
+    IGNORE_TOKEN_ID,
+    DynamicHeartEchoDataset,
+    TokenBudgetBatchSampler,
+    length_bucketed_batches,
+    per_entry_loss,
+)
+
+
+def test_per_entry_loss_matches_unbatched_loss():
+    torch.manual_seed(0)
+    logits = torch.randn(2, 5, 11)
+    labels = torch.randint(0, 11, (2, 5))
+    labels[1, 3:] = IGNORE_TOKEN_ID
+    # 每行一条语料
+    entry_index = torch.tensor([[0] * 5, [1] * 5])
+
+    loss_sums, counts = per_entry_loss(logits, labels, entry_index, 2)
+
+    for row in range(2):
+        expected = torch.nn.functional.cross_entropy(
+            logits[row, :-1], labels[row, 1:], ignore_index=IGNORE_TOKEN_ID
+        )
+        assert torch.allclose(loss_sums[row] / counts[row], expected)
+    assert counts.tolist() == [4, 2]
+
+
+def test_length_bucketed_batches_respect_token_budget():
+    lengths = [5, 1, 9, 3, 7, 16]
+    batches = length_bucketed_batches(lengths, max_tokens=16)
+
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) == 1 or max(lengths[i] for i in batch) * len(batch) <= 16
+
+
+def test_token_budget_sampler_keeps_batches_inside_optimizer_groups():
+    lengths = [5, 1, 9, 3, 7, 16, 2, 2, 8, 4]
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens=16, group_size=4)
+
+    seen = []
+    for batch in sampler:
+        # 一个 batch 不会跨过每 4 条一次的优化器步骤
+        assert len(seen) // 4 == (len(seen) + len(batch) - 1) // 4
+        seen.extend(batch)
+    assert sorted(seen) == list(range(len(lengths)))
+
+
+class CharTokenizer:
+    def __call__(self, text, **kwargs):
+        return {"input_ids": [ord(c) for c in text]}
+
+
+def test_long_entries_are_split_into_overlapping_windows():
+    entries = [
+        SimpleNamespace(entry_type="knowledge", content="abcdefghijklmnopqrst"),
+        SimpleNamespace(entry_type="knowledge", content="short"),
+    ]
+    dataset = DynamicHeartEchoDataset(
+        entries, CharTokenizer(), max_length=8, overlap=3
+    )
+
+    assert dataset.sample_entries == [0, 0, 0, 0, 1]
+    assert all(len(dataset[i]["input_ids"]) <= 8 for i in range(len(dataset)))
+    # 除第一个 token 之外，每个 token 恰好在一个窗口里作为预测目标
+    predicted = []
+    for i in range(4):
+        labels = dataset[i]["labels"][1:]
+        predicted += [chr(t) for t in labels.tolist() if t != IGNORE_TOKEN_ID]
+    assert "".join(predicted) == "bcdefghijklmnopqrst"
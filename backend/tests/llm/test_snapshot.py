@@ -0,0 +1,39 @@
+import torch
+from llm.snapshot import InferenceSnapshot
+
+
+def test_publish_swaps_in_new_weights():
+    model = torch.nn.Linear(4, 4)
+    snapshot = InferenceSnapshot(model)
+    with torch.no_grad():
+        model.weight.add_(1.0)
+
+    assert snapshot.publish(model)
+
+    with snapshot.acquire() as inference_model:
+        assert torch.equal(inference_model.weight, model.weight)
+        assert not inference_model.training
+    assert snapshot.version == 1
+
+
+def test_readers_keep_a_consistent_model_across_publishes():
+    model = torch.nn.Linear(4, 4)
+    snapshot = InferenceSnapshot(model)
+    original = model.weight.detach().clone()
+
+    with snapshot.acquire() as inference_model:
+        with torch.no_grad():
+            model.weight.add_(1.0)
+        # 第一次发布写入后台副本，不影响正在使用前台副本的读者
+        assert snapshot.publish(model)
+        assert torch.equal(inference_model.weight, original)
+
+        # 旧的前台副本现在成了后台副本，仍被占用，不能覆盖
+        with torch.no_grad():
+            model.weight.add_(1.0)
+        assert not snapshot.publish(model)
+        assert torch.equal(inference_model.weight, original)
+
+    assert snapshot.publish(model)
+    with snapshot.acquire() as inference_model:
+        assert torch.equal(inference_model.weight, model.weight)
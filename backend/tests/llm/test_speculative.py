@@ -0,0 +1,46 @@
+import threading
+import torch
+from llm.speculative import SpeculativeConfig, build_generate_kwargs, count_forwards
+
+
+def test_draft_settings_do_not_modify_the_shared_draft_model(make_tiny_model):
+    model, draft_model = make_tiny_model(), make_tiny_model()
+    draft_config = draft_model.generation_config.to_dict()
+    input_ids = torch.tensor([[5, 6, 7, 8]])
+    config = SpeculativeConfig(
+        mode="draft", draft_model="draft", num_speculative_tokens=3
+    )
+
+    kwargs = build_generate_kwargs(config, draft_model)
+    generated = model.generate(
+        input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=10,
+        do_sample=False,
+        pad_token_id=0,
+        **kwargs,
+    )
+
+    assert kwargs["assistant_model"].generation_config.num_assistant_tokens >= 1
+    assert draft_model.generation_config.to_dict() == draft_config
+    expected = model.generate(
+        input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=10,
+        do_sample=False,
+        pad_token_id=0,
+    )
+    assert torch.equal(generated, expected)
+
+
+def test_count_forwards_ignores_other_threads(tiny_model):
+    model = tiny_model
+    input_ids = torch.tensor([[5, 6, 7]])
+
+    with torch.no_grad(), count_forwards(model) as forwards:
+        other = threading.Thread(target=lambda: model(input_ids))
+        other.start()
+        other.join()
+        model(input_ids)
+
+    assert forwards == [1]
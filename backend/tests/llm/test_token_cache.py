@@ -0,0 +1,23 @@
+from llm.token_cache import TokenCache
+
+
+def test_reads_tokens_back_from_disk_and_keys_by_fingerprint(make_entry, tmp_path):
+    path = str(tmp_path / "tokens.sqlite")
+    calls = []
+
+    def tokenize(entry):
+        calls.append(entry.content)
+        return [ord(c) for c in entry.content]
+
+    entries = [make_entry("abc"), make_entry("hello")]
+    cache = TokenCache(path, "fp", tokenize)
+    assert cache.warm(entries) == 2
+    assert cache.count_tokens(entries) == [3, 5]
+
+    restarted = TokenCache(path, "fp", tokenize)
+    assert restarted.get_many(entries)[1].tolist() == [ord(c) for c in "hello"]
+    assert calls == ["abc", "hello"]
+
+    other_tokenizer = TokenCache(path, "other", tokenize)
+    assert other_tokenizer.warm(entries) == 2
+    assert restarted.stats()["stored_entries"] == 2
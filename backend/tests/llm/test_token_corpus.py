@@ -0,0 +1,114 @@
+import pickle
+import pytest
+import torch
+from torch.utils.data import DataLoader
+from llm.token_corpus import TokenCorpus, TokenCorpusDataset, TokenCorpusWriter
+from llm_manager import collate_fn
+
+
+@pytest.fixture
+def build(make_entry):
+    def build(path, contents):
+        entries = [make_entry(content) for content in contents]
+        writer = TokenCorpusWriter(str(path), "fp")
+        writer.add(
+            entries, [torch.tensor([ord(c) for c in e.content]) for e in entries]
+        )
+        return writer.close()
+
+    return build
+
+
+def test_reads_entries_and_windows_from_memmap(build, make_entry, tmp_path):
+    path = tmp_path / "all"
+    meta = build(path, ["abc", "hello world", "xy"])
+    assert meta["num_entries"] == 3 and meta["num_tokens"] == 16
+
+    corpus = TokenCorpus(str(path))
+    assert corpus.token_ids(1).tolist() == [ord(c) for c in "hello world"]
+    assert corpus.entry_id(2) == "id-xy"
+    assert corpus.entry_sha256(0) == make_entry("abc").sha256
+
+    dataset = TokenCorpusDataset(corpus, max_length=6, overlap=2)
+    # "hello world" 切成起始于 0、4、8 的三个窗口
+    assert dataset.sample_entries == [0, 1, 1, 1, 2]
+    item = dataset[3]
+    assert item["input_ids"].tolist() == [ord(c) for c in "rld"]
+    assert item["labels"].tolist()[:2] == [-100, -100]
+
+    # 传给 worker 进程时不带打开的 mmap
+    restored = pickle.loads(pickle.dumps(dataset))
+    assert restored.corpus._arrays == {}
+    assert restored[1]["input_ids"].tolist() == [ord(c) for c in "hello "]
+
+
+def test_dataloader_workers_share_the_corpus(build, tmp_path):
+    path = tmp_path / "all"
+    build(path, ["abc", "hello", "xy", "q"])
+    dataset = TokenCorpusDataset(TokenCorpus(str(path)))
+    loader = DataLoader(dataset, batch_size=2, num_workers=2, collate_fn=collate_fn)
+    lengths = [batch["attention_mask"].sum(dim=1).tolist() for batch in loader]
+    assert lengths == [[3, 5], [2, 1]]
+
+
+def test_rebuild_replaces_previous_export(build, tmp_path):
+    path = tmp_path / "all"
+    build(path, ["abc"])
+    opened = TokenCorpus(str(path))
+    build(path, ["hello", "xy"])
+
+    # 已经打开的对象继续读打开时的版本，不会混用新版本的文件
+    assert len(opened) == 1
+    assert opened.token_ids(0).tolist() == [ord(c) for c in "abc"]
+    assert len(TokenCorpus(str(path))) == 2
+
+    build(path, [])
+    corpus = TokenCorpus(str(path))
+    assert len(corpus) == 0 and len(TokenCorpusDataset(corpus)) == 0
+    # 只保留最近两个版本，没有留下临时目录
+    names = sorted(p.name for p in path.iterdir())
+    generations = [name for name in names if name.startswith("v-")]
+    assert names == ["CURRENT"] + generations
+    assert len(generations) == 2 and generations[-1] == corpus.generation
+
+
+def test_dataset_reads_a_subset_of_entries(build, tmp_path):
+    path = tmp_path / "all"
+    build(path, ["abc", "hello", "xy"])
+    dataset = TokenCorpusDataset(TokenCorpus(str(path)), indices=[2, 0])
+
+    assert dataset.entry_ids() == ["id-xy", "id-abc"]
+    assert dataset.entry_lengths() == [2, 3]
+    assert dataset.samples == [(0, 0), (1, 0)]
+    assert dataset[1]["input_ids"].tolist() == [ord(c) for c in "abc"]
+
+
+@pytest.fixture
+def exported(tiny_llm_manager, make_entry, tmp_path):
+    entries = [make_entry(content) for content in ("t5 t6 t7", "t8 t9", "t10 t11 t12")]
+    writer = TokenCorpusWriter(
+        str(tmp_path / "all"), tiny_llm_manager.tokenizer_fingerprint()
+    )
+    writer.add(entries, tiny_llm_manager.tokenize_entries(entries))
+    writer.close()
+    return entries, TokenCorpus(str(tmp_path / "all"))
+
+
+def test_trains_on_the_exported_tokens(tiny_llm_manager, exported):
+    entries, corpus = exported
+    # 只有一次优化器步骤，损失与训练前的评估相同
+    expected = tiny_llm_manager.score_entries("session", [entries[2], entries[0]])
+
+    result = tiny_llm_manager.train_on_token_corpus("session", corpus, [2, 0])
+
+    assert result.entry_losses.keys() == expected.keys()
+    for entry_id, loss in expected.items():
+        assert result.entry_losses[entry_id] == pytest.approx(loss, rel=1e-4)
+
+
+def test_rejects_an_export_from_another_tokenizer(tiny_llm_manager, build, tmp_path):
+    build(tmp_path / "other", ["abc"])
+    corpus = TokenCorpus(str(tmp_path / "other"))
+
+    with pytest.raises(ValueError):
+        tiny_llm_manager.train_on_token_corpus("session", corpus, [0])
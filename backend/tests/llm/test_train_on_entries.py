@@ -0,0 +1,138 @@
+import pytest
+import torch
+import llm_manager
+from app.core.config import settings
+
+
+@pytest.fixture
+def entries(make_entry):
+    return [make_entry(content) for content in ("t5 t6 t7 t8", "t9 t10", "t11 t12 t13")]
+
+
+def test_entry_losses_come_from_the_training_forward_pass(tiny_llm_manager, entries):
+    # 不到 16 条，所有前向都在唯一一次优化器步骤之前，损失与训练前的评估相同
+    expected = tiny_llm_manager.score_entries("session", entries)
+    weights = tiny_llm_manager.model.lm_head.weight.detach().clone()
+
+    result = tiny_llm_manager.train_on_entries("session", entries)
+
+    assert result.entry_losses.keys() == expected.keys()
+    for entry_id, loss in expected.items():
+        assert result.entry_losses[entry_id] == pytest.approx(loss, rel=1e-4)
+    assert result.skipped_entry_ids == []
+    assert not torch.equal(tiny_llm_manager.model.lm_head.weight, weights)
+
+
+def fail_on_call(monkeypatch, owner, name, n):
+    """第 n 次调用 owner.name 时抛出内存不足。"""
+    original = getattr(owner, name)
+    calls = []
+
+    def wrapper(*args, **kwargs):
+        calls.append(None)
+        if len(calls) == n:
+            raise RuntimeError("CUDA out of memory")
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(owner, name, wrapper)
+
+
+@pytest.fixture
+def oom_on_backward(monkeypatch):
+    """第一次反向传播时抛出内存不足；每个 batch 单独一次优化器步骤。"""
+    monkeypatch.setattr(settings, "TRAIN_MAX_BATCH_TOKENS", 4)
+    monkeypatch.setattr(llm_manager, "ENTRIES_PER_OPTIMIZER_STEP", 1)
+    fail_on_call(monkeypatch, torch.Tensor, "backward", 1)
+
+
+def test_entries_of_a_failed_backward_are_skipped(
+    tiny_llm_manager, entries, oom_on_backward
+):
+    result = tiny_llm_manager.train_on_entries("session", entries)
+
+    assert len(result.skipped_entry_ids) == 1
+    assert set(result.entry_losses) | set(result.skipped_entry_ids) == {
+        entry.id for entry in entries
+    }
+    assert not set(result.entry_losses) & set(result.skipped_entry_ids)
+
+
+def test_backward_oom_discards_the_whole_accumulation_group(
+    monkeypatch, tiny_llm_manager, entries
+):
+    # 三条语料各自一个 batch，都在同一个梯度累积周期里
+    monkeypatch.setattr(settings, "TRAIN_MAX_BATCH_TOKENS", 4)
+    fail_on_call(monkeypatch, torch.Tensor, "backward", 2)
+    weights = tiny_llm_manager.model.lm_head.weight.detach().clone()
+
+    result = tiny_llm_manager.train_on_entries("session", entries)
+
+    # 第一批的梯度和第二批的一起被丢弃，只有最后一批参与了优化器步骤
+    assert len(result.skipped_entry_ids) == 2
+    assert len(result.entry_losses) == 1
+    assert set(result.entry_losses) | set(result.skipped_entry_ids) == {
+        entry.id for entry in entries
+    }
+    assert not torch.equal(tiny_llm_manager.model.lm_head.weight, weights)
+
+
+def test_backward_oom_on_the_last_batch_skips_the_optimizer_step(
+    monkeypatch, tiny_llm_manager, entries
+):
+    monkeypatch.setattr(settings, "TRAIN_MAX_BATCH_TOKENS", 4)
+    fail_on_call(monkeypatch, torch.Tensor, "backward", 3)
+    weights = tiny_llm_manager.model.lm_head.weight.detach().clone()
+
+    result = tiny_llm_manager.train_on_entries("session", entries)
+
+    assert result.entry_losses == {}
+    assert sorted(result.skipped_entry_ids) == sorted(entry.id for entry in entries)
+    assert torch.equal(tiny_llm_manager.model.lm_head.weight, weights)
+
+
+def test_forward_oom_keeps_the_accumulated_gradients(
+    monkeypatch, tiny_llm_manager, entries
+):
+    monkeypatch.setattr(settings, "TRAIN_MAX_BATCH_TOKENS", 4)
+    fail_on_call(monkeypatch, llm_manager, "per_entry_loss", 2)
+
+    result = tiny_llm_manager.train_on_entries("session", entries)
+
+    # 只有前向失败的那一批被跳过，之前累积的梯度照常参与优化器步骤
+    assert len(result.skipped_entry_ids) == 1
+    assert len(result.entry_losses) == 2
+    assert set(result.entry_losses) | set(result.skipped_entry_ids) == {
+        entry.id for entry in entries
+    }
+
+
+def optimizer_state(manager):
+    optimizer = manager.active_model.optimizer
+    return [optimizer.state[p] for p in optimizer.param_groups[0]["params"]]
+
+
+def test_optimizer_state_carries_over_rounds_and_checkpoints(
+    monkeypatch, tiny_llm_manager, entries, make_session
+):
+    monkeypatch.setattr(settings, "CHECKPOINT_ASYNC", False)
+    tiny_llm_manager.train_on_entries("session", entries)
+    optimizer = tiny_llm_manager.active_model.optimizer
+    tiny_llm_manager.train_on_entries("session", entries)
+
+    # 同一个会话的多轮训练复用优化器和学习率调度器
+    assert tiny_llm_manager.active_model.optimizer is optimizer
+    assert all(state["step"] == 2 for state in optimizer_state(tiny_llm_manager))
+    assert tiny_llm_manager.active_model.lr_scheduler.last_epoch == 2
+
+    tiny_llm_manager.checkpoint_model(make_session())
+    restored = llm_manager.LLMManager()
+    restored.load_model("./trained/session", "session")
+    restored._get_optimizer()
+
+    assert restored.active_model.lr_scheduler.last_epoch == 2
+    for state, saved in zip(
+        optimizer_state(restored), optimizer_state(tiny_llm_manager)
+    ):
+        assert state["step"] == 2
+        assert torch.equal(state["exp_avg"], saved["exp_avg"])
+        assert torch.equal(state["exp_avg_sq"], saved["exp_avg_sq"])
@@ -0,0 +1,18 @@
+import pytest
+from llm.training_memory import training_memory_mode
+
+
+def test_lean_mode_checkpoints_only_while_training(tiny_model):
+    model = tiny_model
+    with training_memory_mode(model, "lean"):
+        assert model.is_gradient_checkpointing
+        assert not model.config.use_cache
+
+    assert not model.is_gradient_checkpointing
+    assert model.config.use_cache
+
+
+def test_rejects_unknown_mode(tiny_model):
+    with pytest.raises(ValueError):
+        with training_memory_mode(tiny_model, "tiny"):
+            pass
@@ -0,0 +1,99 @@
+import unittest
+from datetime import time
+from unittest.mock import MagicMock, patch
+
+from repositories.training_loss.memory_training_loss_repository import (
+    MemoryTrainingLossRepository,
+)
+from services.auto_smelt_service import (
+    AutoSmeltService,
+    in_time_windows,
+    parse_time_windows,
+)
+from services.model_training_service import ModelTrainingService
+from services.training_loss_service import TrainingLossService
+
+
+class TestTimeWindows(unittest.TestCase):
+    def test_parses_windows_across_midnight(self):
+        windows = parse_time_windows("23:00-02:00, 13:00-14:00")
+        self.assertTrue(in_time_windows(time(23, 30), windows))
+        self.assertTrue(in_time_windows(time(1, 0), windows))
+        self.assertTrue(in_time_windows(time(13, 0), windows))
+        self.assertFalse(in_time_windows(time(14, 0), windows))
+        self.assertFalse(in_time_windows(time(12, 0), windows))
+
+    def test_rejects_invalid_window(self):
+        with self.assertRaises(ValueError):
+            parse_time_windows("1am-2am")
+
+
+class TestAutoSmeltService(unittest.TestCase):
+    def setUp(self):
+        self.training_service = MagicMock()
+        self.job_service = MagicMock()
+        self.job_service.has_active_job.return_value = False
+        self.chat_worker = MagicMock()
+        self.chat_worker.idle_seconds.return_value = 3600
+        self.service = AutoSmeltService(
+            self.training_service,
+            MagicMock(),
+            self.job_service,
+            self.chat_worker,
+        )
+
+    @patch("services.auto_smelt_service.settings")
+    def test_submits_job_when_enough_new_entries(self, settings):
+        settings.AUTO_SMELT_BATCH_SIZE = 16
+        settings.AUTO_SMELT_CHAT_QUIET_SECONDS = 60
+        self.training_service.count_new_entries.return_value = 16
+
+        self.service.tick()
+        self.job_service.submit_job.assert_called_once_with(
+            "smelt_new_corpus", batch_size=16
+        )
+
+    @patch("services.auto_smelt_service.settings")
+    def test_yields_to_chat_and_running_jobs(self, settings):
+        settings.AUTO_SMELT_CHAT_QUIET_SECONDS = 60
+        self.training_service.count_new_entries.return_value = 100
+
+        self.chat_worker.idle_seconds.return_value = 5
+        self.assertIsNone(self.service.tick())
+        self.assertEqual(self.service.get_status()["state"], "chat_active")
+
+        self.chat_worker.idle_seconds.return_value = 3600
+        self.job_service.has_active_job.return_value = True
+        self.assertIsNone(self.service.tick())
+        self.job_service.submit_job.assert_not_called()
+
+    @patch("services.auto_smelt_service.settings")
+    def test_pending_entries_are_not_counted_as_new(self, settings):
+        settings.AUTO_SMELT_BATCH_SIZE = 16
+        settings.AUTO_SMELT_CHAT_QUIET_SECONDS = 60
+        session_service = MagicMock()
+        session_service.get_current_session.return_value.id = "session"
+        corpus_entry_repo = MagicMock()
+        corpus_entry_repo.count.return_value = 20
+        self.service.training_session_service = session_service
+        self.service.model_training_service = ModelTrainingService(
+            MagicMock(),
+            corpus_entry_repo,
+            session_service,
+            TrainingLossService(MemoryTrainingLossRepository(), corpus_entry_repo),
+        )
+        self.service.idle_windows = parse_time_windows("00:00-23:59:59")
+
+        # 20 条语料中 8 条已训练、损失还在等待检查点，新语料不够一轮，复习旧语料
+        session_service.get_pending_entry_ids.return_value = {
+            f"entry-{i}" for i in range(8)
+        }
+        self.service.tick()
+        self.assertEqual(self.service.get_status()["new_entries"], 12)
+        self.job_service.submit_job.assert_called_once_with(
+            "smelt_new_old", batch_size=16
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from repositories.training_loss.memory_training_loss_repository import (
+    MemoryTrainingLossRepository,
+)
+from llm.token_corpus import TokenCorpusWriter
+from llm_manager import TrainingResult
+from services.model_training_service import ModelTrainingService
+from services.training_loss_service import TrainingLossService
+
+
+class TestScoring(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _factories(self, make_entry, make_session):
+        self.make_entry = make_entry
+        self.make_session = make_session
+
+    def setUp(self):
+        self.session = self.make_session()
+        self.entries = [self.make_entry(content) for content in ("a", "b", "c")]
+        self.corpus_entry_repo = MagicMock()
+        self.corpus_entry_repo.count.return_value = len(self.entries)
+        self.corpus_entry_repo.get_entries_by_ids.side_effect = lambda ids: [
+            entry for entry in self.entries if entry.id in ids
+        ]
+        self.loss_service = TrainingLossService(
+            MemoryTrainingLossRepository(), self.corpus_entry_repo
+        )
+        self.session_service = MagicMock()
+        self.session_service.get_current_session.return_value = self.session
+        self.session_service.get_pending_entry_ids.return_value = set()
+        self.llm_manager = MagicMock()
+        self.llm_manager.score_entries.side_effect = lambda name, entries: {
+            entry.id: 1.0 for entry in entries
+        }
+        self.service = ModelTrainingService(
+            self.llm_manager,
+            self.corpus_entry_repo,
+            self.session_service,
+            self.loss_service,
+        )
+
+    def test_scoring_leaves_new_entry_count_unchanged(self):
+        self.assertEqual(self.service.count_new_entries(self.session.id), 3)
+
+        result = self.service.score_entries(["id-a", "id-b"])
+
+        self.assertEqual(result["entries_scored"], 2)
+        self.assertEqual(len(self.loss_service.get_losses_for_session("session")), 2)
+        self.assertEqual(self.service.count_new_entries(self.session.id), 3)
+
+    def test_scoring_keeps_trained_entries_trained(self):
+        self.loss_service.update_loss("id-a", 2.0, self.session)
+        self.service.score_entries(["id-a"])
+
+        (loss,) = self.loss_service.get_losses_for_corpus_entry("id-a")
+        self.assertEqual(loss.loss_value, 1.0)
+        self.assertTrue(loss.trained)
+        self.assertEqual(self.service.count_new_entries(self.session.id), 2)
+
+    def test_pending_entries_are_not_counted_as_new(self):
+        self.corpus_entry_repo.sample_new_entries.return_value = self.entries[:2]
+        self.assertEqual(
+            len(self.service.sample_new_entries(2, "session", {"id-a"})), 2
+        )
+
+        # a 正在训练，b 已训练但损失还没有写入数据库，只剩 c 一条新语料
+        self.session_service.get_pending_entry_ids.return_value = {"id-b"}
+        with self.assertRaises(ValueError):
+            self.service.sample_new_entries(2, "session", {"id-a"})
+
+
+class TestTrainSingleEntry(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _factories(self, make_entry):
+        self.make_entry = make_entry
+
+    def setUp(self):
+        self.entry = self.make_entry("a")
+        self.llm_manager = MagicMock()
+        self.llm_manager.count_tokens.side_effect = lambda entries: [3] * len(entries)
+        corpus_entry_repo = MagicMock()
+        corpus_entry_repo.get_by_id.return_value = self.entry
+        self.session_service = MagicMock()
+        self.service = ModelTrainingService(
+            self.llm_manager, corpus_entry_repo, self.session_service, MagicMock()
+        )
+
+    def test_records_the_entry_loss_and_tokens_once(self):
+        self.llm_manager.train_on_entries.return_value = TrainingResult(
+            loss=0.5, entry_losses={self.entry.id: 1.5}
+        )
+        result = self.service.train_single_entry(self.entry.id)
+
+        self.session_service.record_round.assert_called_once_with(
+            {self.entry.id: 1.5}, 3
+        )
+        self.assertEqual(result["loss"], 1.5)
+        self.assertEqual(result["tokens_trained"], 3)
+        self.llm_manager.count_tokens.assert_called_once()
+
+    def test_skipped_entry_is_not_recorded_as_trained(self):
+        self.llm_manager.train_on_entries.return_value = TrainingResult(
+            loss=0.0, skipped_entry_ids=[self.entry.id]
+        )
+        result = self.service.train_single_entry(self.entry.id)
+
+        self.session_service.record_round.assert_called_once_with({}, 0)
+        self.assertIsNone(result["loss"])
+        self.assertEqual(result["tokens_trained"], 0)
+
+
+class TestTokenCorpus(unittest.TestCase):
+    @patch("services.model_training_service.settings")
+    def test_rejects_corpus_ids_outside_the_export_dir(self, settings):
+        llm_manager = MagicMock()
+        service = ModelTrainingService(
+            llm_manager, MagicMock(), MagicMock(), MagicMock()
+        )
+        with tempfile.TemporaryDirectory() as root:
+            settings.TOKEN_CORPUS_DIR = os.path.join(root, "token_corpus")
+            for corpus_id in ("../x", "/tmp/x", "a/b", ".."):
+                with self.assertRaises(ValueError):
+                    service.build_token_corpus(corpus_id)
+            self.assertEqual(os.listdir(root), [])
+        llm_manager._load_model_if_not_loaded.assert_not_called()
+
+
+class TestSmeltTokenCorpus(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _factories(self, make_entry, make_session):
+        self.make_entry = make_entry
+        self.make_session = make_session
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.llm_manager = MagicMock()
+        self.llm_manager.train_on_token_corpus.side_effect = self._train
+        self.session_service = MagicMock()
+        self.session_service.get_current_session.return_value = self.make_session()
+        self.service = ModelTrainingService(
+            self.llm_manager, MagicMock(), self.session_service, MagicMock()
+        )
+        self.trained = []
+
+    def _train(self, session_name, corpus, indices, **kwargs):
+        entry_ids = [corpus.entry_id(idx) for idx in indices]
+        self.trained.append(entry_ids)
+        return TrainingResult(
+            loss=1.0, entry_losses={entry_id: 1.0 for entry_id in entry_ids}
+        )
+
+    def _build(self, contents):
+        entries = [self.make_entry(content) for content in contents]
+        writer = TokenCorpusWriter(os.path.join(self.root.name, "all"), "fp")
+        writer.add(entries, [[0] * len(entry.content) for entry in entries])
+        writer.close()
+
+    @patch("services.model_training_service.settings")
+    def test_rounds_walk_through_the_corpus_once_per_epoch(self, settings):
+        settings.TOKEN_CORPUS_DIR = self.root.name
+        os.makedirs(os.path.join(self.root.name, "all"))
+        self._build(["a", "bb", "ccc"])
+
+        results = [self.service.smelt_token_corpus(2) for _ in range(3)]
+
+        self.assertEqual([len(ids) for ids in self.trained], [2, 1, 2])
+        self.assertEqual(
+            sorted(self.trained[0] + self.trained[1]), ["id-a", "id-bb", "id-ccc"]
+        )
+        self.assertEqual([result["epoch"] for result in results], [1, 1, 2])
+        # 记录的 token 数取自导出的长度
+        recorded = self.session_service.record_round.call_args_list[1].args
+        self.assertEqual(recorded[1], len(self.trained[1][0]) - len("id-"))
+
+    @patch("services.model_training_service.settings")
+    def test_requires_a_built_corpus(self, settings):
+        settings.TOKEN_CORPUS_DIR = self.root.name
+        with self.assertRaises(ValueError):
+            self.service.smelt_token_corpus(2)
+        self.llm_manager.train_on_token_corpus.assert_not_called()
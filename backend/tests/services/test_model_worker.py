@@ -0,0 +1,63 @@
+import asyncio
+import threading
+import unittest
+
+from services.model_worker import (
+    DeadlineExceededError,
+    ModelWorker,
+    WorkerOverloadedError,
+)
+
+
+class TestModelWorker(unittest.TestCase):
+    def setUp(self):
+        self.worker = ModelWorker("test", max_queue_size=1)
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def _block(self):
+        self.started.set()
+        self.release.wait(5)
+        return "blocked"
+
+    def test_run_returns_result(self):
+        result = asyncio.run(self.worker.run(lambda x: x * 2, 21))
+        self.assertEqual(result, 42)
+
+    def test_run_propagates_exception(self):
+        def fail():
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            asyncio.run(self.worker.run(fail))
+
+    def test_rejects_when_queue_is_full(self):
+        running = self.worker.submit(self._block)
+        self.started.wait(5)
+        self.worker.submit(lambda: None)  # 占满队列
+
+        with self.assertRaises(WorkerOverloadedError):
+            self.worker.submit(lambda: None)
+
+        self.release.set()
+        self.assertEqual(running.result(5), "blocked")
+
+    def test_expired_request_is_not_executed(self):
+        worker = ModelWorker("test", max_queue_size=2)
+        worker.submit(self._block)
+        self.started.wait(5)
+        executed = []
+
+        with self.assertRaises(DeadlineExceededError):
+            asyncio.run(worker.run(lambda: executed.append(1), timeout=0.05))
+
+        self.release.set()
+        worker.submit(lambda: None).result(5)
+        self.assertEqual(executed, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from services.model_worker import ModelWorker
+from services.training_job_service import TrainingJobService
+
+
+class FakeTrainingService:
+    """每轮报告两步进度；第一步之后等待 release，方便测试在训练中途取消。"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.rounds = 0
+        self.prepared = []
+        self.trained = []
+
+    def prepare_round(self, job_type, batch_size, exclude_ids=None):
+        round_number = len(self.prepared)
+        self.prepared.append(exclude_ids)
+        return [MagicMock(id=f"{round_number}-{i}") for i in range(batch_size)]
+
+    def smelt_new_corpus(
+        self, batch_size, on_step=None, should_stop=None, new_entries=None
+    ):
+        self.rounds += 1
+        self.trained.append([entry.id for entry in new_entries or []])
+        for step in range(2):
+            on_step({"step": step + 1, "total_steps": 2, "loss": 1.0})
+            self.started.set()
+            self.release.wait(5)
+            if should_stop():
+                return {"loss": 1.0, "cancelled": True}
+        return {"loss": 1.0, "cancelled": False}
+
+
+class TestTrainingJobService(unittest.TestCase):
+    def setUp(self):
+        self.training_service = FakeTrainingService()
+        session_service = MagicMock()
+        session_service.get_current_session.return_value = MagicMock(id="session")
+        self.service = TrainingJobService(
+            self.training_service,
+            session_service,
+            ModelWorker("training", max_queue_size=4),
+        )
+
+    def tearDown(self):
+        self.training_service.release.set()
+
+    def _wait_finished(self, job):
+        for snapshot in self.service.watch_job(job.id, timeout=5):
+            pass
+        return snapshot
+
+    def test_runs_all_rounds(self):
+        self.training_service.release.set()
+        job = self.service.submit_job("smelt_new_corpus", rounds=3)
+
+        snapshot = self._wait_finished(job)
+        self.assertEqual(snapshot["status"], "completed")
+        self.assertEqual(job.rounds_completed, 3)
+        self.assertEqual(len(job.results), 3)
+        self.assertEqual(job.progress["round"], 3)
+
+    def test_prefetches_next_round_excluding_current_entries(self):
+        self.training_service.release.set()
+        job = self.service.submit_job("smelt_new_corpus", rounds=3, batch_size=2)
+
+        self._wait_finished(job)
+        self.assertEqual(
+            self.training_service.prepared, [None, {"0-0", "0-1"}, {"1-0", "1-1"}]
+        )
+        self.assertEqual(
+            self.training_service.trained,
+            [["0-0", "0-1"], ["1-0", "1-1"], ["2-0", "2-1"]],
+        )
+
+    def test_cancel_stops_between_steps(self):
+        job = self.service.submit_job("smelt_new_corpus", rounds=3)
+        self.training_service.started.wait(5)
+        self.service.cancel_job(job.id)
+        self.training_service.release.set()
+
+        snapshot = self._wait_finished(job)
+        self.assertEqual(snapshot["status"], "cancelled")
+        self.assertEqual(job.rounds_completed, 0)
+        self.assertEqual(self.training_service.rounds, 1)
+
+    def test_rejects_invalid_job(self):
+        with self.assertRaises(ValueError):
+            self.service.submit_job("train_single_entry")
+        with self.assertRaises(ValueError):
+            self.service.get_job("missing")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from services.training_session_service import TrainingSessionService
+
+
+class TestTrainingSessionService(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def _factories(self, make_session):
+        self.make_session = make_session
+
+    def setUp(self):
+        self.session_repo = MagicMock()
+        self.llm_manager = MagicMock()
+        self.loss_service = MagicMock()
+        self.service = TrainingSessionService(
+            self.session_repo, self.llm_manager, self.loss_service
+        )
+        self.service.current_session = self.make_session()
+
+    @patch("services.training_session_service.settings")
+    def test_losses_are_written_after_the_checkpoint(self, settings):
+        settings.CHECKPOINT_EVERY_ROUNDS = 0
+        settings.CHECKPOINT_EVERY_SECONDS = 0
+        self.service.record_round({"a": 1.0, "b": 2.0}, tokens=30)
+
+        # 计数立即写入会话信息，损失等待检查点
+        self.assertEqual(self.service.current_session.tokens_trained, 30)
+        self.session_repo.update.assert_called()
+        self.loss_service.update_loss.assert_not_called()
+        self.assertEqual(self.service.get_pending_entry_ids(), {"a", "b"})
+
+        self.service.save_current_session()
+        session, state, on_saved = self.llm_manager.save_model.call_args[0]
+        self.assertEqual(state["pending_losses"], {"a": 1.0, "b": 2.0})
+        self.assertEqual(state["rounds_trained"], 1)
+
+        # 检查点写入期间 b 又训练了一轮，保留较新的损失
+        self.service.record_round({"b": 3.0}, tokens=10)
+        on_saved()
+        self.assertEqual(self.loss_service.update_loss.call_count, 2)
+        self.assertEqual(self.service.pending_losses, {"b": 3.0})
+
+    @patch("services.training_session_service.time")
+    @patch("services.training_session_service.settings")
+    def test_checkpoints_follow_the_configured_cadence(self, settings, time):
+        settings.CHECKPOINT_EVERY_ROUNDS = 2
+        settings.CHECKPOINT_EVERY_SECONDS = 600
+        time.monotonic.return_value = 0
+        self.service = TrainingSessionService(
+            self.session_repo, self.llm_manager, self.loss_service
+        )
+        self.service.current_session = self.make_session()
+
+        self.service.record_round({"a": 1.0}, tokens=10)
+        self.llm_manager.checkpoint_model.assert_not_called()
+        self.service.record_round({"b": 1.0}, tokens=10)
+        self.assertEqual(self.llm_manager.checkpoint_model.call_count, 1)
+        _, state, _ = self.llm_manager.checkpoint_model.call_args[0]
+        self.assertEqual(state["pending_losses"], {"a": 1.0, "b": 1.0})
+
+        # 轮数还没到，但距上一个检查点已经超过 600 秒
+        time.monotonic.return_value = 601
+        self.service.record_round({"c": 1.0}, tokens=10)
+        self.assertEqual(self.llm_manager.checkpoint_model.call_count, 2)
+
+    @patch("services.training_session_service.restore_rng_state")
+    def test_load_session_restores_the_checkpoint_state(self, restore_rng_state):
+        self.service.current_session = None
+        stored = self.make_session()
+        stored.tokens_trained = 500
+        self.session_repo.get_by_id.return_value = stored
+        self.llm_manager.load_training_state.return_value = {
+            "tokens_trained": 300,
+            "rounds_trained": 3,
+            "pending_losses": {"a": 1.0},
+            "rng": "rng",
+        }
+
+        session = self.service.load_session("session")
+        self.assertEqual((session.tokens_trained, session.rounds_trained), (300, 3))
+        restore_rng_state.assert_called_once_with("rng")
+        self.loss_service.update_loss.assert_called_once_with("a", 1.0, session)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import json
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.core.config import settings
+from app.core.dependencies import (
+    get_chat_worker,
+    get_llm_manager,
+    get_training_session_service,
+)
+from server import app
+from services.model_worker import ModelWorker
+
+HISTORY = [{"role": "user", "content": "t5 t6 t7"}]
+
+
+def parse_events(body: str):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+@pytest.fixture
+def chat_worker():
+    return ModelWorker("chat", max_queue_size=1)
+
+
+@pytest.fixture
+def client(tiny_llm_manager, chat_worker, make_session):
+    session_service = MagicMock()
+    session_service.get_current_session.return_value = make_session()
+    app.dependency_overrides[get_llm_manager] = lambda: tiny_llm_manager
+    app.dependency_overrides[get_chat_worker] = lambda: chat_worker
+    app.dependency_overrides[get_training_session_service] = lambda: session_service
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+
+
+def test_stream_is_rejected_when_the_chat_queue_is_full(client, chat_worker):
+    started, release = threading.Event(), threading.Event()
+    chat_worker.submit(lambda: started.set() or release.wait(5))
+    started.wait(5)
+    chat_worker.submit(lambda: None)  # 占满队列
+    try:
+        response = client.post("/chat/stream", json={"history": HISTORY})
+    finally:
+        release.set()
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "5"
+
+
+def test_stream_reports_a_request_that_expired_in_the_queue(client, chat_worker):
+    started = threading.Event()
+
+    def block_until_queued():
+        # 对话请求进入队列之后再等到它超时
+        started.set()
+        while chat_worker.stats()["queued"] == 0:
+            time.sleep(0.01)
+        time.sleep(0.1)
+
+    chat_worker.submit(block_until_queued)
+    started.wait(5)
+    with patch.object(settings, "CHAT_REQUEST_TIMEOUT", 0.05), patch.object(
+        settings, "CHAT_STREAM_TIMEOUT", 5.0
+    ):
+        response = client.post("/chat/stream", json={"history": HISTORY})
+
+    # 响应头在生成开始前就已发出，超时通过 error 事件报告
+    assert response.status_code == 200
+    ((event_type, data),) = parse_events(response.text)
+    assert event_type == "error"
+    assert data["error"] == "DeadlineExceededError"
+
+
+def test_stream_sends_tokens_then_done(client):
+    response = client.post(
+        "/chat/stream",
+        json={"history": HISTORY, "max_new_tokens": 8, "do_sample": False},
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.headers["Cache-Control"] == "no-cache"
+    # 每个事件是 event 与 data 两行，以空行结束
+    assert response.text.endswith("\n\n")
+    events = parse_events(response.text)
+    *tokens, (done_type, done) = events
+    assert tokens and all(event_type == "token" for event_type, _ in tokens)
+    assert done_type == "done" and done["done"] is True
+    assert done["chunks"] == len(tokens)
+    assert done["ttft"] <= done["total_time"]
+
+    # 拼接起来与不流式的回复相同
+    reply = client.post(
+        "/chat",
+        json={"history": HISTORY, "max_new_tokens": 8, "do_sample": False},
+    ).json()["response"]
+    assert "".join(data["token"] for _, data in tokens).strip() == reply.strip()
+
+
+def test_stream_reports_a_failed_generation(client, tiny_llm_manager, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("generation failed")
+
+    monkeypatch.setattr(tiny_llm_manager, "chat", fail)
+    response = client.post("/chat/stream", json={"history": HISTORY})
+
+    assert response.status_code == 200
+    assert parse_events(response.text) == [
+        ("error", {"error": "RuntimeError", "detail": "generation failed"})
+    ]
@@ -0,0 +1,97 @@
+from concurrent.futures import Future
+from unittest.mock import MagicMock
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.core.config import settings
+from app.core.dependencies import get_llm_manager
+from server import app
+
+
+@pytest.fixture
+def llm_manager():
+    return MagicMock()
+
+
+@pytest.fixture
+def client(llm_manager, monkeypatch):
+    monkeypatch.setattr(settings, "STARTUP_LOAD_SESSION", True)
+    app.dependency_overrides[get_llm_manager] = lambda: llm_manager
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+
+
+def startup_load(monkeypatch, result=None, error=None, done=True):
+    future = Future()
+    if error is not None:
+        future.set_exception(error)
+    elif done:
+        future.set_result(result)
+    monkeypatch.setattr(app.state, "startup_load", future, raising=False)
+
+
+def test_ready_when_the_model_is_loaded(client, llm_manager):
+    llm_manager.get_load_status.return_value = {"state": "ready", "progress": 1.0}
+
+    response = client.get("/ready")
+
+    assert response.status_code == 200
+    assert response.json()["state"] == "ready"
+
+
+def test_not_ready_while_loading(client, llm_manager):
+    llm_manager.get_load_status.return_value = {"state": "loading", "progress": 0.5}
+
+    response = client.get("/ready")
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    assert response.json()["progress"] == 0.5
+
+
+def test_not_ready_when_loading_failed(client, llm_manager):
+    llm_manager.get_load_status.return_value = {"state": "failed", "error": "boom"}
+
+    response = client.get("/ready")
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    assert response.json()["error"] == "boom"
+
+
+def test_not_ready_before_the_startup_load_starts(client, llm_manager, monkeypatch):
+    llm_manager.get_load_status.return_value = {"state": "idle"}
+    startup_load(monkeypatch, done=False)
+
+    response = client.get("/ready")
+
+    assert response.status_code == 503
+    assert response.json()["state"] == "pending"
+
+
+def test_not_ready_when_the_startup_load_fails_early(client, llm_manager, monkeypatch):
+    llm_manager.get_load_status.return_value = {"state": "idle"}
+    startup_load(monkeypatch, error=ValueError("Session not found"))
+
+    response = client.get("/ready")
+
+    assert response.status_code == 503
+    assert response.json() == {"state": "failed", "error": "Session not found"}
+
+
+def test_ready_when_there_is_no_session_to_load(client, llm_manager, monkeypatch):
+    llm_manager.get_load_status.return_value = {"state": "idle"}
+    startup_load(monkeypatch, result=None)
+
+    assert client.get("/ready").status_code == 200
+
+
+def test_ready_without_a_startup_load(client, llm_manager, monkeypatch):
+    monkeypatch.setattr(settings, "STARTUP_LOAD_SESSION", False)
+    llm_manager.get_load_status.return_value = {"state": "idle"}
+
+    response = client.get("/ready")
+
+    assert response.status_code == 200
+    assert response.json()["state"] == "idle"